@@ -0,0 +1,220 @@
+"""Admission control in front of the upstream LLM calls.
+
+Every call (the reformulation, the answer) first acquires its estimated tokens from the token
+bucket of its model, which refills at the configured tokens and requests per minute. When the
+bucket is short, the call waits in a priority queue of the model, for at most `max_wait` seconds.
+When the queue is full, or the expected wait is longer than that, the request is rejected right
+away with AdmissionRejected, which the endpoints turn into a 429 with Retry-After. So at a rate
+limit a few users wait or retry, instead of every request failing upstream.
+
+The limits are per process: configure the share of the organization's limits of one worker, e.g.
+the OpenAI TPM divided by the number of instances and workers. When the upstream still answers with
+a 429, the bucket of the model is paused for its Retry-After.
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import math
+import re
+import time
+from typing import Dict, Optional, Tuple
+
+from app.api.metrics import ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Lower is served first. Set by the endpoints from the X-Priority header
+DEFAULT_PRIORITY = 5
+current_priority: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "current_priority", default=DEFAULT_PRIORITY
+)
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, model: str, reason: str, retry_after: float):
+        super().__init__(f"{model} is over its rate limit ({reason}), retry in {retry_after:.1f}s")
+        self.model = model
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def parse_limits(spec: str) -> Dict[str, Tuple[Optional[float], Optional[float]]]:
+    """Parses "model=tokens_per_minute:requests_per_minute,..." (either may be left empty)."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        model, _, rates = item.partition("=")
+        tokens_per_minute, _, requests_per_minute = rates.partition(":")
+        limits[model.strip()] = (
+            float(tokens_per_minute) if tokens_per_minute else None,
+            float(requests_per_minute) if requests_per_minute else None,
+        )
+    return limits
+
+
+class TokenBucket:
+    """Tokens and requests per minute. Each starts full, with a minute's worth of capacity."""
+
+    def __init__(self, tokens_per_minute=None, requests_per_minute=None):
+        self.capacity = (tokens_per_minute or math.inf, requests_per_minute or math.inf)
+        self.rates = (self.capacity[0] / 60, self.capacity[1] / 60)
+        self.levels = list(self.capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.levels = [
+                min(capacity, level + rate * elapsed)
+                for capacity, level, rate in zip(self.capacity, self.levels, self.rates)
+            ]
+            self.updated = now
+
+    def wait_time(self, tokens: float, requests=1, now=None) -> float:
+        """Seconds until the tokens and requests are available, 0 if they are now."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        wait = max(self.updated - now, 0.0)  # paused after an upstream 429
+        # A request larger than the capacity would never fit, it waits for a full bucket instead
+        for amount, capacity, level, rate in zip(
+            (tokens, requests), self.capacity, self.levels, self.rates
+        ):
+            missing = min(amount, capacity) - level
+            if missing > 0:
+                wait = max(wait, missing / rate)
+        return wait
+
+    def consume(self, tokens: float):
+        self.levels[0] -= min(tokens, self.capacity[0])
+        self.levels[1] -= 1
+
+    def pause(self, seconds: float):
+        now = time.monotonic()
+        self._refill(now)
+        self.levels = [min(level, 0.0) for level in self.levels]
+        self.updated = max(self.updated, now + seconds)
+
+
+class AdmissionController:
+    """Token buckets and priority queues of the upstream models, see the module docstring."""
+
+    def __init__(self, limits, max_queue=100, max_wait=10.0):
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.buckets = {
+            model: TokenBucket(tokens_per_minute, requests_per_minute)
+            for model, (tokens_per_minute, requests_per_minute) in limits.items()
+        }
+        self._queues = {model: [] for model in self.buckets}  # (priority, seq, tokens, future)
+        self._timers = {}
+        self._sequence = itertools.count()
+        self.admitted = 0
+        self.queued = 0
+        self.upstream_limited = 0
+
+    def queue_depth(self, model=None) -> int:
+        models = self._queues if model is None else [model]
+        return sum(
+            1 for name in models for *_, future in self._queues.get(name, []) if not future.done()
+        )
+
+    def expected_wait(self, model: str, tokens: float) -> float:
+        # The tokens of the requests queued ahead have to come in before these ones
+        bucket = self.buckets[model]
+        queued = [entry for entry in self._queues[model] if not entry[3].done()]
+        return bucket.wait_time(tokens + sum(entry[2] for entry in queued), len(queued) + 1)
+
+    def _reject(self, model, reason, retry_after):
+        ADMISSION_REJECTED.labels(model, reason).inc()
+        raise AdmissionRejected(model, reason, retry_after)
+
+    async def acquire(self, model: str, tokens: float, priority: Optional[int] = None):
+        """Waits until the model's bucket can take the call, raises AdmissionRejected otherwise."""
+        bucket = self.buckets.get(model)
+        if bucket is None:
+            return
+        queue = self._queues[model]
+        if self.queue_depth(model) == 0 and bucket.wait_time(tokens) == 0:
+            bucket.consume(tokens)
+            self.admitted += 1
+            ADMISSION_WAIT_SECONDS.labels(model).observe(0)
+            return
+
+        expected_wait = self.expected_wait(model, tokens)
+        if self.queue_depth(model) >= self.max_queue:
+            self._reject(model, "queue_full", expected_wait)
+        if expected_wait > self.max_wait:
+            self._reject(model, "expected_wait", expected_wait)
+
+        priority = current_priority.get() if priority is None else priority
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(queue, (priority, next(self._sequence), tokens, future))
+        self.queued += 1
+        start = time.perf_counter()
+        self._dispatch(model)
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except asyncio.TimeoutError:
+            self._reject(model, "timeout", self.expected_wait(model, tokens))
+        finally:
+            # The queue head may have been a cancelled (disconnected) request
+            self._dispatch(model)
+        self.admitted += 1
+        ADMISSION_WAIT_SECONDS.labels(model).observe(time.perf_counter() - start)
+
+    def _dispatch(self, model: str):
+        """Admits the queued calls the bucket can take now, and sets a timer for the next one."""
+        timer = self._timers.pop(model, None)
+        if timer is not None:
+            timer.cancel()
+        queue, bucket = self._queues[model], self.buckets[model]
+        while queue:
+            _, _, tokens, future = queue[0]
+            if future.done():
+                heapq.heappop(queue)
+                continue
+            wait = bucket.wait_time(tokens)
+            if wait > 0:
+                loop = asyncio.get_running_loop()
+                self._timers[model] = loop.call_later(wait, self._dispatch, model)
+                return
+            heapq.heappop(queue)
+            bucket.consume(tokens)
+            future.set_result(None)
+
+    def report_rate_limited(self, model: str, retry_after: Optional[float] = None):
+        """Pauses the model's bucket after an upstream 429, the limits are set too high."""
+        bucket = self.buckets.get(model)
+        if bucket is None:
+            return
+        self.upstream_limited += 1
+        retry_after = retry_after if retry_after is not None else 1.0
+        logger.warning(f"{model} answered with a rate limit error, pausing it for {retry_after}s")
+        bucket.pause(retry_after)
+
+    @property
+    def stats(self):
+        stats = {
+            "queue_depth": self.queue_depth(),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "upstream_limited": self.upstream_limited,
+        }
+        for model in self.buckets:
+            name = re.sub(r"\W", "_", model)
+            stats[f"queue_depth_{name}"] = self.queue_depth(model)
+            stats[f"available_tokens_{name}"] = max(self.buckets[model].levels[0], 0)
+        return stats
+
+
+def retry_after_seconds(error) -> Optional[float]:
+    """The Retry-After of an upstream rate limit error (openai.RateLimitError), if it has one."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,263 @@
+"""Caches for the expensive upstream calls of the RAG pipeline."""
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import faiss
+import numpy as np
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+
+class EmbeddingCache:
+    """Bounded LRU cache of query embeddings keyed by (embedding model, normalized query text).
+
+    Entries expire after `ttl` seconds. If `path` is given, embeddings are also written to a SQLite
+    file, which is consulted on a memory miss, so the cache survives instance restarts.
+    """
+
+    def __init__(self, max_size=10000, ttl=7 * 24 * 3600, path=None, max_disk_size=100000):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_disk_size = max_disk_size
+        self._entries = OrderedDict()  # key -> (expires_at, embedding)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._disk = None
+        if path is not None:
+            self._disk = sqlite3.connect(path, check_same_thread=False)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute("PRAGMA synchronous=NORMAL")
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key TEXT PRIMARY KEY, created REAL, embedding BLOB)"
+            )
+            self._disk.execute("DELETE FROM embeddings WHERE created < ?", (time.time() - ttl,))
+            self._disk.commit()
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{normalize_query(text)}".encode()).hexdigest()
+
+    def get(self, model: str, text: str) -> Optional[np.ndarray]:
+        key = self.make_key(model, text)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, embedding = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return embedding
+                del self._entries[key]
+
+            if self._disk is not None:
+                row = self._disk.execute(
+                    "SELECT created, embedding FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[0] + self.ttl > now:
+                    embedding = np.frombuffer(row[1], dtype=np.float32)
+                    self._store(key, row[0] + self.ttl, embedding)
+                    self.disk_hits += 1
+                    return embedding
+
+            self.misses += 1
+            return None
+
+    def put(self, model: str, text: str, embedding):
+        key = self.make_key(model, text)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        now = time.time()
+        with self._lock:
+            self._store(key, now + self.ttl, embedding)
+            if self._disk is not None:
+                self._disk.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                    (key, now, embedding.tobytes()),
+                )
+                self._disk.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings "
+                    "ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_size,),
+                )
+                self._disk.commit()
+
+    def _store(self, key, expires_at, embedding):
+        self._entries[key] = (expires_at, embedding)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    @property
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+        }
+
+
+class CachedAnswer(BaseModel):
+    question: str
+    references: str
+    answer: str
+    hits: int = 0
+
+
+class AnswerCache:
+    """Semantic cache of final answers keyed by the embedding of the reformulated question.
+
+    Lookups search a local FAISS inner product index over the normalized question embeddings, and
+    only count as a hit above the cosine `threshold`. The least recently used answer is evicted
+    once `max_size` is reached, and the whole cache is dropped when the vector index version
+    changes, since the cached references may no longer exist.
+    """
+
+    def __init__(self, max_size=1000, threshold=0.97):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.index_version = None
+        self._index = None
+        self._entries = OrderedDict()  # faiss id -> CachedAnswer
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32).reshape(1, -1).copy()
+        faiss.normalize_L2(vector)
+        return vector
+
+    def _check_version(self, index_version):
+        if index_version != self.index_version:
+            if self._entries:
+                logger.info(
+                    f"Vector index changed ({self.index_version} -> {index_version}), "
+                    f"dropping {len(self._entries)} cached answers"
+                )
+                self.invalidations += 1
+            self.index_version = index_version
+            self._index = None
+            self._entries.clear()
+
+    def lookup(self, embedding, index_version=None) -> Optional[CachedAnswer]:
+        vector = self._normalize(embedding)
+        with self._lock:
+            self._check_version(index_version)
+            if self._index is None or self._index.ntotal == 0:
+                self.misses += 1
+                return None
+            scores, ids = self._index.search(vector, 1)
+            similarity, entry_id = float(scores[0][0]), int(ids[0][0])
+            if entry_id == -1 or similarity < self.threshold:
+                self.misses += 1
+                return None
+            entry = self._entries[entry_id]
+            self._entries.move_to_end(entry_id)
+            entry.hits += 1
+            self.hits += 1
+        logger.info(
+            f"Answer cache hit (similarity {similarity:.3f}, {entry.hits} hits): {entry.question}"
+        )
+        return entry
+
+    def store(self, question, embedding, references, answer, index_version=None):
+        vector = self._normalize(embedding)
+        with self._lock:
+            self._check_version(index_version)
+            if self._index is None:
+                self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(vector.shape[1]))
+            entry_id = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(vector, np.array([entry_id], dtype=np.int64))
+            self._entries[entry_id] = CachedAnswer(
+                question=question, references=references, answer=answer
+            )
+            while len(self._entries) > self.max_size:
+                evicted_id, _ = self._entries.popitem(last=False)
+                self._index.remove_ids(np.array([evicted_id], dtype=np.int64))
+                self.evictions += 1
+
+    @property
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "size": len(self._entries),
+        }
+
+
+class RerankCache:
+    """Bounded LRU cache of rerank results keyed by (reranker, query, set of candidate chunks).
+
+    Chunks are identified by the digest of their text, so entries stay valid when the candidates
+    come back in a different order, or from a new index version with the same chunks.
+    """
+
+    def __init__(self, max_size=10000, ttl=24 * 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, [(chunk id, relevance score)])
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def chunk_id(text: str) -> str:
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    @staticmethod
+    def make_key(reranker: str, query: str, chunk_ids, top_n: int) -> str:
+        query_hash = hashlib.sha256(normalize_query(query).encode()).hexdigest()
+        return hashlib.sha256(
+            "\0".join([reranker, query_hash, str(top_n), *sorted(chunk_ids)]).encode()
+        ).hexdigest()
+
+    def get(self, reranker: str, query: str, documents, top_n: int):
+        """Returns the cached (document index, relevance score) results, or None."""
+        chunk_ids = [self.chunk_id(document) for document in documents]
+        key = self.make_key(reranker, query, chunk_ids, top_n)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        positions = {chunk_id: i for i, chunk_id in enumerate(chunk_ids)}
+        return [(positions[chunk_id], score) for chunk_id, score in entry[1]]
+
+    def put(self, reranker: str, query: str, documents, top_n: int, results):
+        chunk_ids = [self.chunk_id(document) for document in documents]
+        key = self.make_key(reranker, query, chunk_ids, top_n)
+        entry = (time.time() + self.ttl, [(chunk_ids[i], score) for i, score in results])
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    @property
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
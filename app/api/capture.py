@@ -0,0 +1,236 @@
+"""Sampled capture of the chat requests and their upstream responses, for the replay.
+
+With REQUEST_CAPTURE_PATH set, a `sample_rate` share of the /api/chat requests is written to a
+JSONL file, one line per request once its answer stream ends: the request, the retrieval settings
+of the config and what the upstreams answered meanwhile, i.e. the reformulated question, the query
+embeddings (keyed by the hash of the query), the rerank results and the answer. That is all
+`benchmarks/replay.py` needs to run the request again offline, on the same index.
+
+The texts are redacted before they are written: e-mail addresses, IBANs, card, phone and other
+long numbers (tax numbers, EMŠO) are replaced by placeholders, the chat id by its hash and the
+preview token is dropped. Names and other free text are kept, so the files are still personal data.
+
+The file is rotated when it would exceed `max_bytes`, to `<path>.1`, `<path>.2`, ... keeping
+`backups` of them. With several gunicorn workers, put `{pid}` in the path to get one per worker.
+"""
+
+import asyncio
+import base64
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import aclosing
+from typing import Optional
+
+import numpy as np
+
+from app.api.cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+REDACTIONS = [
+    (re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+"), "<email>"),
+    (re.compile(r"\b[A-Z]{2}\d{2}(?: ?[A-Z0-9]{4}){3,7}(?: ?[A-Z0-9]{1,3})?\b"), "<iban>"),
+    (re.compile(r"\b\d{4}(?:[ -]\d{4}){3}\b"), "<card>"),
+    (
+        re.compile(r"(?<![\w.,])(?:(?:\+|00)386[ /-]?|0)\d{1,2}[ /-]?\d{3}[ /-]?\d{2} ?\d{1,2}\b"),
+        "<phone>",
+    ),
+    (re.compile(r"\b\d{8,}\b"), "<number>"),
+]
+
+# The scalar settings of the Config the replay runs the request with
+REPLAYED_SETTINGS = (
+    "retrieve_n",
+    "rerank_max_n",
+    "max_context_len",
+    "model",
+    "embedding_model",
+    "use_reformulated_question",
+    "pipeline_mode",
+    "speculative_similarity_threshold",
+    "hybrid_search",
+    "rrf_k",
+    "hybrid_rerank_pool",
+    "hybrid_skip_rerank_agreement",
+    "rerank_skip_gap",
+    "shard_routing",
+    "shard_centroid_margin",
+    "max_routed_shards",
+    "index_version",
+)
+
+
+def redact(text: str) -> str:
+    for pattern, placeholder in REDACTIONS:
+        text = pattern.sub(placeholder, text)
+    return text
+
+
+def text_key(text: str) -> str:
+    # Redacting is idempotent, so a replayed (already redacted) text has the key it was stored with
+    return hashlib.sha256(normalize_query(redact(text)).encode()).hexdigest()[:16]
+
+
+def encode_vector(vector) -> str:
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode()
+
+
+def decode_vector(data: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(data), dtype=np.float32)
+
+
+def config_settings(config) -> dict:
+    settings = {name: getattr(config, name, None) for name in REPLAYED_SETTINGS}
+    pruning = getattr(config, "pruning", None)
+    settings["pruning"] = None
+    if pruning is not None:
+        settings["pruning"] = {
+            "dedup_threshold": pruning.dedup_threshold,
+            "mmr_lambda": pruning.mmr_lambda,
+            "mmr_n": pruning.mmr_n,
+            "group": pruning.group,
+        }
+    return settings
+
+
+class CaptureRecord:
+    """What one request sent and received, filled in by the pipeline while it runs."""
+
+    def __init__(self, request: dict, settings: dict):
+        self.id = uuid.uuid4().hex
+        self.start = time.time()
+        self.request = request
+        self.settings = settings
+        self.reformulations = []
+        self.embeddings = {}  # text key -> base64 float32 vector
+        self.reranks = {}  # text key of the query -> [[document index, relevance score], ...]
+        self.answer_deltas = []
+
+    def add_reformulation(self, question: str):
+        self.reformulations.append(redact(question))
+
+    def add_embedding(self, text: str, embedding):
+        self.embeddings[text_key(text)] = encode_vector(embedding)
+
+    def add_rerank(self, query: str, results):
+        self.reranks[text_key(query)] = [[int(i), float(score)] for i, score in results]
+
+    def add_answer_delta(self, delta: str):
+        self.answer_deltas.append(delta)
+
+    def to_json(self, status: str) -> str:
+        return json.dumps(
+            {
+                "id": self.id,
+                "ts": self.start,
+                "status": status,
+                "duration_ms": round(1000 * (time.time() - self.start), 1),
+                "settings": self.settings,
+                "request": self.request,
+                "upstream": {
+                    "reformulations": self.reformulations,
+                    "embeddings": self.embeddings,
+                    "reranks": self.reranks,
+                    # Redacted as a whole, as a number may be split across deltas
+                    "answer": redact("".join(self.answer_deltas)),
+                    "answer_deltas": len(self.answer_deltas),
+                },
+            },
+            ensure_ascii=False,
+        )
+
+
+# The record of the request being served, if it is captured
+current_capture: contextvars.ContextVar[Optional[CaptureRecord]] = contextvars.ContextVar(
+    "current_capture", default=None
+)
+
+
+class RequestCapture:
+    def __init__(self, path, sample_rate=0.01, max_bytes=50_000_000, backups=3, seed=None):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.captured = 0
+        self.skipped = 0
+        self.rotations = 0
+        self.errors = 0
+        self.bytes_written = 0
+
+    def start(self, chat_request: dict, config) -> Optional[CaptureRecord]:
+        """The record of a sampled request, None if the request is not captured."""
+        if self._rng.random() >= self.sample_rate:
+            self.skipped += 1
+            return None
+        chat_id = chat_request.get("chat_id")
+        request = {
+            "messages": [
+                {"role": message["role"], "content": redact(message["content"])}
+                for message in chat_request["messages"]
+            ],
+            "chat_id": hashlib.sha256(chat_id.encode()).hexdigest()[:16] if chat_id else None,
+            "sources": chat_request.get("sources"),
+        }
+        return CaptureRecord(request, config_settings(config))
+
+    async def stream(self, stream, record: CaptureRecord):
+        """Passes the answer stream through, then writes the record."""
+        status = "error"
+        try:
+            async with aclosing(stream):
+                async for chunk in stream:
+                    yield chunk
+            status = "completed"
+        except (GeneratorExit, asyncio.CancelledError):
+            status = "disconnected"
+            raise
+        finally:
+            self.write(record.to_json(status))
+
+    def write(self, line: str):
+        # The path is resolved on first use, in the worker process that writes
+        path = self.path.format(pid=os.getpid())
+        data = (line + "\n").encode()
+        try:
+            with self._lock:
+                if os.path.exists(path) and os.path.getsize(path) + len(data) > self.max_bytes:
+                    self._rotate(path)
+                with open(path, "ab") as f:
+                    f.write(data)
+                self.captured += 1
+                self.bytes_written += len(data)
+        except OSError as e:
+            # Capturing must never fail the request
+            self.errors += 1
+            logger.warning(f"Could not write the captured request to {path}: {e}")
+
+    def _rotate(self, path):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{path}.{i}"):
+                os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(path, f"{path}.1")
+        else:
+            os.remove(path)
+        self.rotations += 1
+
+    @property
+    def stats(self):
+        return {
+            "captured": self.captured,
+            "skipped": self.skipped,
+            "rotations": self.rotations,
+            "errors": self.errors,
+            "bytes_written": self.bytes_written,
+        }
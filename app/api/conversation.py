@@ -0,0 +1,209 @@
+"""Per-chat conversation state, so that long chats do not resend their whole history every turn.
+
+For every chat_id the store keeps a rolling summary of the older messages and the last
+reformulated question. The reformulation and the answer then get the summary plus the messages
+after it, instead of the full history. After each answer, the messages that no longer fit the
+history token budget are folded into the summary (see `update_conversation` in
+app.api.openai_interface).
+
+States live in an in-memory LRU, backed by an optional shared backend (SQLite, or a Redis-like
+key-value client), so that a chat can continue on another instance or after a restart.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_INTRO = "Povzetek prejšnjega dela pogovora:\n"
+
+
+class ConversationState(BaseModel):
+    chat_id: str
+    summary: str = ""
+    # The number of leading messages folded into the summary, and their digest, so that an edited
+    # or different history is not answered with the summary of another one
+    summarized_messages: int = 0
+    summarized_digest: str = ""
+    # The last reformulated question, and the digest of the history it was made for
+    last_reformulation: Optional[str] = None
+    reformulation_digest: str = ""
+    updated_at: float = 0.0
+
+
+def history_digest(messages) -> str:
+    digest = hashlib.sha256()
+    for message in messages:
+        digest.update(f"{message.role}\0{message.content}\0".encode())
+    return digest.hexdigest()
+
+
+def count_message_tokens(messages, encoder) -> int:
+    return sum(len(encoder.encode(f"{message.role}: {message.content} \n")) for message in messages)
+
+
+def summarized_prefix(state: Optional[ConversationState], messages) -> int:
+    """The number of leading messages the state's summary stands in for, 0 if it does not apply."""
+    if state is None or not state.summary:
+        return 0
+    n = state.summarized_messages
+    if n == 0 or n >= len(messages) or history_digest(messages[:n]) != state.summarized_digest:
+        return 0
+    return n
+
+
+def split_for_summary(messages, encoder, token_budget: int, keep_last=2) -> int:
+    """The number of leading messages to summarize, 0 while the messages fit the token budget.
+
+    Once they do not, the older messages are summarized down to half the budget, so that the
+    summary is updated every few turns rather than on every turn. The last `keep_last` messages
+    (the previous answer and the new question) are always kept.
+    """
+    token_counts = [count_message_tokens([message], encoder) for message in messages]
+    if sum(token_counts) <= token_budget:
+        return 0
+    n_kept, tokens = 0, 0
+    for count in reversed(token_counts):
+        tokens += count
+        if n_kept >= keep_last and tokens > token_budget // 2:
+            break
+        n_kept += 1
+    return len(messages) - n_kept
+
+
+class SQLiteConversationBackend:
+    def __init__(self, path, ttl=30 * 24 * 3600):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations "
+            "(chat_id TEXT PRIMARY KEY, updated REAL, state TEXT)"
+        )
+        self._conn.execute("DELETE FROM conversations WHERE updated < ?", (time.time() - ttl,))
+        self._conn.commit()
+
+    def get(self, chat_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT updated, state FROM conversations WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+        if row is None or row[0] + self.ttl < time.time():
+            return None
+        return row[1]
+
+    def put(self, chat_id: str, data: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)",
+                (chat_id, time.time(), data),
+            )
+            self._conn.commit()
+
+
+class KeyValueConversationBackend:
+    """Backend on a Redis-like client, anything with `get(key)` and `set(key, value, ex=ttl)`."""
+
+    def __init__(self, client, prefix="taxgpt:chat:", ttl=30 * 24 * 3600):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, chat_id: str) -> Optional[str]:
+        data = self.client.get(self.prefix + chat_id)
+        return data.decode() if isinstance(data, bytes) else data
+
+    def put(self, chat_id: str, data: str):
+        self.client.set(self.prefix + chat_id, data, ex=self.ttl)
+
+
+class ConversationStore:
+    """Bounded LRU of conversation states, in front of an optional shared backend."""
+
+    def __init__(self, max_size=10000, backend=None):
+        self.max_size = max_size
+        self.backend = backend
+        self._states = OrderedDict()  # chat_id -> ConversationState
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+        self.summaries = 0
+        self.reused_reformulations = 0
+        # Prompt tokens of the histories as received, and as sent upstream after the compaction
+        self.history_tokens = 0
+        self.sent_history_tokens = 0
+
+    def get(self, chat_id: str) -> Optional[ConversationState]:
+        with self._lock:
+            state = self._states.get(chat_id)
+            if state is not None:
+                self._states.move_to_end(chat_id)
+                self.hits += 1
+                return state.model_copy()
+
+        data = None
+        if self.backend is not None:
+            try:
+                data = self.backend.get(chat_id)
+            except Exception as e:
+                logger.warning(f"Could not load the state of chat {chat_id}: {e}")
+        if data is None:
+            self.misses += 1
+            return None
+        state = ConversationState(**json.loads(data))
+        self.backend_hits += 1
+        self._store(state)
+        return state.model_copy()
+
+    def put(self, state: ConversationState):
+        state.updated_at = time.time()
+        self._store(state.model_copy())
+        if self.backend is not None:
+            try:
+                self.backend.put(state.chat_id, state.model_dump_json())
+            except Exception as e:
+                logger.warning(f"Could not save the state of chat {state.chat_id}: {e}")
+
+    def _store(self, state: ConversationState):
+        with self._lock:
+            self._states[state.chat_id] = state
+            self._states.move_to_end(state.chat_id)
+            while len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+
+    def record_compaction(self, history_tokens: int, sent_history_tokens: int):
+        self.history_tokens += history_tokens
+        self.sent_history_tokens += sent_history_tokens
+
+    @property
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "backend_hits": self.backend_hits,
+            "misses": self.misses,
+            "size": len(self._states),
+            "summaries": self.summaries,
+            "reused_reformulations": self.reused_reformulations,
+            "history_tokens": self.history_tokens,
+            "sent_history_tokens": self.sent_history_tokens,
+            "saved_history_tokens": self.history_tokens - self.sent_history_tokens,
+        }
+
+
+def summary_content(summary: str) -> str:
+    return SUMMARY_INTRO + summary
+
+
+def format_history(messages: List) -> str:
+    return "".join(f"{message.role}: {message.content} \n" for message in messages)
@@ -0,0 +1,72 @@
+"""Cancellation of the request pipeline when the client disconnects.
+
+Before the response starts (reformulation, embedding, search, rerank), the work runs next to a
+watcher of the client connection and is cancelled when the client goes away. While streaming, the
+response cancels the stream and closes the generator chain right away, which closes the upstream
+OpenAI stream. Abandoned requests are counted by the stage they were abandoned in.
+"""
+
+import asyncio
+import contextlib
+
+from starlette.responses import StreamingResponse
+
+from app.api.metrics import ABANDONED_REQUESTS
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def run_unless_disconnected(request, awaitable):
+    """Runs the awaitable, cancelling it and raising ClientDisconnected if the client goes away."""
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(wait_for_disconnect(request.receive))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+    if task.cancelled():
+        ABANDONED_REQUESTS.labels("pre_answer").inc()
+        raise ClientDisconnected()
+    return task.result()
+
+
+class DisconnectAwareStreamingResponse(StreamingResponse):
+    """Streaming response that stops the stream as soon as the client disconnects.
+
+    Unlike the base class on ASGI servers that only report a disconnect on the next write, it always
+    listens for the disconnect, and it closes the body iterator so its cleanup runs immediately.
+    """
+
+    async def __call__(self, scope, receive, send):
+        stream_task = asyncio.ensure_future(self.stream_response(send))
+        disconnect_task = asyncio.ensure_future(self.listen_for_disconnect(receive))
+        try:
+            await asyncio.wait({stream_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            disconnect_task.cancel()
+            if not stream_task.done():
+                stream_task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await stream_task
+            if hasattr(self.body_iterator, "aclose"):
+                await self.body_iterator.aclose()
+
+        if stream_task.cancelled() or isinstance(stream_task.exception(), OSError):
+            ABANDONED_REQUESTS.labels("streaming").inc()
+            return
+        stream_task.result()
+        if self.background is not None:
+            await self.background()
@@ -0,0 +1,136 @@
+"""Backends embedding the queries (and, when the index is rebuilt, the chunks).
+
+The OpenAI embeddings are the default. A local sentence embedding model exported to ONNX can be
+used instead (EMBEDDING_BACKEND=local), it runs on the CPU without a network round trip per query
+and needs `onnxruntime` and `tokenizers`. Vectors of different backends are not comparable, so an
+index only serves queries of the backend that built it (see app.index.store and app.index.rebuild).
+"""
+
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from app.api.startup import startup
+
+logger = logging.getLogger(__name__)
+
+QUANTIZED_MODEL_FILENAME = "model_quantized.onnx"
+
+
+class LocalEmbeddings(Embeddings):
+    """Local sentence embedding model, an ONNX export with its `tokenizer.json` in `model_path`.
+
+    The token embeddings are mean pooled and L2 normalized. The int8 model written by
+    `quantize_model` is used when present. Some models expect a prefix on the queries and the
+    documents (e.g. "query: " and "passage: " for the E5 models). Inference runs on a dedicated
+    thread, so it neither blocks the event loop nor the FAISS searches.
+    """
+
+    def __init__(
+        self,
+        model_path,
+        query_prefix="",
+        document_prefix="",
+        max_length=512,
+        batch_size=32,
+        threads=None,
+        quantized=True,
+    ):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self.model = os.path.basename(os.path.normpath(model_path))
+        self.name = f"local/{self.model}"
+        self.query_prefix = query_prefix
+        self.document_prefix = document_prefix
+        self.batch_size = batch_size
+        model_file = os.path.join(model_path, QUANTIZED_MODEL_FILENAME)
+        if not quantized or not os.path.exists(model_file):
+            model_file = os.path.join(model_path, "model.onnx")
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            model_file, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_path, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length)
+        self.tokenizer.enable_padding()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="local-embeddings")
+        logger.info(f"Loaded the {self.name} embeddings from {model_file}")
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start : start + self.batch_size])
+            attention_mask = np.array([encoding.attention_mask for encoding in encodings])
+            inputs = {
+                "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+                "attention_mask": attention_mask.astype(np.int64),
+                "token_type_ids": np.array(
+                    [encoding.type_ids for encoding in encodings], dtype=np.int64
+                ),
+            }
+            inputs = {name: value for name, value in inputs.items() if name in self.input_names}
+            token_embeddings = self.session.run(None, inputs)[0]
+            mask = attention_mask[:, :, None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            vectors.append(pooled / np.linalg.norm(pooled, axis=1, keepdims=True))
+        return np.concatenate(vectors).astype(np.float32)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed([self.document_prefix + text for text in texts]).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed([self.query_prefix + text])[0].tolist()
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.embed_documents, texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.embed_query, text)
+
+    def warm_up(self):
+        # The first inference allocates the session's buffers
+        self.embed_query("davek")
+
+
+def backend_spec(embeddings) -> dict:
+    """Identifies the backend and model of the embeddings, as recorded next to an index."""
+    if isinstance(embeddings, LocalEmbeddings):
+        return {"backend": "local", "model": embeddings.model}
+    return {"backend": "openai", "model": getattr(embeddings, "model", None)}
+
+
+def create_embeddings(
+    backend="openai", model=None, model_path=None, query_prefix="", document_prefix=""
+):
+    if backend == "openai":
+        # langchain_openai is imported on first use, it is slow
+        OpenAIEmbeddings = startup.timed_import("langchain_openai").OpenAIEmbeddings
+        return OpenAIEmbeddings(model=model)
+    if backend == "local":
+        if model_path is None:
+            raise ValueError("The local embedding backend needs the path of the ONNX model")
+        return LocalEmbeddings(
+            model_path, query_prefix=query_prefix, document_prefix=document_prefix
+        )
+    raise ValueError(f"Unknown embedding backend {backend}")
+
+
+def quantize_model(model_path):
+    """Writes the int8 (dynamically quantized) variant of the model, preferred when loading it."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    output = os.path.join(model_path, QUANTIZED_MODEL_FILENAME)
+    quantize_dynamic(os.path.join(model_path, "model.onnx"), output, weight_type=QuantType.QInt8)
+    logger.info(f"Wrote the quantized model to {output}")
+    return output
@@ -0,0 +1,179 @@
+"""Per-stage latency metrics of the RAG pipeline.
+
+Every stage (reformulate, embed, search, rerank, pack, first_token, stream) is timed with `stage`,
+which observes a Prometheus histogram (served on /metrics), adds the duration to the timings of the
+current request (sent as the `Server-Timing` header) and, with OTEL_TRACING=1 and the
+opentelemetry packages installed, records an OpenTelemetry span. Timing a stage costs a few
+microseconds, so it is always on.
+"""
+
+import contextvars
+import os
+import time
+from contextlib import aclosing, contextmanager
+from typing import Dict, Optional
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Histogram, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+STAGE_SECONDS = Histogram(
+    "taxgpt_stage_seconds",
+    "Duration of the stages of answering a question",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64),
+)
+STREAMED_TOKENS = Counter("taxgpt_streamed_tokens", "Answer tokens streamed to the clients")
+ABANDONED_REQUESTS = Counter(
+    "taxgpt_abandoned_requests",
+    "Requests whose client disconnected before the answer was complete",
+    ["stage"],
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    "taxgpt_admission_wait_seconds",
+    "Time the upstream calls waited in the admission queue of their model",
+    ["model"],
+    buckets=(0, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32),
+)
+ADMISSION_REJECTED = Counter(
+    "taxgpt_admission_rejected",
+    "Upstream calls rejected by the admission control (answered with a 429)",
+    ["model", "reason"],
+)
+FALLBACKS = Counter(
+    "taxgpt_fallbacks",
+    "Upstream calls that missed their deadline or failed, and the fallback used instead",
+    ["stage", "fallback"],
+)
+HEDGED_CALLS = Counter(
+    "taxgpt_hedged_calls",
+    "Upstream calls for which a hedged duplicate was sent, by the call that returned first",
+    ["stage", "winner"],
+)
+SHARD_ROUTES = Counter(
+    "taxgpt_shard_routes",
+    "Searches by how their shards were picked (filter, keyword, centroid, or all for no routing)",
+    ["reason"],
+)
+
+tracer = None
+if os.environ.get("OTEL_TRACING", "0") == "1":
+    from opentelemetry import trace
+
+    tracer = trace.get_tracer("taxgpt")
+
+
+class RequestTimings:
+    """Total duration of each stage within one request, in seconds."""
+
+    def __init__(self):
+        self.durations: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float):
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        return ", ".join(
+            f"{name};dur={1000 * seconds:.1f}" for name, seconds in self.durations.items()
+        )
+
+
+current_timings: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar(
+    "current_timings", default=None
+)
+
+
+def observe(name: str, seconds: float):
+    STAGE_SECONDS.labels(name).observe(seconds)
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
+    if tracer is not None:
+        # Spans get explicit times instead of being entered, so stages may span generator yields
+        end_time = time.time_ns()
+        span = tracer.start_span(name, start_time=end_time - int(seconds * 1e9))
+        span.end(end_time=end_time)
+
+
+# Set by the replay (benchmarks/replay.py) to profile the code of each stage separately
+current_stage_profiler: contextvars.ContextVar = contextvars.ContextVar(
+    "current_stage_profiler", default=None
+)
+
+
+@contextmanager
+def stage(name: str):
+    profiler = current_stage_profiler.get()
+    if profiler is not None:
+        profiler.enter(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+        if profiler is not None:
+            profiler.exit(name)
+
+
+async def start_timed_stream(stream, sse_comment=False):
+    """Runs the stream up to its first chunk, so the stages before it are timed.
+
+    Returns the timings, to be sent as the `Server-Timing` header, and the whole stream, led by a
+    `: server-timing` SSE comment if `sse_comment` is set.
+    """
+    timings = RequestTimings()
+    token = current_timings.set(timings)
+    try:
+        first_chunk = await stream.__anext__()
+    except StopAsyncIteration:
+        first_chunk = None
+    finally:
+        current_timings.reset(token)
+
+    async def timed_stream():
+        if sse_comment:
+            yield f": server-timing {timings.server_timing()}\n\n".encode()
+        if first_chunk is not None:
+            yield first_chunk
+            async with aclosing(stream):
+                async for chunk in stream:
+                    yield chunk
+
+    return timings, timed_stream()
+
+
+class StatsCollector:
+    """Exports the `stats` counters of the caches and rerankers as `taxgpt_<source>_<stat>`."""
+
+    def __init__(self):
+        self.sources = {}
+
+    def collect(self):
+        for source_name, source in list(self.sources.items()):
+            for stat, value in source.stats.items():
+                yield GaugeMetricFamily(
+                    f"taxgpt_{source_name}_{stat}", f"{stat} of the {source_name}", value=value
+                )
+
+
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
+
+
+def register_stats_source(name: str, source):
+    if source is not None:
+        stats_collector.sources[name] = source
+
+
+def metrics_registry():
+    """The registry to serve on /metrics.
+
+    With several gunicorn workers (PROMETHEUS_MULTIPROC_DIR set, see gunicorn_conf.py) the
+    histograms and counters are aggregated over all the workers, the cache stats are the ones of the
+    worker serving the scrape.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(stats_collector)
+    return registry
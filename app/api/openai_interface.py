@@ -1,14 +1,48 @@
+import asyncio
 import logging
 import json
+import time
+from contextlib import aclosing, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional, Dict
 from pydantic import BaseModel
-from openai import OpenAI
-from app.api.retrieval import get_law_context_chunks
-from app.api.prompts import CHATBOT_PROMPT, RAG_PROMPT
+from openai import AsyncOpenAI, RateLimitError
+from app.api.retrieval import (
+    cosine_similarity,
+    current_sources,
+    embed_query,
+    get_encoder,
+    get_law_context_chunks,
+)
+from app.api.prompts import CHATBOT_PROMPT, RAG_PROMPT, SUMMARY_PROMPT
+from app.api.admission import AdmissionController, AdmissionRejected, retry_after_seconds
+from app.api.capture import RequestCapture, current_capture
+from app.api.cache import AnswerCache, CachedAnswer, EmbeddingCache, RerankCache
+from app.api.conversation import (
+    ConversationState,
+    ConversationStore,
+    count_message_tokens,
+    format_history,
+    history_digest,
+    split_for_summary,
+    summarized_prefix,
+    summary_content,
+)
+from app.api.metrics import STREAMED_TOKENS, observe, stage
+from app.api.pruning import CandidatePruning
+from app.api.rerank import Reranker
+from app.api.resilience import Resilience, call_upstream, record_fallback
+from app.api.sse import DONE_FRAME, coalesce_events, encode_event
 from langchain_community.vectorstores.faiss import FAISS
 
 logger = logging.getLogger(__name__)
 
+REFORMULATION_MODEL = "gpt-4o"
+# Completion tokens reserved for a reformulation or a summary (JSON answers of a few sentences)
+JSON_COMPLETION_TOKENS = 200
+# The summaries run in the background and yield to the users' requests in the admission queues
+SUMMARY_PRIORITY = 9
+
 
 class Message(BaseModel):
     content: str
@@ -20,10 +54,65 @@ class Config(BaseModel):
     rerank_max_n: int
     max_context_len: int
     model: str
-    client: OpenAI
+    client: AsyncOpenAI
     embedding_model: str
     db: FAISS
     use_reformulated_question: Optional[bool] = False
+    # Bounded pool for the CPU bound FAISS search, so it never runs on the event loop
+    search_executor: Optional[ThreadPoolExecutor] = None
+    # "sequential": reformulate, then retrieve. "speculative": skip the reformulation for
+    # single-turn chats, otherwise retrieve on the raw question while reformulating
+    pipeline_mode: Optional[str] = "sequential"
+    speculative_similarity_threshold: Optional[float] = 0.9
+    embedding_cache: Optional[EmbeddingCache] = None
+    # Only used together with use_reformulated_question, as the answer must not depend on history
+    answer_cache: Optional[AnswerCache] = None
+    index_version: Optional[str] = None
+    # Query time knobs of the approximate index variants (see app.index.variants)
+    faiss_nprobe: Optional[int] = None
+    faiss_ef_search: Optional[int] = None
+    # Batched retrieval: concurrent rerank calls, and the batch size from which results stream
+    rerank_concurrency: Optional[int] = 8
+    batch_stream_threshold: Optional[int] = 20
+    # Hybrid retrieval: BM25 hits (the index's bm25.npz sidecar) fused with the FAISS hits
+    hybrid_search: Optional[bool] = False
+    rrf_k: Optional[int] = 60
+    hybrid_rerank_pool: Optional[int] = None
+    hybrid_skip_rerank_agreement: Optional[float] = None
+    # None uses the process wide Cohere reranker. The gap gate skips reranking when the last top
+    # rerank_max_n chunk is better than the next one by at least the gap, in similarity for an
+    # inner product index and in squared distance for an L2 one
+    reranker: Optional[Reranker] = None
+    rerank_cache: Optional[RerankCache] = None
+    rerank_skip_gap: Optional[float] = None
+    # Also send the stage timings as a leading SSE comment, for clients that cannot read headers
+    sse_timing_comment: Optional[bool] = False
+    # Coalescing of the answer deltas into SSE frames, a flush interval of 0 sends every delta
+    sse_flush_interval: Optional[float] = 0.03
+    sse_flush_bytes: Optional[int] = 1024
+    sse_flush_on_newline: Optional[bool] = True
+    # Per-chat rolling summaries (see app.api.conversation): after each answer, the history beyond
+    # the token budget is folded into the summary, which then replaces it in the prompts
+    conversation_store: Optional[ConversationStore] = None
+    history_token_budget: Optional[int] = 1500
+    summary_model: Optional[str] = "gpt-4o-mini"
+    # Rate limits of the upstream models (see app.api.admission). The answer calls reserve the
+    # tokens of their prompt plus expected_answer_tokens
+    admission: Optional[AdmissionController] = None
+    expected_answer_tokens: Optional[int] = 800
+    # Deadlines, hedging and retries of the embedding, rerank and reformulation calls, with the
+    # rerank and reformulation falling back to the embedding ranking and the raw question
+    resilience: Optional[Resilience] = None
+    # Law family shards of the index (see app.index.shards): a query only searches the shards of
+    # the laws it names or, with a centroid margin, the up to max_routed_shards closest to it.
+    # Turning the routing off keeps restricting the requests with sources to their shards
+    shard_routing: Optional[bool] = True
+    shard_centroid_margin: Optional[float] = None
+    max_routed_shards: Optional[int] = 3
+    # Deduplication, MMR and grouping of the retrieved chunks before the rerank (app.api.pruning)
+    pruning: Optional[CandidatePruning] = None
+    # Sampled capture of the chat requests and their upstream responses, for the replay
+    capture: Optional[RequestCapture] = None
 
     class Config:
         arbitrary_types_allowed = True
@@ -43,44 +132,38 @@ def add_context_to_messages(messages, context):
     return enriched_messages
 
 
-def process_chunk(chunk: bytes) -> str:
-    content = chunk.choices[0].delta.content if chunk.choices[0].delta.content else ""
-    # Split the content into lines and prefix each with 'data: '
-    # Then join them back together, ending with double newlines.
-    return "\n".join("data: " + line for line in content.split("\n")) + "\n\n"
-
-
-def get_openai_stream(messages: List[Message], config: Config):
+async def get_openai_stream(messages: List[Message], config: Config, chat_id=None):
     # Extract the configuration parameters
     client = config.client
-    k = config.k
-    max_context_len = config.max_context_len
     model = config.model
-    embedding_model = config.embedding_model
     db = config.db
+    conversation, history = load_conversation(chat_id, messages, config)
 
-    print("Vector database type: ", type(db))
+    logger.info(f"Vector database type: {type(db)}")
     # Retrieve the context relevant for the latest message and create the new message
-    context = get_law_context_chunks(
-        messages[-1].content,
-        k=k,
-        max_context_len=max_context_len,
-        embedding_model=embedding_model,
-        db=db,
-    )[0]
-    enriched_messages = add_context_to_messages(messages, context)
+    context, _ = await get_law_context_chunks(messages[-1].content, **get_retrieval_kwargs(config))
+    enriched_messages = add_context_to_messages(history, context)
 
     # Prepend the messages with a system prompt
     enriched_messages = [Message(content=CHATBOT_PROMPT, role="system")] + enriched_messages
 
     # Get response from OpenAI
     logger.info("Sending API request to OpenAI")
-    openai_stream = client.chat.completions.create(
-        model=model, messages=enriched_messages, temperature=0, stream=True
+    await admit(config, model, enriched_messages, config.expected_answer_tokens)
+    answer_parts = []
+    answer = stream_response(
+        enriched_messages,
+        model,
+        client,
+        answer_parts,
+        admission=config.admission,
+        **get_coalesce_kwargs(config),
     )
-    for chunk in openai_stream:
-        yield process_chunk(chunk)
-    yield "data: [DONE]\n\n"  # Properly formatted SSE message for stream end if needed
+    async with aclosing(answer):
+        async for chunk in answer:
+            yield chunk
+    if conversation is not None:
+        schedule_conversation_update(conversation, messages, "".join(answer_parts), config)
 
 
 ############################################################################################
@@ -90,45 +173,273 @@ def get_openai_stream(messages: List[Message], config: Config):
 # 3. Send the system prompt, reformulated question, and the context to openAI
 # 4. Stream back the response
 ############################################################################################
-def reformulate_question(logged_messages: List[Message], config: Config):
-    conversation_history = [message.model_dump() for message in logged_messages]
-    conversation_history = [f"{msg['role']}: {msg['content']} \n" for msg in conversation_history]
-    conversation_history_string = "".join(conversation_history)
-    prompt = RAG_PROMPT.replace("{conversation_history}", conversation_history_string)
+async def reformulate_question(
+    logged_messages: List[Message], config: Config, conversation: ConversationState = None
+):
+    # A retried turn (same history) reuses the reformulation stored with the chat
+    digest = history_digest(logged_messages) if conversation is not None else None
+    if conversation is not None and conversation.reformulation_digest == digest:
+        logger.info("Reusing the reformulation of the same chat history")
+        config.conversation_store.reused_reformulations += 1
+        return capture_reformulation(conversation.last_reformulation)
+
+    prompt = RAG_PROMPT.replace("{conversation_history}", format_history(logged_messages))
+    message = [Message(role="user", content=prompt)]
+
+    async def request_reformulation():
+        # Every attempt, hedged or retried, is admitted on its own
+        await admit(config, REFORMULATION_MODEL, message, JSON_COMPLETION_TOKENS)
+        with reporting_rate_limits(config.admission, REFORMULATION_MODEL):
+            completion = await config.client.chat.completions.create(
+                model=REFORMULATION_MODEL,
+                messages=message,
+                temperature=0,
+                stream=False,
+                response_format={"type": "json_object"},
+            )
+        return json.loads(completion.choices[0].message.content)["reformulated_question"]
+
+    try:
+        with stage("reformulate"):
+            reformulated_question = await call_upstream(
+                config.resilience, "reformulate", request_reformulation
+            )
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        if config.resilience is None:
+            raise
+        # The raw question is enough for the retrieval of most follow-up questions
+        record_fallback("reformulate", "raw_question", e)
+        return capture_reformulation(logged_messages[-1].content)
+    if conversation is not None:
+        conversation.last_reformulation = reformulated_question
+        conversation.reformulation_digest = digest
+        config.conversation_store.put(conversation)
+    return capture_reformulation(reformulated_question)
+
+
+def capture_reformulation(question: str) -> str:
+    # The question the request goes on with, however it was reformulated (see app.api.capture)
+    record = current_capture.get()
+    if record is not None:
+        record.add_reformulation(question)
+    return question
+
+
+def load_conversation(chat_id: Optional[str], messages: List[Message], config: Config):
+    """Returns the chat's state and its history, with the summarized messages replaced by the
+    summary.
+
+    Without a conversation store or a chat_id the history is the messages as received.
+    """
+    store = config.conversation_store
+    if store is None or chat_id is None:
+        return None, messages
+    conversation = store.get(chat_id) or ConversationState(chat_id=chat_id)
+    history = messages
+    n_summarized = summarized_prefix(conversation, messages)
+    if n_summarized > 0:
+        summary_message = Message(role="system", content=summary_content(conversation.summary))
+        history = [summary_message] + messages[n_summarized:]
+    encoder = get_encoder(config.model)
+    store.record_compaction(
+        count_message_tokens(messages, encoder), count_message_tokens(history, encoder)
+    )
+    return conversation, history
+
+
+async def summarize_history(summary: str, messages: List[Message], config: Config) -> str:
+    prompt = SUMMARY_PROMPT.replace("{summary}", summary or "/").replace(
+        "{conversation}", format_history(messages)
+    )
     message = [Message(role="user", content=prompt)]
-    completion = config.client.chat.completions.create(
-        model="gpt-4o",
-        messages=message,
-        temperature=0,
-        stream=False,
-        response_format={"type": "json_object"},
+    await admit(config, config.summary_model, message, JSON_COMPLETION_TOKENS, SUMMARY_PRIORITY)
+    with stage("summarize"), reporting_rate_limits(config.admission, config.summary_model):
+        completion = await config.client.chat.completions.create(
+            model=config.summary_model,
+            messages=message,
+            temperature=0,
+            stream=False,
+            response_format={"type": "json_object"},
+        )
+    return json.loads(completion.choices[0].message.content)["summary"]
+
+
+async def update_conversation(
+    conversation: ConversationState, messages: List[Message], answer: str, config: Config
+):
+    """Folds the messages beyond the history token budget into the chat's rolling summary."""
+    store = config.conversation_store
+    history = messages + [Message(role="assistant", content=answer)]
+    n_summarized = summarized_prefix(conversation, history)
+    if n_summarized == 0:
+        # No summary yet, or one of a different history
+        conversation.summary = ""
+    n_split = n_summarized + split_for_summary(
+        history[n_summarized:], get_encoder(config.model), config.history_token_budget
+    )
+    if n_split > n_summarized:
+        try:
+            conversation.summary = await summarize_history(
+                conversation.summary, history[n_summarized:n_split], config
+            )
+        except Exception as e:
+            logger.warning(f"Could not update the summary of chat {conversation.chat_id}: {e}")
+            return
+        conversation.summarized_messages = n_split
+        conversation.summarized_digest = history_digest(history[:n_split])
+        store.summaries += 1
+    store.put(conversation)
+
+
+# Keeps the background updates referenced until they are done
+_conversation_updates = set()
+
+
+def schedule_conversation_update(conversation, messages, answer, config):
+    task = asyncio.create_task(update_conversation(conversation, messages, answer, config))
+    _conversation_updates.add(task)
+    task.add_done_callback(_conversation_updates.discard)
+
+
+async def admit(config: Config, model: str, messages, completion_tokens: int, priority=None):
+    """Waits for the admission of a call to the model, see app.api.admission.
+
+    Its cost is estimated as the tokens of the prompt plus the completion tokens it may use.
+    Raises AdmissionRejected when the model's queue is full.
+    """
+    if config.admission is None:
+        return
+    tokens = count_message_tokens(messages, get_encoder(model)) + completion_tokens
+    await config.admission.acquire(model, tokens, priority)
+
+
+@contextmanager
+def reporting_rate_limits(admission: Optional[AdmissionController], model: str):
+    # An upstream 429 despite the admission control pauses the model's bucket
+    try:
+        yield
+    except RateLimitError as e:
+        if admission is not None:
+            admission.report_rate_limited(model, retry_after_seconds(e))
+        raise
+
+
+def get_retrieval_kwargs(config: Config) -> Dict:
+    # The retrieval settings of the config, as accepted by get_law_context_chunks(_batch)
+    shard_index = getattr(config.db, "shard_index", None)
+    sources = current_sources.get()
+    return dict(
+        retrieve_n=config.retrieve_n,
+        rerank_max_n=config.rerank_max_n,
+        max_context_len=config.max_context_len,
+        embedding_model=config.embedding_model,
+        db=config.db,
+        executor=config.search_executor,
+        embedding_cache=config.embedding_cache,
+        bm25_index=getattr(config.db, "bm25_index", None) if config.hybrid_search else None,
+        rrf_k=config.rrf_k,
+        rerank_pool=config.hybrid_rerank_pool,
+        skip_rerank_agreement=config.hybrid_skip_rerank_agreement,
+        skip_rerank_gap=config.rerank_skip_gap,
+        reranker=config.reranker,
+        rerank_cache=config.rerank_cache,
+        resilience=config.resilience,
+        # Without routing the explicit sources filter still applies, only the queries are not routed
+        shard_index=shard_index if config.shard_routing or sources else None,
+        sources=sources,
+        shard_centroid_margin=config.shard_centroid_margin,
+        max_routed_shards=config.max_routed_shards,
+        pruning=config.pruning,
     )
-    response_json = json.loads(completion.choices[0].message.content)
-    return response_json["reformulated_question"]
 
 
-def process_text_for_sse_format(text: str) -> str:
-    return "\n".join("data: " + line for line in text.split("\n")) + "\n\n"
+def get_embedding_args(config: Config):
+    # The arguments of embed_query after the query
+    return config.db, config.embedding_model, config.embedding_cache, config.resilience
+
+
+def get_coalesce_kwargs(config: Config) -> Dict:
+    return dict(
+        flush_interval=config.sse_flush_interval,
+        flush_bytes=config.sse_flush_bytes,
+        flush_on_newline=config.sse_flush_on_newline,
+    )
+
+
+def is_single_turn(messages: List[Message]) -> bool:
+    # A chat with only one (user) message has no history the question could refer to
+    return len([message for message in messages if message.role != "system"]) == 1
+
+
+async def reformulate_and_retrieve(
+    messages: List[Message], config: Config, conversation: ConversationState = None
+):
+    """Returns the question to answer and, if already available, its retrieved law context.
+
+    In the speculative mode the retrieval for the raw last message runs concurrently with the
+    reformulation. Its result is kept if the reformulated question embeds close enough to the raw
+    one, otherwise the retrieval is repeated for the reformulated question.
+    """
+    if config.pipeline_mode != "speculative":
+        return await reformulate_question(messages, config, conversation), None
+
+    raw_question = messages[-1].content
+    if is_single_turn(messages):
+        logger.info("Single-turn chat, skipping the question reformulation")
+        return raw_question, None
+
+    retrieval_kwargs = get_retrieval_kwargs(config)
+
+    async def speculative_retrieval(raw_embedding_task):
+        raw_embedding = await raw_embedding_task
+        return await get_law_context_chunks(
+            raw_question, query_embedding=raw_embedding, **retrieval_kwargs
+        )
+
+    raw_embedding_task = asyncio.create_task(embed_query(raw_question, *get_embedding_args(config)))
+    speculative_task = asyncio.create_task(speculative_retrieval(raw_embedding_task))
+    try:
+        reformulated_question = await reformulate_question(messages, config, conversation)
+        reformulated_embedding = await embed_query(
+            reformulated_question, *get_embedding_args(config)
+        )
+        similarity = cosine_similarity(await raw_embedding_task, reformulated_embedding)
+        if similarity >= config.speculative_similarity_threshold:
+            logger.info(f"Keeping the speculative retrieval (similarity {similarity:.3f})")
+            return reformulated_question, await speculative_task
+
+        logger.info(f"Discarding the speculative retrieval (similarity {similarity:.3f})")
+        speculative_task.cancel()
+        retrieved = await get_law_context_chunks(
+            reformulated_question, query_embedding=reformulated_embedding, **retrieval_kwargs
+        )
+        return reformulated_question, retrieved
+    finally:
+        pending = [speculative_task, raw_embedding_task]
+        for task in pending:
+            task.cancel()
+        # Waits for the cancellations, so no retrieval keeps running (or logs errors) after this
+        await asyncio.gather(*pending, return_exceptions=True)
 
 
 def prettify_references(references: List[Dict]) -> str:
     if len(references) == 0:
         return ""
 
-    markdown_references = "\n\nUporabljeni viri:\n"
-    counter = 1
+    # One line per source, the first reference of each
+    lines, seen = [], set()
     for ref in references:
-        new_reference_name = ref["details_href_name"]
-        if new_reference_name not in markdown_references:
-            new_reference = (
-                f"* **[[{counter}]]({ref['raw_filepath']})** {ref['details_href_name']}\n"
+        if ref["details_href_name"] not in seen:
+            seen.add(ref["details_href_name"])
+            lines.append(
+                f"* **[[{len(lines) + 1}]]({ref['raw_filepath']})** {ref['details_href_name']}\n"
             )
-            counter += 1
-            markdown_references += new_reference
-    return markdown_references
+    return "\n\nUporabljeni viri:\n" + "".join(lines)
 
 
-def retrieve_context(
+async def retrieve_context(
     messages: List[Message],
     reformulated_query,
     db,
@@ -136,16 +447,27 @@ def retrieve_context(
     rerank_max_n,
     max_context_len,
     embedding_model,
+    executor=None,
+    retrieved=None,
+    embedding_cache=None,
+    query_embedding=None,
+    **retrieval_kwargs,
 ):
-    # 1. Get the RAG context chunks
-    law_context, law_context_references = get_law_context_chunks(
-        reformulated_query,
-        retrieve_n=retrieve_n,
-        rerank_max_n=rerank_max_n,
-        max_context_len=max_context_len,
-        embedding_model=embedding_model,
-        db=db,
-    )
+    # 1. Get the RAG context chunks (unless they were already retrieved speculatively)
+    if retrieved is None:
+        retrieved = await get_law_context_chunks(
+            reformulated_query,
+            retrieve_n=retrieve_n,
+            rerank_max_n=rerank_max_n,
+            max_context_len=max_context_len,
+            embedding_model=embedding_model,
+            db=db,
+            executor=executor,
+            query_embedding=query_embedding,
+            embedding_cache=embedding_cache,
+            **retrieval_kwargs,
+        )
+    law_context, law_context_references = retrieved
 
     # 2. Prepare the context chunk into a text, and references object
     markdown_references = prettify_references(law_context_references)
@@ -171,27 +493,66 @@ def retrieve_context(
     )
 
 
-def stream_response(enriched_messages, model, client):
-
+async def stream_answer_deltas(enriched_messages, model, client, answer_parts=None, admission=None):
+    start = time.perf_counter()
+    with reporting_rate_limits(admission, model):
+        openai_stream = await client.chat.completions.create(
+            model=model, messages=enriched_messages, temperature=0, stream=True
+        )
+    first_token = True
+    record = current_capture.get()
+    try:
+        async for chunk in openai_stream:
+            if first_token:
+                observe("first_token", time.perf_counter() - start)
+                first_token = False
+            content = chunk.choices[0].delta.content or ""
+            if content:
+                STREAMED_TOKENS.inc()
+                if record is not None:
+                    record.add_answer_delta(content)
+            if answer_parts is not None:
+                answer_parts.append(content)
+            yield content
+    finally:
+        # Also when the client disconnected: stop generating (and paying for) the answer
+        await openai_stream.close()
+    observe("stream", time.perf_counter() - start)
+
+
+async def stream_response(
+    enriched_messages, model, client, answer_parts=None, admission=None, **coalesce_kwargs
+):
     logger.info("Getting chatbot reply")
-    openai_stream = client.chat.completions.create(
-        model=model, messages=enriched_messages, temperature=0, stream=True
+    # The deltas are coalesced into fewer, pre-encoded SSE frames (see app.api.sse)
+    frames = coalesce_events(
+        stream_answer_deltas(enriched_messages, model, client, answer_parts, admission),
+        **coalesce_kwargs,
     )
-    for chunk in openai_stream:
-        yield process_chunk(chunk)
+    async with aclosing(frames):
+        async for frame in frames:
+            yield frame
+
+    yield DONE_FRAME  # Properly formatted SSE message for stream end if needed
 
-    yield "data: [DONE]\n\n"  # Properly formatted SSE message for stream end if needed
+
+async def replay_cached_answer(cached_answer: CachedAnswer):
+    # Same frames as a live answer: references, the separator lines, the answer and the end marker
+    if len(cached_answer.references) > 0:
+        yield encode_event(cached_answer.references)
+    yield encode_event("\n\n\n\n")
+    yield encode_event(cached_answer.answer)
+    yield DONE_FRAME
 
 
 # Single API call to reformulate question, get refernces and send them to user, send the message to
 # OpenAI and stream back the response to user
-def process_question_and_stream_response(messages: List[Message], config: Config):
+async def process_question_and_stream_response(
+    messages: List[Message], config: Config, chat_id=None
+):
 
     # Extract the configuration parameters
     client = config.client
-    retrieve_n = config.retrieve_n
-    rerank_max_n = config.rerank_max_n
-    max_context_len = config.max_context_len
     model = config.model
     db = config.db
     embedding_model = config.embedding_model
@@ -199,39 +560,79 @@ def process_question_and_stream_response(messages: List[Message], config: Config
     use_reformulated_question = config.use_reformulated_question
     logger.info("Extracted config properties")
 
+    # Long chats send the rolling summary of the older messages instead of the messages
+    conversation, history = load_conversation(chat_id, messages, config)
+
     # Based on the logged messages, reformulate the latest user question
-    reformulated_question = reformulate_question(messages, config)
+    reformulated_question, retrieved = await reformulate_and_retrieve(history, config, conversation)
     logging.info(f"Reformulated question: {reformulated_question}")
+
+    # Near-duplicate questions are answered from the semantic answer cache, unless the request
+    # restricts the sources
+    answer_cache = (
+        config.answer_cache if use_reformulated_question and current_sources.get() is None else None
+    )
+    question_embedding = None
+    if answer_cache is not None:
+        question_embedding = await embed_query(
+            reformulated_question, db, embedding_model, config.embedding_cache, config.resilience
+        )
+        cached_answer = answer_cache.lookup(question_embedding, config.index_version)
+        if cached_answer is not None:
+            async for chunk in replay_cached_answer(cached_answer):
+                yield chunk
+            if conversation is not None:
+                schedule_conversation_update(conversation, messages, cached_answer.answer, config)
+            logger.info("Finished response from the answer cache")
+            return
     # reformulated_question_into = "Search query:\n\n"
-    # yield process_text_for_sse_format(reformulated_question_into + reformulated_question)
+    # yield encode_event(reformulated_question_into + reformulated_question)
 
     # Retrieve the relevant references for the latest (reformulated) user question
-    msg_hist_with_context, query_with_context, only_references = retrieve_context(
-        messages,
+    msg_hist_with_context, query_with_context, only_references = await retrieve_context(
+        history,
         reformulated_question,
-        db,
-        retrieve_n,
-        rerank_max_n,
-        max_context_len,
-        embedding_model,
+        retrieved=retrieved,
+        query_embedding=question_embedding,
+        **get_retrieval_kwargs(config),
     )
+    # Before the first chunk, so that a rejection can still be answered with a 429
+    answer_messages = query_with_context if use_reformulated_question else msg_hist_with_context
+    await admit(config, model, answer_messages, config.expected_answer_tokens)
+
     if len(only_references) > 0:
         logging.info(f"Only references found: {only_references}")
-        yield process_text_for_sse_format(only_references)
+        yield encode_event(only_references)
 
     # Send the (reformulated) question with the law excerpts to OpenAI and stream the response
     logger.info("Sending question to OpenAI")
     # answer_intro = "\n\n\n\nOdgovor:\n\n\n"
-    # yield process_text_for_sse_format(answer_intro)
+    # yield encode_event(answer_intro)
     empty_lines = "\n\n\n\n"
-    yield process_text_for_sse_format(empty_lines)
-
-    if use_reformulated_question:
-        for chunk in stream_response(query_with_context, model, client):
-            yield chunk
-    else:
-        for chunk in stream_response(msg_hist_with_context, model, client):
+    yield encode_event(empty_lines)
+
+    answer_parts = []
+    answer = stream_response(
+        answer_messages,
+        model,
+        client,
+        answer_parts,
+        admission=config.admission,
+        **get_coalesce_kwargs(config),
+    )
+    async with aclosing(answer):
+        async for chunk in answer:
             yield chunk
+    if answer_cache is not None:
+        answer_cache.store(
+            reformulated_question,
+            question_embedding,
+            only_references,
+            "".join(answer_parts),
+            config.index_version,
+        )
+    if conversation is not None:
+        schedule_conversation_update(conversation, messages, "".join(answer_parts), config)
     logger.info("Finished response")
 
 
@@ -73,3 +73,32 @@ Conversation history: {conversation_history}
 Reformulated question:
 
 """
+
+
+SUMMARY_PROMPT = """
+### ROLE
+You maintain a running summary of a conversation between a user and an AI chatbot that answers
+questions about the Slovenian tax law, so that the older part of the conversation does not have to
+be repeated on every turn.
+
+### GOAL
+You are given the current summary (possibly empty) and the next part of the conversation, in the
+format {role}: {message}. Update the summary so that it also covers the new part.
+
+Keep every fact the user has provided about their situation (status, amounts, dates, type of
+income, ...), the questions they asked and the conclusions and law articles of the answers.
+Leave out greetings, repetitions and the wording of the answers. The summary should be in the
+Slovenian language and as short as possible.
+
+### OUTPUT FORMAT
+Return the result in the following JSON format:
+{
+  "summary": "The updated summary here"
+}
+
+### TASK
+Current summary: {summary}
+Next part of the conversation: {conversation}
+Updated summary:
+
+"""
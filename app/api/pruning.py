@@ -0,0 +1,167 @@
+"""Pruning of the retrieved candidates before the rerank and the packing.
+
+The top hits often repeat themselves: the same chunk in several consolidated versions of a law, or
+consecutive chunks of one article. Before they are reranked and packed, the candidates of a query:
+- lose their duplicates, the same text of the same source or a vector within `dedup_threshold`
+  cosine similarity of a better candidate
+- are reordered by maximal marginal relevance (MMR), trading the similarity to the query for the
+  dissimilarity to the candidates already picked (`mmr_lambda`), keeping the first `mmr_n`
+- have their chunks of the same article at consecutive FAISS positions merged into one candidate,
+  packed as one context block
+
+The vectors are read back from the FAISS index, so pruning costs no embedding call. With an index
+that cannot reconstruct its vectors (IVF without a direct map) only the exact duplicates are
+removed and the chunks grouped.
+"""
+
+import hashlib
+import logging
+from typing import List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from app.api.retrieval import CONTEXT_BLOCK_KEY, CONTEXT_TOKENS_KEY
+
+logger = logging.getLogger(__name__)
+
+
+def source_id(metadata) -> str:
+    return metadata.get("raw_filepath") or metadata.get("details_href_name") or ""
+
+
+def reconstruct(index, positions) -> Optional[np.ndarray]:
+    """The normalized vectors at the positions, None if the index cannot reconstruct them."""
+    try:
+        vectors = index.reconstruct_batch(np.asarray(positions, dtype=np.int64))
+    except RuntimeError:
+        return None
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def maximal_marginal_relevance(query_vector, vectors, n, mmr_lambda):
+    """Indices of the n vectors picked by MMR, in the order they were picked."""
+    relevance = vectors @ query_vector
+    picked = [int(np.argmax(relevance))]
+    max_similarity = vectors @ vectors[picked[0]]
+    while len(picked) < min(n, len(vectors)):
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity
+        scores[picked] = -np.inf
+        best = int(np.argmax(scores))
+        picked.append(best)
+        max_similarity = np.maximum(max_similarity, vectors @ vectors[best])
+    return picked
+
+
+def group_adjacent(hits: List[Tuple[int, Document, float]]):
+    """Merges the chunks of the same source at consecutive positions, in position order.
+
+    The hits are best first, and a group keeps the score of its best ranked chunk, whichever the
+    direction of the index metric.
+    """
+    groups = {}  # first position of the group -> [positions, docs, (best rank, its score)]
+    group_of = {}
+    ranked = sorted(enumerate(hits), key=lambda ranked_hit: ranked_hit[1][0])
+    for rank, (position, doc, score) in ranked:
+        previous = group_of.get(position - 1)
+        source = source_id(doc.metadata)
+        if (
+            previous is not None
+            and source
+            and source_id(groups[previous][1][-1].metadata) == source
+        ):
+            group = groups[previous]
+            group[0].append(position)
+            group[1].append(doc)
+            group[2] = min(group[2], (rank, score))
+            group_of[position] = previous
+        else:
+            groups[position] = [[position], [doc], (rank, score)]
+            group_of[position] = position
+
+    merged = {}
+    for first, (positions, docs, (_, score)) in groups.items():
+        if len(docs) == 1:
+            merged[first] = (docs[0], score)
+            continue
+        metadata = {
+            key: value
+            for key, value in docs[0].metadata.items()
+            if key not in (CONTEXT_BLOCK_KEY, CONTEXT_TOKENS_KEY)
+        }
+        tokens = [doc.metadata.get(CONTEXT_TOKENS_KEY) for doc in docs]
+        if None not in tokens:
+            # An upper bound, the merged block has one header instead of one per chunk
+            metadata[CONTEXT_TOKENS_KEY] = sum(tokens)
+        text = "\n".join(doc.page_content for doc in docs)
+        merged[first] = (Document(page_content=text, metadata=metadata), score)
+    return merged, group_of
+
+
+class CandidatePruning:
+    def __init__(self, dedup_threshold=0.95, mmr_lambda=0.7, mmr_n=None, group=True):
+        self.dedup_threshold = dedup_threshold
+        self.mmr_lambda = mmr_lambda
+        self.mmr_n = mmr_n
+        self.group = group
+        self.candidates_in = 0
+        self.candidates_out = 0
+        self.duplicates = 0
+        self.grouped = 0
+
+    def prune(self, index, query_embedding, hits):
+        """Prunes the (FAISS position, doc, score) hits of one query, best first.
+
+        Returns the (doc, score) candidates, in the MMR order if it applies, else in the hits'
+        order.
+        """
+        self.candidates_in += len(hits)
+        seen, unique = set(), []
+        for hit in hits:
+            position, doc, _ = hit
+            key = (source_id(doc.metadata), hashlib.sha1(doc.page_content.encode()).digest())
+            if key not in seen:
+                seen.add(key)
+                unique.append(hit)
+
+        vectors = reconstruct(index, [position for position, _, _ in unique]) if unique else None
+        if vectors is not None and self.dedup_threshold is not None:
+            kept = []
+            for i in range(len(unique)):
+                if not kept or (vectors[kept] @ vectors[i]).max() < self.dedup_threshold:
+                    kept.append(i)
+            unique, vectors = [unique[i] for i in kept], vectors[kept]
+        self.duplicates += len(hits) - len(unique)
+
+        if vectors is not None and self.mmr_lambda is not None and len(unique) > 1:
+            query_vector = np.asarray(query_embedding, dtype=np.float32)
+            query_vector = query_vector / np.linalg.norm(query_vector)
+            picked = maximal_marginal_relevance(
+                query_vector, vectors, self.mmr_n or len(unique), self.mmr_lambda
+            )
+            unique = [unique[i] for i in picked]
+
+        if not self.group:
+            candidates = [(doc, score) for _, doc, score in unique]
+        else:
+            merged, group_of = group_adjacent(unique)
+            candidates, emitted = [], set()
+            for position, _, _ in unique:
+                # A group takes the rank of its best ranked chunk
+                first = group_of[position]
+                if first not in emitted:
+                    emitted.add(first)
+                    candidates.append(merged[first])
+            self.grouped += len(unique) - len(candidates)
+        self.candidates_out += len(candidates)
+        return candidates
+
+    @property
+    def stats(self):
+        return {
+            "candidates_in": self.candidates_in,
+            "candidates_out": self.candidates_out,
+            "duplicates": self.duplicates,
+            "grouped": self.grouped,
+        }
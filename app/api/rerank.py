@@ -0,0 +1,159 @@
+"""Rerankers of the retrieved law chunks.
+
+The remote Cohere reranker is the default. A local cross-encoder exported to ONNX can be used
+instead (RERANK_BACKEND=cross_encoder), it runs on the CPU and needs `onnxruntime` and `tokenizers`.
+Each reranker counts its calls and the reranks that were skipped, by reason.
+"""
+
+import abc
+import asyncio
+import functools
+import logging
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+import cohere
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+COHERE_RERANK_MODEL = "rerank-multilingual-v3.0"
+
+
+class Reranker(abc.ABC):
+    name = "reranker"
+
+    def __init__(self):
+        self.calls = 0
+        self.skips = Counter()
+
+    async def rerank(self, query: str, documents: List[str], top_n: int) -> List[Tuple[int, float]]:
+        """Returns the (document index, relevance score) of the top_n documents, best first."""
+        self.calls += 1
+        return await self._rerank(query, documents, top_n)
+
+    @abc.abstractmethod
+    async def _rerank(self, query, documents, top_n):
+        """The rerank call of the backend, without the bookkeeping."""
+
+    def record_skip(self, reason: str):
+        self.skips[reason] += 1
+
+    @property
+    def stats(self):
+        return {"calls": self.calls, **{f"skipped_{reason}": n for reason, n in self.skips.items()}}
+
+
+class CohereReranker(Reranker):
+    """Cohere rerank API, through one client (and connection pool) per process."""
+
+    def __init__(self, api_key=None, model=COHERE_RERANK_MODEL, base_url=None):
+        super().__init__()
+        self.name = f"cohere/{model}"
+        self.api_key = api_key
+        self.model = model
+        self.base_url = base_url
+        self._client = None
+
+    @property
+    def client(self):
+        # Created on first use, inside the event loop that serves the requests
+        if self._client is None:
+            self._client = cohere.AsyncClient(
+                self.api_key or os.getenv("COHERE_API_KEY"), base_url=self.base_url
+            )
+        return self._client
+
+    async def _rerank(self, query, documents, top_n):
+        reranked_results = await self.client.rerank(
+            query=query,
+            documents=documents,
+            model=self.model,
+            top_n=top_n,
+            return_documents=False,
+        )
+        return [(item.index, float(item.relevance_score)) for item in reranked_results.results]
+
+
+class CrossEncoderReranker(Reranker):
+    """Local cross-encoder, an ONNX export with its `tokenizer.json` in `model_path`.
+
+    Scores are the sigmoid of the logits, so the same minimum relevance score applies as with
+    Cohere. Inference runs on a dedicated thread, so it neither blocks the event loop nor the FAISS
+    searches.
+    """
+
+    def __init__(self, model_path, max_length=512, batch_size=16, threads=None):
+        super().__init__()
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self.name = f"cross_encoder/{os.path.basename(os.path.normpath(model_path))}"
+        self.batch_size = batch_size
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_path, "model.onnx"), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_path, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length)
+        self.tokenizer.enable_padding()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cross-encoder")
+
+    def score(self, query, documents):
+        logits = []
+        for start in range(0, len(documents), self.batch_size):
+            batch = documents[start : start + self.batch_size]
+            encodings = self.tokenizer.encode_batch([(query, document) for document in batch])
+            inputs = {
+                "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+                "attention_mask": np.array(
+                    [encoding.attention_mask for encoding in encodings], dtype=np.int64
+                ),
+                "token_type_ids": np.array(
+                    [encoding.type_ids for encoding in encodings], dtype=np.int64
+                ),
+            }
+            inputs = {name: value for name, value in inputs.items() if name in self.input_names}
+            outputs = self.session.run(None, inputs)[0]
+            logits.extend(outputs.reshape(len(batch), -1)[:, -1])
+        return 1 / (1 + np.exp(-np.array(logits, dtype=np.float32)))
+
+    async def _rerank(self, query, documents, top_n):
+        loop = asyncio.get_running_loop()
+        scores = await loop.run_in_executor(self.executor, self.score, query, documents)
+        order = np.argsort(-scores, kind="stable")[:top_n]
+        return [(int(i), float(scores[i])) for i in order]
+
+
+def create_reranker(backend="cohere", model=None, model_path=None):
+    if backend == "cohere":
+        return CohereReranker(model=model or COHERE_RERANK_MODEL)
+    if backend == "cross_encoder":
+        if model_path is None:
+            raise ValueError("The cross_encoder rerank backend needs the path of the ONNX model")
+        return CrossEncoderReranker(model_path)
+    raise ValueError(f"Unknown rerank backend {backend}")
+
+
+@functools.lru_cache(maxsize=None)
+def get_default_reranker():
+    # Shared by all the callers that do not pass their own reranker
+    return CohereReranker()
+
+
+def should_skip_rerank(scores, rerank_max_n, min_gap, larger_is_better=True):
+    """Whether the embedding scores (best first) already separate the top rerank_max_n chunks.
+
+    True when the last chunk that makes the cut is better than the next one by `min_gap`: in
+    similarity for an inner product index (larger is better), in squared L2 distance for an L2
+    index (smaller is better).
+    """
+    if min_gap is None or len(scores) <= rerank_max_n:
+        return False
+    gap = scores[rerank_max_n - 1] - scores[rerank_max_n]
+    return (gap if larger_is_better else -gap) >= min_gap
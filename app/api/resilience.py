@@ -0,0 +1,192 @@
+"""Deadlines, hedging and retries of the upstream calls before the answer starts.
+
+The embedding, rerank and reformulation calls go through the CallPolicy of their stage:
+- the call (with its retries) must finish within the stage's deadline, else DeadlineExceeded
+- when it is slower than the stage's recent p95 latency, a duplicate (hedged) call is fired and
+  whichever returns first is kept, the other one is cancelled
+- failed calls are retried with a jittered exponential backoff, only while the deadline allows it;
+  rate limited calls (429, or rejected by the admission control) are not, they would only add to
+  the load the upstream is already refusing
+
+Callers degrade instead of failing where they can (see `record_fallback`): the rerank keeps the
+embedding ranking, the reformulation uses the raw question. The embedding has no fallback.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Dict, Optional
+
+import numpy as np
+
+from app.api.admission import AdmissionRejected
+from app.api.metrics import FALLBACKS, HEDGED_CALLS
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage: str, deadline: float):
+        super().__init__(f"The {stage} call did not finish within its {deadline}s deadline")
+        self.stage = stage
+        self.deadline = deadline
+
+
+def is_retryable(error: Exception) -> bool:
+    # Client errors (4xx) fail the same way when retried, and a rate limit is waited out by the
+    # admission control's pause of the model, not by retrying right away
+    if isinstance(error, AdmissionRejected):
+        return False
+    status_code = getattr(error, "status_code", None)
+    return status_code is None or status_code >= 500
+
+
+def record_fallback(stage: str, fallback: str, error: Exception):
+    logger.warning(f"Falling back to {fallback} after the {stage} call failed: {error}")
+    FALLBACKS.labels(stage, fallback).inc()
+
+
+class CallPolicy:
+    """Deadline, hedging and retries of the calls of one stage.
+
+    The hedge delay is the `hedge_quantile` of the last `window` call latencies, and at least
+    `min_hedge_delay`. Until there are `min_samples` latencies it is `initial_hedge_delay`, by
+    default a third of the deadline. A hedge_quantile of None disables hedging.
+    """
+
+    def __init__(
+        self,
+        stage: str,
+        deadline: Optional[float] = None,
+        hedge_quantile: Optional[float] = 0.95,
+        min_hedge_delay=0.05,
+        initial_hedge_delay=None,
+        retries=2,
+        backoff=0.1,
+        max_backoff=1.0,
+        window=200,
+        min_samples=20,
+    ):
+        self.stage = stage
+        self.deadline = deadline
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_delay = min_hedge_delay
+        if initial_hedge_delay is None and deadline is not None:
+            initial_hedge_delay = deadline / 3
+        self.initial_hedge_delay = initial_hedge_delay
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.calls = 0
+        self.retried = 0
+        self.timeouts = 0
+
+    def hedge_delay(self) -> Optional[float]:
+        if self.hedge_quantile is None:
+            return None
+        if len(self.latencies) < self.min_samples:
+            return self.initial_hedge_delay
+        return max(float(np.quantile(self.latencies, self.hedge_quantile)), self.min_hedge_delay)
+
+    async def call(self, make_call):
+        """Awaits make_call() under the policy, make_call creates a new coroutine per attempt."""
+        self.calls += 1
+        loop = asyncio.get_running_loop()
+        deadline = None if self.deadline is None else loop.time() + self.deadline
+        for attempt in range(self.retries + 1):
+            remaining = None if deadline is None else deadline - loop.time()
+            start = time.perf_counter()
+            try:
+                result = await asyncio.wait_for(self._hedged(make_call), remaining)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise DeadlineExceeded(self.stage, self.deadline)
+            except Exception as e:
+                sleep = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+                out_of_time = deadline is not None and loop.time() + sleep >= deadline
+                if attempt == self.retries or not is_retryable(e) or out_of_time:
+                    raise
+                logger.info(f"Retrying the {self.stage} call in {sleep:.2f}s after: {e}")
+                self.retried += 1
+                await asyncio.sleep(sleep)
+                continue
+            self.latencies.append(time.perf_counter() - start)
+            return result
+
+    async def _hedged(self, make_call):
+        delay = self.hedge_delay()
+        if delay is None:
+            return await make_call()
+        first = asyncio.ensure_future(make_call())
+        hedge = None
+        pending = {first}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                hedge = asyncio.ensure_future(make_call())
+                pending.add(hedge)
+            error = None
+            while True:
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if hedge is not None:
+                        winner = "hedge" if task is hedge else "first"
+                        HEDGED_CALLS.labels(self.stage, winner).inc()
+                    return task.result()
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @property
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "retried": self.retried,
+            "timeouts": self.timeouts,
+            "hedge_delay": self.hedge_delay() or 0.0,
+        }
+
+
+class Resilience:
+    """The call policies of the stages, stages without one are called as they are."""
+
+    def __init__(self, policies: Dict[str, CallPolicy]):
+        self.policies = policies
+
+    async def call(self, stage: str, make_call):
+        policy = self.policies.get(stage)
+        if policy is None:
+            return await make_call()
+        return await policy.call(make_call)
+
+    @property
+    def stats(self):
+        return {
+            f"{stage}_{name}": value
+            for stage, policy in self.policies.items()
+            for name, value in policy.stats.items()
+        }
+
+
+async def call_upstream(resilience: Optional[Resilience], stage: str, make_call):
+    if resilience is None:
+        return await make_call()
+    return await resilience.call(stage, make_call)
+
+
+def create_resilience(deadlines: Dict[str, float], hedge_quantile=0.95, retries=2) -> Resilience:
+    return Resilience(
+        {
+            stage: CallPolicy(stage, deadline, hedge_quantile=hedge_quantile, retries=retries)
+            for stage, deadline in deadlines.items()
+        }
+    )
@@ -1,7 +1,18 @@
+import asyncio
+import contextvars
+import functools
+import hashlib
 import tiktoken
 import logging
-import cohere
+import faiss
+import numpy as np
 import os
+from typing import List, Optional
+
+from app.api.capture import current_capture
+from app.api.metrics import stage
+from app.api.rerank import get_default_reranker, should_skip_rerank
+from app.api.resilience import call_upstream, record_fallback
 
 logger = logging.getLogger(__name__)
 
@@ -10,42 +21,320 @@ logger = logging.getLogger(__name__)
 MIN_EMBEDDING_SIMILARITY_SCORE = 0.5
 MIN_RERANKING_SIMILARITY_SCORE = 0.25
 
+CONTEXT_HEADER = "Retrieved relevant context from the law: \n\n"
+# Metadata written by the index upgrade step (app.index.upgrade), not part of the references
+CONTEXT_BLOCK_KEY = "context_block"
+CONTEXT_TOKENS_KEY = "context_tokens"
 
-def get_law_context_chunks(
-    query,
-    retrieve_n=25,
+# The sources (law abbreviations) the current request restricts the retrieval to, if any
+current_sources: contextvars.ContextVar[Optional[List[str]]] = contextvars.ContextVar(
+    "current_sources", default=None
+)
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoder(model):
+    return tiktoken.encoding_for_model(model)
+
+
+@functools.lru_cache(maxsize=None)
+def count_header_tokens(model):
+    return len(get_encoder(model).encode(CONTEXT_HEADER))
+
+
+def render_context_block(article, source):
+    return f"""
+        Source: {source["details_href_name"]}\n
+        Link: {source["raw_filepath"]}\n
+        Text: {article} \n
+        """  # noqa: E501
+
+
+def pack_context(law_articles_text, law_articles_sources, max_context_len, embedding_model):
+    """Greedily packs the context blocks, in ranking order, into the token budget.
+
+    Uses the block and token count precomputed at index build time when the metadata has them,
+    and only tokenizes the blocks of older indexes.
+    """
+    references = []
+    context_blocks = [CONTEXT_HEADER]
+    used_tokens = count_header_tokens(embedding_model)
+    for article, source in zip(law_articles_text, law_articles_sources):
+        article_context = source.get(CONTEXT_BLOCK_KEY) or render_context_block(article, source)
+        n_tokens = source.get(CONTEXT_TOKENS_KEY)
+        if n_tokens is None:
+            n_tokens = len(get_encoder(embedding_model).encode(article_context))
+        if used_tokens + n_tokens < max_context_len:
+            used_tokens += n_tokens
+            context_blocks.append(article_context)
+            references.append(
+                {
+                    key: value
+                    for key, value in source.items()
+                    if key not in (CONTEXT_BLOCK_KEY, CONTEXT_TOKENS_KEY)
+                }
+            )
+    return "".join(context_blocks), references
+
+
+def get_index_version(vector_db_path):
+    # Fingerprint of the index files on disk, used to invalidate caches built on an older index
+    fingerprint = hashlib.sha256()
+    for name in ("index.faiss", "index.pkl", "docstore.sqlite"):
+        path = os.path.join(vector_db_path, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            fingerprint.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return fingerprint.hexdigest()[:12]
+
+
+def cache_model(db, embedding_model):
+    # Local embeddings (app.api.embeddings) are cached under their own name, so that a persistent
+    # cache never mixes the vectors of two backends
+    return getattr(db.embeddings, "name", None) or embedding_model
+
+
+async def embed_queries(queries, db, embedding_model=None, cache=None, resilience=None):
+    # Only the queries missing from the cache are embedded, in a single batched request
+    embedding_model = cache_model(db, embedding_model)
+    embeddings = [
+        cache.get(embedding_model, query) if cache is not None else None for query in queries
+    ]
+    missing = [position for position, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        with stage("embed"):
+            new_embeddings = await call_upstream(
+                resilience,
+                "embed",
+                lambda: db.embeddings.aembed_documents([queries[i] for i in missing]),
+            )
+        for position, embedding in zip(missing, new_embeddings):
+            embeddings[position] = embedding
+            if cache is not None:
+                cache.put(embedding_model, queries[position], embedding)
+    record = current_capture.get()
+    if record is not None:
+        for query, embedding in zip(queries, embeddings):
+            record.add_embedding(query, embedding)
+    return embeddings
+
+
+async def embed_query(query, db, embedding_model=None, cache=None, resilience=None):
+    embedding_model = cache_model(db, embedding_model)
+    embedding = cache.get(embedding_model, query) if cache is not None else None
+    if embedding is None:
+        with stage("embed"):
+            embedding = await call_upstream(
+                resilience, "embed", lambda: db.embeddings.aembed_query(query)
+            )
+        if cache is not None:
+            cache.put(embedding_model, query, embedding)
+    record = current_capture.get()
+    if record is not None:
+        record.add_embedding(query, embedding)
+    return embedding
+
+
+def cosine_similarity(a, b):
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+def dense_search(db, query_embeddings, k, shard_index=None, routes=None):
+    """FAISS search of the queries, in their routed shards (see app.index.shards) if any."""
+    vectors = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+    if db._normalize_L2:
+        vectors = vectors.copy()
+        faiss.normalize_L2(vectors)
+    if shard_index is None or routes is None or all(route is None for route in routes):
+        return db.index.search(vectors, k)
+    scores, indices = shard_index.search(vectors, k, routes)
+    unrouted = [query for query, route in enumerate(routes) if route is None]
+    if unrouted:
+        scores[unrouted], indices[unrouted] = db.index.search(vectors[unrouted], k)
+    return scores, indices
+
+
+def lookup_docs(db, positions):
+    """Returns the documents at the given FAISS positions, keyed by position."""
+    positions = list(dict.fromkeys(positions))
+    doc_ids = [db.index_to_docstore_id[position] for position in positions]
+    if hasattr(db.docstore, "search_many"):
+        docs = db.docstore.search_many(doc_ids)
+    else:
+        docs = [db.docstore.search(doc_id) for doc_id in doc_ids]
+    return dict(zip(positions, docs))
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    scores = {}
+    for ranking in rankings:
+        for rank, position in enumerate(ranking):
+            scores[position] = scores.get(position, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def find_candidates(
+    db,
+    queries,
+    query_embeddings,
+    k,
+    bm25_index=None,
+    rrf_k=60,
     rerank_max_n=5,
-    max_context_len=4096,
-    embedding_model="text-embedding-3-small",
-    db=None,
+    rerank_pool=None,
+    skip_rerank_agreement=None,
+    skip_rerank_gap=None,
+    shard_index=None,
+    sources=None,
+    shard_centroid_margin=None,
+    max_routed_shards=3,
+    pruning=None,
 ):
-    # First stage semantic retrieval
-    enc = tiktoken.encoding_for_model(embedding_model)
-    docs = db.similarity_search_with_score(query, k=retrieve_n)
-    docs = [doc for doc, score in docs if float(score) > MIN_EMBEDDING_SIMILARITY_SCORE]
-    law_articles_text = [doc.page_content for doc in docs]
-    law_articles_sources = [doc.metadata for doc in docs]
+    """First stage retrieval for all the queries at once, CPU bound.
+
+    Runs one matrix FAISS search and, if a BM25 index is given, fuses each query's dense hits with
+    its BM25 hits by reciprocal rank fusion. The fused ranking is trusted without reranking when the
+    top `rerank_max_n` dense and BM25 hits overlap by at least `skip_rerank_agreement`, and the
+    dense ranking when its scores show a gap of `skip_rerank_gap` after the top `rerank_max_n`.
+    With a shard index, each query only searches the shards it is routed to (both the dense and the
+    BM25 hits), `sources` restricting all of them to the shards of those laws. The candidates are
+    then deduplicated, diversified and grouped by `pruning` (see app.api.pruning), if given.
+    Returns per query the candidate (doc, score) list and the keyword arguments for rerank_and_pack.
+    """
+    routes = [None] * len(queries)
+    if shard_index is not None:
+        routes = [
+            shard_index.route(query, embedding, sources, shard_centroid_margin, max_routed_shards)
+            for query, embedding in zip(queries, query_embeddings)
+        ]
+    scores, indices = dense_search(db, query_embeddings, k, shard_index, routes)
+    dense_hits = [
+        [
+            (int(position), float(score))
+            for position, score in zip(row, row_scores)
+            if position != -1 and float(score) > MIN_EMBEDDING_SIMILARITY_SCORE
+        ]
+        for row, row_scores in zip(indices, scores)
+    ]
+
+    if bm25_index is None:
+        hits = dense_hits
+        larger_is_better = db.index.metric_type == faiss.METRIC_INNER_PRODUCT
+        rerank_kwargs = [
+            (
+                {"skip_rerank": "gap"}
+                if should_skip_rerank(
+                    [s for _, s in query_hits], rerank_max_n, skip_rerank_gap, larger_is_better
+                )
+                else {}
+            )
+            for query_hits in dense_hits
+        ]
+    else:
+        hits, rerank_kwargs = [], []
+        for query, query_dense_hits, route in zip(queries, dense_hits, routes):
+            dense_ranking = [position for position, _ in query_dense_hits]
+            mask = None if route is None else shard_index.mask(route)
+            lexical_ranking = bm25_index.search(query, k, mask)
+            hits.append(reciprocal_rank_fusion([dense_ranking, lexical_ranking], rrf_k)[:k])
+            agreement = len(
+                set(dense_ranking[:rerank_max_n]) & set(lexical_ranking[:rerank_max_n])
+            ) / max(rerank_max_n, 1)
+            rerank_kwargs.append({"rerank_pool": rerank_pool})
+            if skip_rerank_agreement is not None and agreement >= skip_rerank_agreement:
+                rerank_kwargs[-1]["skip_rerank"] = "agreement"
+
+    docs = lookup_docs(db, [position for query_hits in hits for position, _ in query_hits])
+    if pruning is not None:
+        return [
+            (
+                pruning.prune(
+                    db.index,
+                    query_embedding,
+                    [(position, docs[position], score) for position, score in query_hits],
+                ),
+                query_rerank_kwargs,
+            )
+            for query_hits, query_rerank_kwargs, query_embedding in zip(
+                hits, rerank_kwargs, query_embeddings
+            )
+        ]
+    return [
+        ([(docs[position], score) for position, score in query_hits], query_rerank_kwargs)
+        for query_hits, query_rerank_kwargs in zip(hits, rerank_kwargs)
+    ]
+
+
+async def rerank_and_pack(
+    query,
+    docs,
+    rerank_max_n,
+    max_context_len,
+    embedding_model,
+    rerank_pool=None,
+    skip_rerank=None,
+    reranker=None,
+    rerank_cache=None,
+    resilience=None,
+):
+    """Reranks the candidates down to rerank_max_n and packs them into the context.
+
+    `skip_rerank` is the reason the candidates' own ranking is kept, if any. With a resilience
+    policy, a rerank call that misses its deadline or fails also keeps it.
+    """
+    if rerank_pool is not None:
+        docs = docs[:rerank_pool]
+    law_articles_text = [doc.page_content for doc, _ in docs]
+    law_articles_sources = [doc.metadata for doc, _ in docs]
     logging.info(f"Retrieved {len(law_articles_text)} law articles")
 
     # Reranking of the results and further filtering docs to less
-    if len(law_articles_text) > rerank_max_n:
-        co = cohere.Client(os.getenv("COHERE_API_KEY"))
-        reranked_results = co.rerank(
-            query=query,
-            documents=law_articles_text,
-            model="rerank-multilingual-v3.0",
-            top_n=rerank_max_n,
-            return_documents=False,
-        )
-        logging.info(
-            f"Similarity scores of reranking: "
-            f"{[item.relevance_score for item in reranked_results.results]}"
-        )
+    reranker = reranker or get_default_reranker()
+    if len(law_articles_text) <= rerank_max_n:
+        reranker.record_skip("few_candidates")
+    elif skip_rerank is not None:
+        logging.info(f"Skipping the reranking ({skip_rerank})")
+        reranker.record_skip(skip_rerank)
+        law_articles_text = law_articles_text[:rerank_max_n]
+        law_articles_sources = law_articles_sources[:rerank_max_n]
+    else:
+        reranked_results = None
+        if rerank_cache is not None:
+            reranked_results = rerank_cache.get(
+                reranker.name, query, law_articles_text, rerank_max_n
+            )
+        if reranked_results is None:
+            try:
+                with stage("rerank"):
+                    reranked_results = await call_upstream(
+                        resilience,
+                        "rerank",
+                        lambda: reranker.rerank(query, law_articles_text, rerank_max_n),
+                    )
+            except Exception as e:
+                if resilience is None:
+                    raise
+                record_fallback("rerank", "embedding_ranking", e)
+                reranker.record_skip("fallback")
+                # The top rerank_max_n candidates in their own order, as with a skipped rerank
+                reranked_results = [(i, 1.0) for i in range(rerank_max_n)]
+            else:
+                if rerank_cache is not None:
+                    rerank_cache.put(
+                        reranker.name, query, law_articles_text, rerank_max_n, reranked_results
+                    )
+        else:
+            reranker.record_skip("cached")
+        record = current_capture.get()
+        if record is not None:
+            record.add_rerank(query, reranked_results)
+        logging.info(f"Similarity scores of reranking: {[score for _, score in reranked_results]}")
         relevant_indeces = []
-        for item in reranked_results.results:
-            print(item)
-            if float(item.relevance_score) > MIN_RERANKING_SIMILARITY_SCORE:
-                relevant_indeces.append(item.index)
+        for index, relevance_score in reranked_results:
+            if relevance_score > MIN_RERANKING_SIMILARITY_SCORE:
+                relevant_indeces.append(index)
         law_articles_text = [law_articles_text[i] for i in relevant_indeces]
         law_articles_sources = [law_articles_sources[i] for i in relevant_indeces]
 
@@ -56,16 +345,167 @@ def get_law_context_chunks(
         references = []
         return context, references
 
-    references = []
-    context = "Retrieved relevant context from the law: \n\n"
-    for article, source in zip(law_articles_text, law_articles_sources):
-        article_context = f"""
-        Source: {source["details_href_name"]}\n
-        Link: {source["raw_filepath"]}\n
-        Text: {article} \n
-        """  # noqa: E501
-        tokens = enc.encode(context + article_context)
-        if len(tokens) < max_context_len:
-            context += article_context
-            references.append(source)
-    return context, references
+    with stage("pack"):
+        return pack_context(
+            law_articles_text, law_articles_sources, max_context_len, embedding_model
+        )
+
+
+async def get_law_context_chunks(
+    query,
+    retrieve_n=25,
+    rerank_max_n=5,
+    max_context_len=4096,
+    embedding_model="text-embedding-3-small",
+    db=None,
+    executor=None,
+    query_embedding=None,
+    embedding_cache=None,
+    bm25_index=None,
+    rrf_k=60,
+    rerank_pool=None,
+    skip_rerank_agreement=None,
+    skip_rerank_gap=None,
+    reranker=None,
+    rerank_cache=None,
+    resilience=None,
+    shard_index=None,
+    sources=None,
+    shard_centroid_margin=None,
+    max_routed_shards=3,
+    pruning=None,
+):
+    # First stage semantic retrieval. The query is embedded with the async client, and the FAISS
+    # search itself (CPU bound) runs on the bounded search executor so it never blocks the loop.
+    if query_embedding is None:
+        query_embedding = await embed_query(query, db, embedding_model, embedding_cache, resilience)
+    loop = asyncio.get_running_loop()
+    with stage("search"):
+        candidates = await loop.run_in_executor(
+            executor,
+            functools.partial(
+                find_candidates,
+                db,
+                [query],
+                [query_embedding],
+                retrieve_n,
+                bm25_index=bm25_index,
+                rrf_k=rrf_k,
+                rerank_max_n=rerank_max_n,
+                rerank_pool=rerank_pool,
+                skip_rerank_agreement=skip_rerank_agreement,
+                skip_rerank_gap=skip_rerank_gap,
+                shard_index=shard_index,
+                sources=sources,
+                shard_centroid_margin=shard_centroid_margin,
+                max_routed_shards=max_routed_shards,
+                pruning=pruning,
+            ),
+        )
+    docs, rerank_kwargs = candidates[0]
+    return await rerank_and_pack(
+        query,
+        docs,
+        rerank_max_n,
+        max_context_len,
+        embedding_model,
+        reranker=reranker,
+        rerank_cache=rerank_cache,
+        resilience=resilience,
+        **rerank_kwargs,
+    )
+
+
+async def iter_law_context_chunks_batch(
+    queries,
+    retrieve_n=25,
+    rerank_max_n=5,
+    max_context_len=4096,
+    embedding_model="text-embedding-3-small",
+    db=None,
+    executor=None,
+    embedding_cache=None,
+    bm25_index=None,
+    rrf_k=60,
+    rerank_pool=None,
+    skip_rerank_agreement=None,
+    skip_rerank_gap=None,
+    reranker=None,
+    rerank_cache=None,
+    resilience=None,
+    shard_index=None,
+    sources=None,
+    shard_centroid_margin=None,
+    max_routed_shards=3,
+    pruning=None,
+    max_concurrency=8,
+):
+    """Retrieves the context of many queries, yielding (query position, result) as they finish.
+
+    All queries are embedded in one batched embeddings request and searched with one matrix FAISS
+    search. Only the rerank calls run per query, at most `max_concurrency` at a time.
+    """
+    if not queries:
+        return
+    query_embeddings = await embed_queries(
+        queries, db, embedding_model, embedding_cache, resilience
+    )
+    loop = asyncio.get_running_loop()
+    with stage("search"):
+        candidates = await loop.run_in_executor(
+            executor,
+            functools.partial(
+                find_candidates,
+                db,
+                queries,
+                query_embeddings,
+                retrieve_n,
+                bm25_index=bm25_index,
+                rrf_k=rrf_k,
+                rerank_max_n=rerank_max_n,
+                rerank_pool=rerank_pool,
+                skip_rerank_agreement=skip_rerank_agreement,
+                skip_rerank_gap=skip_rerank_gap,
+                shard_index=shard_index,
+                sources=sources,
+                shard_centroid_margin=shard_centroid_margin,
+                max_routed_shards=max_routed_shards,
+                pruning=pruning,
+            ),
+        )
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def finish(position, query, docs, rerank_kwargs):
+        async with semaphore:
+            result = await rerank_and_pack(
+                query,
+                docs,
+                rerank_max_n,
+                max_context_len,
+                embedding_model,
+                reranker=reranker,
+                rerank_cache=rerank_cache,
+                resilience=resilience,
+                **rerank_kwargs,
+            )
+        return position, result
+
+    tasks = [
+        asyncio.create_task(finish(position, query, docs, rerank_kwargs))
+        for position, (query, (docs, rerank_kwargs)) in enumerate(zip(queries, candidates))
+    ]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def get_law_context_chunks_batch(queries, **kwargs):
+    """Batched version of get_law_context_chunks, returns the (context, references) per query."""
+    results = [None] * len(queries)
+    async for position, result in iter_law_context_chunks_batch(queries, **kwargs):
+        results[position] = result
+    return results
@@ -0,0 +1,94 @@
+"""Server-sent events encoding of the streamed answers.
+
+OpenAI streams the answer in deltas of a few characters. Instead of one `data:` frame per delta,
+`coalesce_events` buffers the deltas and writes them as one frame once the oldest buffered delta is
+`flush_interval` seconds old, the buffer reaches `flush_bytes`, or a delta contains a newline. The
+frames are encoded to bytes once. A client joining the data of the events sees the same text.
+"""
+
+import asyncio
+import contextlib
+from contextlib import aclosing
+from typing import AsyncIterator
+
+DONE_FRAME = b"data: [DONE]\n\n"
+
+
+def encode_event(text: str) -> bytes:
+    # Every line of the text is its own data line, the client joins them back with newlines
+    return ("data: " + text.replace("\n", "\ndata: ") + "\n\n").encode()
+
+
+async def coalesce_events(
+    texts: AsyncIterator[str], flush_interval=0.03, flush_bytes=1024, flush_on_newline=True
+) -> AsyncIterator[bytes]:
+    """Encodes the text deltas into SSE frames, several deltas per frame.
+
+    The first delta is sent right away, so that coalescing does not delay the first token. With a
+    flush_interval of 0 every delta is sent as its own frame, as soon as it arrives.
+    """
+    if not flush_interval:
+        async with aclosing(texts):
+            async for text in texts:
+                yield encode_event(text)
+        return
+
+    # A task reads the deltas into the buffer and wakes the sender up when a frame is due. It costs
+    # one future and one timer per frame, instead of a timed wait per delta.
+    loop = asyncio.get_running_loop()
+    buffer = []
+    buffered_bytes = 0
+    wakeup = loop.create_future()
+    timer = None
+    done = False
+    error = None
+
+    def wake():
+        if not wakeup.done():
+            wakeup.set_result(None)
+
+    async def read_texts():
+        nonlocal buffered_bytes, timer, done, error
+        first = True
+        try:
+            async for text in texts:
+                if not text:
+                    continue
+                buffer.append(text)
+                buffered_bytes += len(text.encode())
+                if first or buffered_bytes >= flush_bytes or (flush_on_newline and "\n" in text):
+                    first = False
+                    wake()
+                elif timer is None:
+                    timer = loop.call_later(flush_interval, wake)
+        except Exception as e:
+            error = e
+        finally:
+            done = True
+            wake()
+
+    reader = loop.create_task(read_texts())
+    try:
+        while True:
+            await wakeup
+            wakeup = loop.create_future()
+            if timer is not None:
+                timer.cancel()
+                timer = None
+            if buffer:
+                frame = encode_event("".join(buffer))
+                buffer.clear()
+                buffered_bytes = 0
+                yield frame
+            if done and not buffer:
+                break
+        if error is not None:
+            raise error
+    finally:
+        if timer is not None:
+            timer.cancel()
+        # Closing the deltas too when the consumer stops early, e.g. on a client disconnect
+        reader.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await reader
+        await texts.aclose()
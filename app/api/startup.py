@@ -0,0 +1,204 @@
+"""Startup instrumentation: how long the imports and resources took, and when the server is ready.
+
+The process-wide `startup` tracker records the heavy imports (`timed_import`: the packages of
+HEAVY_IMPORTS, imported first by app.app, and the ones imported on first use), the loading of each
+resource (`loading`), and the background warm-up that runs once the server accepts connections
+(`warm_up`: the tokenizers, a search touching the index, the upstream clients). The server is ready
+when every expected resource is loaded, or degraded, see the /ready endpoint.
+
+This module imports no heavy package itself, so that their import times can be recorded.
+"""
+
+import argparse
+import asyncio
+import importlib
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Imported one by one by app.app before anything else, for the per package import times
+HEAVY_IMPORTS = (
+    "numpy",
+    "faiss",
+    "tiktoken",
+    "openai",
+    "cohere",
+    "langchain_community.vectorstores.faiss",
+    "fastapi",
+    "uvicorn",
+)
+WARM_UP_RESOURCES = ("encoders", "index_pages", "clients")
+# Only a head start for the first requests, which load them anyway: reported degraded instead of
+# keeping the server from being ready when they still fail after the retries
+OPTIONAL_WARM_UP_RESOURCES = ("index_pages", "clients")
+
+
+def process_start_time() -> float:
+    """Wall clock time the process started, from /proc, or now where it is not available."""
+    try:
+        with open("/proc/self/stat") as f:
+            # The fields after the command name (which may contain spaces), starttime is the 22nd
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+class StartupTracker:
+    def __init__(self):
+        self.started_at = process_start_time()
+        self.imports = {}  # module -> seconds
+        self.resources = {}  # name -> {"status": ..., "seconds": ...}
+        self.milestones = {}  # name -> seconds since the process started
+        self.ready_at = None
+
+    def mark(self, milestone: str):
+        self.milestones[milestone] = round(time.time() - self.started_at, 3)
+
+    def timed_import(self, module_name: str):
+        """Imports the module, recording how long it took if it was not imported yet."""
+        if module_name in sys.modules:
+            return sys.modules[module_name]
+        start = time.perf_counter()
+        module = importlib.import_module(module_name)
+        self.imports[module_name] = round(time.perf_counter() - start, 3)
+        return module
+
+    def expect(self, *names: str):
+        for name in names:
+            self.resources.setdefault(name, {"status": "pending", "seconds": None})
+
+    @contextmanager
+    def loading(self, name: str):
+        self.resources[name] = {"status": "loading", "seconds": None}
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.resources[name] = {
+                "status": "failed",
+                "seconds": round(time.perf_counter() - start, 3),
+            }
+            raise
+        self.resources[name] = {"status": "ready", "seconds": round(time.perf_counter() - start, 3)}
+        self._check_ready()
+
+    def degrade(self, name: str, error: Exception):
+        """Gives up on loading the resource, the server is ready without it."""
+        self.resources[name] = {**self.resources.get(name, {}), "status": "degraded"}
+        self.resources[name]["error"] = str(error)
+        self._check_ready()
+
+    def _check_ready(self):
+        if self.ready_at is None and self.ready:
+            self.ready_at = time.time()
+            self.mark("ready")
+            logger.info(f"Ready {self.ready_at - self.started_at:.2f}s after the process started")
+
+    @property
+    def ready(self) -> bool:
+        return bool(self.resources) and all(
+            resource["status"] in ("ready", "degraded") for resource in self.resources.values()
+        )
+
+    def report(self):
+        return {
+            "ready": self.ready,
+            "time_to_ready_s": (
+                round(self.ready_at - self.started_at, 3) if self.ready_at is not None else None
+            ),
+            "uptime_s": round(time.time() - self.started_at, 3),
+            "milestones": self.milestones,
+            "imports": self.imports,
+            "resources": self.resources,
+            "pid": os.getpid(),
+        }
+
+
+startup = StartupTracker()
+
+
+def touch_index(db):
+    # One search pages in the index structures (and the memory-mapped vectors it scans), and one
+    # lookup opens the docstore connection of this process
+    import numpy as np
+
+    vector = np.zeros((1, db.index.d), dtype=np.float32)
+    _, positions = db.index.search(vector, 1)
+    if positions[0][0] >= 0:
+        db.docstore.search(db.index_to_docstore_id[int(positions[0][0])])
+
+
+async def warm_up(config, retries=3, backoff=1.0, max_backoff=30.0):
+    """Loads what the first request would otherwise load, before the server reports ready.
+
+    A failed step is retried with an exponential backoff: the encoders until they load, as every
+    request needs them, the optional resources `retries` times before they are reported degraded.
+    """
+    from app.api.rerank import get_default_reranker
+    from app.api.retrieval import get_encoder
+
+    loop = asyncio.get_running_loop()
+    startup.expect(*WARM_UP_RESOURCES)
+
+    async def load_encoders():
+        # The BPE files come from TIKTOKEN_CACHE_DIR, baked into the image
+        for model in (config.model, config.embedding_model):
+            await loop.run_in_executor(None, get_encoder, model)
+        # A local embedding model (app.api.embeddings) runs its first inference
+        embeddings_warm_up = getattr(getattr(config.db, "embeddings", None), "warm_up", None)
+        if embeddings_warm_up is not None:
+            await loop.run_in_executor(None, embeddings_warm_up)
+
+    async def load_index_pages():
+        if config.db is not None:
+            await loop.run_in_executor(config.search_executor, touch_index, config.db)
+
+    async def load_clients():
+        # Created on first use otherwise (the Cohere client, see app.api.rerank)
+        reranker = config.reranker or get_default_reranker()
+        if hasattr(reranker, "client"):
+            reranker.client
+
+    steps = {"encoders": load_encoders, "index_pages": load_index_pages, "clients": load_clients}
+    for name, load in steps.items():
+        failures = 0
+        while True:
+            try:
+                with startup.loading(name):
+                    await load()
+                break
+            except Exception as e:
+                failures += 1
+                if name in OPTIONAL_WARM_UP_RESOURCES and failures > retries:
+                    logger.error(f"Warming up {name} failed, serving without it: {e}")
+                    startup.degrade(name, e)
+                    break
+                delay = min(max_backoff, backoff * 2 ** (failures - 1))
+                logger.warning(f"Warming up {name} failed, retrying in {delay:.0f}s: {e}")
+                await asyncio.sleep(delay)
+
+
+def prebake_tokenizers(encoding_names=None):
+    """Downloads the BPE files of the tiktoken encodings into TIKTOKEN_CACHE_DIR, at image build."""
+    if not os.environ.get("TIKTOKEN_CACHE_DIR"):
+        raise ValueError("Set TIKTOKEN_CACHE_DIR, the directory the encodings are loaded from")
+    import tiktoken
+
+    for name in encoding_names or tiktoken.list_encoding_names():
+        tiktoken.get_encoding(name)
+        logger.info(f"Cached the {name} encoding in {os.environ['TIKTOKEN_CACHE_DIR']}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Caches the tokenizer files for offline startup")
+    parser.add_argument("--encodings", nargs="*", help="Default: all the tiktoken encodings")
+    args = parser.parse_args()
+    prebake_tokenizers(args.encodings)
@@ -1,26 +1,69 @@
 import os
+import json
+import asyncio
 import logging
+import secrets
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 import argparse
+import math
+from app.api.startup import HEAVY_IMPORTS, startup
+
+# The heavy packages first, one by one, so that /ready reports the import time of each
+for module_name in HEAVY_IMPORTS:
+    startup.timed_import(module_name)
+
 import uvicorn
 import openai
-from pydantic import BaseModel
-from fastapi import FastAPI
+from pydantic import BaseModel, Field
+from fastapi import APIRouter, FastAPI, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from typing import List, Optional
 from dotenv import find_dotenv, load_dotenv
 from app.api.openai_interface import (
     get_openai_stream,
     Config,
     Message,
-    OpenAI,
+    AsyncOpenAI,
+    get_retrieval_kwargs,
     process_question_and_stream_response,
 )
 
 # from app.utils import fetch_database_ip
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores.faiss import FAISS
-from app.storage.storage_bucket import check_folder_exists, download_folder
+from app.index.store import load_vector_store
+from app.index.variants import apply_search_params
+from app.index.manager import IndexManager, read_manifest
+from app.storage.storage_bucket import check_folder_exists, get_bucket, sync_folder
+from app.api.admission import (
+    AdmissionController,
+    AdmissionRejected,
+    current_priority,
+    parse_limits,
+)
+from app.api.cache import AnswerCache, EmbeddingCache, RerankCache
+from app.api.capture import RequestCapture, current_capture
+from app.api.conversation import ConversationStore, SQLiteConversationBackend
+from app.api.embeddings import create_embeddings
+from app.api.pruning import CandidatePruning
+from app.api.rerank import create_reranker
+from app.api.resilience import create_resilience
+from app.api.startup import WARM_UP_RESOURCES, warm_up
+from app.api.metrics import metrics_registry, register_stats_source, start_timed_stream
+from app.api.disconnect import (
+    ClientDisconnected,
+    DisconnectAwareStreamingResponse,
+    run_unless_disconnected,
+)
+from app.api.retrieval import (
+    current_sources,
+    get_index_version,
+    get_law_context_chunks_batch,
+    iter_law_context_chunks_batch,
+)
+
+startup.mark("app_imported")
 
 # Configure logging
 logging.basicConfig(
@@ -29,6 +72,10 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+# Queries accepted by one /api/retrieve_batch request
+MAX_BATCH_QUERIES = 500
+
+
 # Define the interfaces for the API calls
 class UserQuery(BaseModel):
     query: str
@@ -40,98 +87,540 @@ class UserQuery(BaseModel):
 class ChatRequest(BaseModel):
     messages: List[Message]
     previewToken: Optional[str] = None
+    # Identifies the chat across turns, for its rolling summary (see app.api.conversation)
+    chat_id: Optional[str] = None
+    # Only retrieve from these laws, e.g. ["ZDDV-1"] (needs the index shards, see app.index.shards)
+    sources: Optional[List[str]] = None
 
 
-# TODO: Only allow access from frontend domain, or from local development (how to do this)
-app = FastAPI()
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+class RetrieveBatchRequest(BaseModel):
+    # An empty or larger batch is answered with a 422
+    queries: List[str] = Field(min_length=1, max_length=MAX_BATCH_QUERIES)
+    sources: Optional[List[str]] = None
+
+
+class IndexReloadRequest(BaseModel):
+    version: Optional[str] = None
 
 
-@app.get("/")
+# Set when the app starts (see create_app), or beforehand by a script embedding the app
+config: Optional[Config] = None
+# Set when the bucket holds versioned vector store snapshots
+index_manager = None
+
+router = APIRouter()
+
+
+@router.get("/")
 async def root():
     logger.info("Root endpoint called")
     return {"message": "Hello World"}
 
 
-@app.post("/api/chat_with_context")
-async def stream_with_local_context(user_query: ChatRequest):
-    logger.info("Chat with local context endpoint called")
-    return StreamingResponse(
-        get_openai_stream(user_query.messages, config),
+def pin_config():
+    # Shallow copy, so a request keeps using the index it started with if it is swapped meanwhile
+    return config.model_copy()
+
+
+@router.get("/ready")
+async def ready():
+    # 503 until the index, the config and the warm-up are done, with what is loaded so far
+    report = startup.report()
+    return JSONResponse(report, status_code=200 if report["ready"] else 503)
+
+
+@router.get("/metrics")
+async def metrics():
+    return Response(generate_latest(metrics_registry()), media_type=CONTENT_TYPE_LATEST)
+
+
+async def timed_event_stream(stream, request: Request, request_config: Config):
+    # The stages up to the first chunk run before the response starts, so their timings can be sent
+    # in the Server-Timing header. They are cancelled if the client disconnects meanwhile
+    try:
+        timings, stream = await run_unless_disconnected(
+            request, start_timed_stream(stream, request_config.sse_timing_comment)
+        )
+    except ClientDisconnected:
+        logger.info("Client disconnected before the answer started")
+        return Response(status_code=499)
+    except AdmissionRejected as e:
+        logger.info(f"Rejected the request: {e}")
+        return JSONResponse(
+            {"detail": "Too many requests, please retry later"},
+            status_code=429,
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+    return DisconnectAwareStreamingResponse(
+        stream,
         media_type="text/event-stream",
+        headers={
+            "X-Index-Version": str(request_config.index_version),
+            "Server-Timing": timings.server_timing(),
+        },
     )
 
 
-@app.post("/api/chat")
-async def chat(user_query: ChatRequest):
-    logger.info("Chat endpoint called")
-    return StreamingResponse(
-        process_question_and_stream_response(user_query.messages, config),
-        media_type="text/event-stream",
+def set_priority(x_priority: Optional[int]):
+    # Priority of the request's upstream calls in the admission queues, 0 (first) to 9
+    if x_priority is not None:
+        current_priority.set(min(max(x_priority, 0), 9))
+
+
+def set_sources(sources: Optional[List[str]], request_config: Config):
+    # Restricts the retrieval of the request to the shards of these laws
+    if not sources:
+        return
+    shard_index = getattr(request_config.db, "shard_index", None)
+    if shard_index is None:
+        raise HTTPException(status_code=400, detail="The index has no shards to filter sources by")
+    try:
+        shard_index.resolve(sources)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    current_sources.set(sources)
+
+
+def capture_chat(stream, user_query: ChatRequest, request_config: Config):
+    # A sample of the chats is written with their upstream responses, for the replay
+    capture = request_config.capture
+    record = capture.start(user_query.model_dump(), request_config) if capture else None
+    if record is None:
+        return stream
+    current_capture.set(record)
+    return capture.stream(stream, record)
+
+
+@router.post("/api/chat_with_context")
+async def stream_with_local_context(
+    user_query: ChatRequest, request: Request, x_priority: Optional[int] = Header(None)
+):
+    request_config = pin_config()
+    set_priority(x_priority)
+    set_sources(user_query.sources, request_config)
+    logger.info(f"Chat with local context endpoint called (index {request_config.index_version})")
+    return await timed_event_stream(
+        get_openai_stream(user_query.messages, request_config, user_query.chat_id),
+        request,
+        request_config,
     )
 
 
-if __name__ == "__main__":
-    args = argparse.ArgumentParser()
-    args.add_argument("--local", action="store_true", help="Run the server locally")
-    args = args.parse_args()
+@router.post("/api/chat")
+async def chat(user_query: ChatRequest, request: Request, x_priority: Optional[int] = Header(None)):
+    request_config = pin_config()
+    set_priority(x_priority)
+    set_sources(user_query.sources, request_config)
+    logger.info(f"Chat endpoint called (index {request_config.index_version})")
+    return await timed_event_stream(
+        capture_chat(
+            process_question_and_stream_response(
+                user_query.messages, request_config, user_query.chat_id
+            ),
+            user_query,
+            request_config,
+        ),
+        request,
+        request_config,
+    )
+
+
+async def stream_retrieve_batch(queries: List[str], request_config: Config):
+    # One NDJSON line per query, in the order the queries finish
+    async for position, (context, references) in iter_law_context_chunks_batch(
+        queries,
+        **get_retrieval_kwargs(request_config),
+        max_concurrency=request_config.rerank_concurrency,
+    ):
+        result = {
+            "index": position,
+            "query": queries[position],
+            "context": context,
+            "references": references,
+        }
+        yield json.dumps(result, ensure_ascii=False) + "\n"
+
+
+@router.post("/api/retrieve_batch")
+async def retrieve_batch(batch: RetrieveBatchRequest):
+    request_config = pin_config()
+    set_sources(batch.sources, request_config)
+    logger.info(f"Batch retrieval endpoint called with {len(batch.queries)} queries")
+    headers = {"X-Index-Version": str(request_config.index_version)}
+    if len(batch.queries) > request_config.batch_stream_threshold:
+        return StreamingResponse(
+            stream_retrieve_batch(batch.queries, request_config),
+            media_type="application/x-ndjson",
+            headers=headers,
+        )
+
+    results = await get_law_context_chunks_batch(
+        batch.queries,
+        **get_retrieval_kwargs(request_config),
+        max_concurrency=request_config.rerank_concurrency,
+    )
+    return {
+        "index_version": request_config.index_version,
+        "results": [
+            {"index": position, "query": query, "context": context, "references": references}
+            for position, (query, (context, references)) in enumerate(zip(batch.queries, results))
+        ],
+    }
+
+
+def check_admin_token(x_admin_token: Optional[str]):
+    admin_token = os.environ.get("ADMIN_TOKEN")
+    if not admin_token or not secrets.compare_digest(x_admin_token or "", admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+    if index_manager is None:
+        raise HTTPException(status_code=409, detail="The vector index is not versioned")
 
+
+@router.get("/admin/index")
+async def index_status(x_admin_token: Optional[str] = Header(None)):
+    check_admin_token(x_admin_token)
+    # The state of the worker that serves the request, the others may still be polling
+    return {
+        "active_version": index_manager.active_version,
+        "history": index_manager.history,
+        "worker_pid": os.getpid(),
+    }
+
+
+@router.post("/admin/index/reload")
+async def reload_index(request: IndexReloadRequest, x_admin_token: Optional[str] = Header(None)):
+    check_admin_token(x_admin_token)
+    # A version is made current in the manifest, so that every worker and instance swaps to it
+    try:
+        if request.version is None:
+            version = await index_manager.reload(config)
+        else:
+            version = await index_manager.pin(config, request.version)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return index_swap_response(version)
+
+
+@router.post("/admin/index/rollback")
+async def rollback_index(x_admin_token: Optional[str] = Header(None)):
+    check_admin_token(x_admin_token)
+    try:
+        version = await index_manager.rollback(config)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return index_swap_response(version)
+
+
+def index_swap_response(version):
+    # Only this worker has swapped yet, the others follow the manifest within the poll interval
+    poll_interval = float(os.environ.get("INDEX_POLL_INTERVAL", 300))
+    return {
+        "active_version": version,
+        "worker_pid": os.getpid(),
+        "other_workers_within_seconds": poll_interval if poll_interval > 0 else None,
+    }
+
+
+def load_environment(local=False):
     logger.info("Loading the environment variables")
-    if args.local:
+    if local:
         load_dotenv(".env.local", override=True)
         # fetch_database_ip(internal=False)
     else:
         # All the environment variables are passed through one secret value --> Need to extract them
         environment_variables = os.environ.get("ENVIRONMENT_VARIABLES")
-        with open(".env", "w") as f:
-            f.write(environment_variables)
+        if environment_variables is not None:
+            with open(".env", "w") as f:
+                f.write(environment_variables)
         load_dotenv(find_dotenv(), override=True)
         # fetch_database_ip(internal=True)
 
+
+def get_search_params():
+    faiss_nprobe = int(os.environ["FAISS_NPROBE"]) if "FAISS_NPROBE" in os.environ else None
+    faiss_ef_search = (
+        int(os.environ["FAISS_EF_SEARCH"]) if "FAISS_EF_SEARCH" in os.environ else None
+    )
+    return faiss_nprobe, faiss_ef_search
+
+
+def load_index(local=False):
+    """Loads the vector store, downloading it first if needed. Returns (db, version, manager)."""
+    manager = None
+    # The embeddings of the queries, the vector store must have been built by the same backend
+    embeddings = create_embeddings(
+        os.environ.get("EMBEDDING_BACKEND", "openai"),
+        model=os.environ["EMBEDDING_MODEL"],
+        model_path=os.environ.get("EMBEDDING_MODEL_PATH"),
+        query_prefix=os.environ.get("EMBEDDING_QUERY_PREFIX", ""),
+    )
+    faiss_nprobe, faiss_ef_search = get_search_params()
+    vector_db_mmap = os.environ.get("VECTOR_DB_MMAP", "1") == "1"
+    vector_db_sync_workers = int(os.environ.get("VECTOR_DB_SYNC_WORKERS", 8))
+
     # Load the Vector DB if we have access to
     logger.info("Loading the vector database")
     VECTOR_DB_PATH = os.getenv("VECTOR_DB_PATH")
     STORAGE_BUCKET_NAME = os.getenv("STORAGE_BUCKET_NAME")
-    if (
-        STORAGE_BUCKET_NAME is not None
-        and check_folder_exists(STORAGE_BUCKET_NAME, "vector_database", local=args.local)
-        and not os.path.exists(os.path.join(VECTOR_DB_PATH, "index.faiss"))
-    ):
-        os.makedirs(VECTOR_DB_PATH, exist_ok=True)
-        download_folder(STORAGE_BUCKET_NAME, "vector_database", VECTOR_DB_PATH, local=args.local)
+    bucket = None
+    if STORAGE_BUCKET_NAME is not None:
+        bucket = get_bucket(STORAGE_BUCKET_NAME, local=local)
 
-    # Initialize the vector store
-    logger.info("Initializing the vector store")
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-    embedding_model = os.environ["EMBEDDING_MODEL"]
-    embeddings = OpenAIEmbeddings(model=embedding_model)
-    try:
-        db = FAISS.load_local(VECTOR_DB_PATH, embeddings, allow_dangerous_deserialization=True)
-    except Exception as e:
-        print("Error loading the database", e)
-        db = None
+    if bucket is not None and read_manifest(bucket) is not None:
+        # Versioned snapshots, reloaded in the background when the manifest changes
+        manager = IndexManager(
+            bucket,
+            VECTOR_DB_PATH,
+            embeddings,
+            mmap=vector_db_mmap,
+            nprobe=faiss_nprobe,
+            ef_search=faiss_ef_search,
+            sync_workers=vector_db_sync_workers,
+        )
+        index_version, db = manager.load_current()
+    else:
+        if bucket is not None and check_folder_exists(
+            STORAGE_BUCKET_NAME, "vector_database", local=local
+        ):
+            # Only the files that are missing or differ from the bucket copy are downloaded
+            os.makedirs(VECTOR_DB_PATH, exist_ok=True)
+            sync_folder(
+                bucket, "vector_database", VECTOR_DB_PATH, max_workers=vector_db_sync_workers
+            )
 
-    # Initialize the config for the OpenAI interface
-    config = Config(
+        logger.info("Initializing the vector store")
+        try:
+            db = load_vector_store(VECTOR_DB_PATH, embeddings, mmap=vector_db_mmap)
+            apply_search_params(db.index, nprobe=faiss_nprobe, ef_search=faiss_ef_search)
+        except Exception as e:
+            logger.error(f"Error loading the database: {e}")
+            db = None
+        index_version = get_index_version(VECTOR_DB_PATH)
+    return db, index_version, manager
+
+
+def build_config(db, index_version) -> Config:
+    """The config of the OpenAI interface, with the clients, caches and executors of one process."""
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    faiss_nprobe, faiss_ef_search = get_search_params()
+    app_config = Config(
         retrieve_n=int(os.environ.get("NUM_RETRIEVED_CHUNKS")),
         rerank_max_n=int(os.environ.get("NUM_RERANKED_CHUNKS")),
         max_context_len=int(os.environ.get("MAX_CONTEXT_LENGTH")),
         model=os.environ.get("GPT_MODEL"),
-        client=OpenAI(api_key=os.environ.get("OPENAI_API_KEY")),
-        embedding_model=embedding_model,
+        client=AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY")),
+        embedding_model=os.environ["EMBEDDING_MODEL"],
         db=db,
         use_reformulated_question=True,
+        search_executor=ThreadPoolExecutor(
+            max_workers=int(os.environ.get("SEARCH_WORKERS", 4)),
+            thread_name_prefix="faiss-search",
+        ),
+        pipeline_mode=os.environ.get("PIPELINE_MODE", "sequential"),
+        speculative_similarity_threshold=float(
+            os.environ.get("SPECULATIVE_SIMILARITY_THRESHOLD", 0.9)
+        ),
+        embedding_cache=EmbeddingCache(
+            max_size=int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000)),
+            ttl=float(os.environ.get("EMBEDDING_CACHE_TTL", 7 * 24 * 3600)),
+            path=os.environ.get("EMBEDDING_CACHE_PATH"),
+        ),
+        # Off unless a size is set, near-duplicate questions would get replayed answers
+        answer_cache=(
+            AnswerCache(
+                max_size=int(os.environ["ANSWER_CACHE_SIZE"]),
+                threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.97)),
+            )
+            if int(os.environ.get("ANSWER_CACHE_SIZE", 0)) > 0
+            else None
+        ),
+        index_version=index_version,
+        faiss_nprobe=faiss_nprobe,
+        faiss_ef_search=faiss_ef_search,
+        rerank_concurrency=int(os.environ.get("RERANK_CONCURRENCY", 8)),
+        batch_stream_threshold=int(os.environ.get("BATCH_STREAM_THRESHOLD", 20)),
+        hybrid_search=os.environ.get("HYBRID_SEARCH", "0") == "1",
+        rrf_k=int(os.environ.get("RRF_K", 60)),
+        hybrid_rerank_pool=(
+            int(os.environ["HYBRID_RERANK_POOL"]) if "HYBRID_RERANK_POOL" in os.environ else None
+        ),
+        hybrid_skip_rerank_agreement=(
+            float(os.environ["HYBRID_SKIP_RERANK_AGREEMENT"])
+            if "HYBRID_SKIP_RERANK_AGREEMENT" in os.environ
+            else None
+        ),
+        reranker=create_reranker(
+            os.environ.get("RERANK_BACKEND", "cohere"),
+            model=os.environ.get("RERANK_MODEL"),
+            model_path=os.environ.get("CROSS_ENCODER_PATH"),
+        ),
+        rerank_cache=RerankCache(
+            max_size=int(os.environ.get("RERANK_CACHE_SIZE", 10000)),
+            ttl=float(os.environ.get("RERANK_CACHE_TTL", 24 * 3600)),
+        ),
+        rerank_skip_gap=(
+            float(os.environ["RERANK_SKIP_GAP"]) if "RERANK_SKIP_GAP" in os.environ else None
+        ),
+        sse_timing_comment=os.environ.get("SSE_TIMING_COMMENT", "0") == "1",
+        sse_flush_interval=float(os.environ.get("SSE_FLUSH_INTERVAL", 0.03)),
+        sse_flush_bytes=int(os.environ.get("SSE_FLUSH_BYTES", 1024)),
+        sse_flush_on_newline=os.environ.get("SSE_FLUSH_ON_NEWLINE", "1") == "1",
+        conversation_store=ConversationStore(
+            max_size=int(os.environ.get("CONVERSATION_CACHE_SIZE", 10000)),
+            backend=(
+                SQLiteConversationBackend(os.environ["CONVERSATION_STORE_PATH"])
+                if "CONVERSATION_STORE_PATH" in os.environ
+                else None
+            ),
+        ),
+        history_token_budget=int(os.environ.get("HISTORY_TOKEN_BUDGET", 1500)),
+        summary_model=os.environ.get("SUMMARY_MODEL", "gpt-4o-mini"),
+        admission=(
+            AdmissionController(
+                parse_limits(os.environ["ADMISSION_LIMITS"]),
+                max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", 100)),
+                max_wait=float(os.environ.get("ADMISSION_MAX_WAIT", 10)),
+            )
+            if "ADMISSION_LIMITS" in os.environ
+            else None
+        ),
+        expected_answer_tokens=int(os.environ.get("EXPECTED_ANSWER_TOKENS", 800)),
+        resilience=(
+            create_resilience(
+                {
+                    "embed": float(os.environ.get("EMBED_DEADLINE", 3)),
+                    "rerank": float(os.environ.get("RERANK_DEADLINE", 3)),
+                    "reformulate": float(os.environ.get("REFORMULATE_DEADLINE", 8)),
+                },
+                hedge_quantile=float(os.environ.get("HEDGE_QUANTILE", 0.95)) or None,
+                retries=int(os.environ.get("UPSTREAM_RETRIES", 2)),
+            )
+            if os.environ.get("UPSTREAM_RESILIENCE", "0") == "1"
+            else None
+        ),
+        shard_routing=os.environ.get("SHARD_ROUTING", "1") == "1",
+        shard_centroid_margin=(
+            float(os.environ["SHARD_CENTROID_MARGIN"])
+            if "SHARD_CENTROID_MARGIN" in os.environ
+            else None
+        ),
+        max_routed_shards=int(os.environ.get("MAX_ROUTED_SHARDS", 3)),
+        pruning=(
+            CandidatePruning(
+                dedup_threshold=float(os.environ.get("PRUNE_DEDUP_THRESHOLD", 0.95)) or None,
+                mmr_lambda=float(os.environ.get("PRUNE_MMR_LAMBDA", 0.7)) or None,
+                mmr_n=int(os.environ["PRUNE_MMR_N"]) if "PRUNE_MMR_N" in os.environ else None,
+                group=os.environ.get("PRUNE_GROUP_CHUNKS", "1") == "1",
+            )
+            if os.environ.get("CANDIDATE_PRUNING", "0") == "1"
+            else None
+        ),
+        capture=(
+            RequestCapture(
+                os.environ["REQUEST_CAPTURE_PATH"],
+                sample_rate=float(os.environ.get("CAPTURE_SAMPLE_RATE", 0.01)),
+                max_bytes=int(os.environ.get("CAPTURE_MAX_BYTES", 50_000_000)),
+                backups=int(os.environ.get("CAPTURE_BACKUPS", 3)),
+            )
+            if "REQUEST_CAPTURE_PATH" in os.environ
+            else None
+        ),
     )
+    register_stats_source("embedding_cache", app_config.embedding_cache)
+    register_stats_source("answer_cache", app_config.answer_cache)
+    register_stats_source("rerank_cache", app_config.rerank_cache)
+    register_stats_source("reranker", app_config.reranker)
+    register_stats_source("conversation_store", app_config.conversation_store)
+    register_stats_source("admission", app_config.admission)
+    register_stats_source("resilience", app_config.resilience)
+    register_stats_source("pruning", app_config.pruning)
+    register_stats_source("capture", app_config.capture)
+    return app_config
+
+
+def create_app(preload_index=False, local=False, index_loader=None, config_builder=None) -> FastAPI:
+    """Creates the app. The environment, vector store and config are loaded when it starts.
+
+    With preload_index the vector store is loaded right away instead, i.e. in the gunicorn master
+    with preload_app (see gunicorn_conf.py), so that the workers forked from it share its memory
+    copy-on-write instead of loading one copy each. The clients, caches and executors are still
+    created in every worker, as they must not cross a fork.
+
+    index_loader (returning the db, its version and index manager) and config_builder replace the
+    loading from the environment, e.g. in the benchmarks.
+    """
+    if index_loader is None:
+
+        def index_loader():
+            load_environment(local)
+            return load_index(local)
+
+    config_builder = config_builder or build_config
+    # Ready once these are loaded (the index and config unless a script set the config already)
+    startup.expect(*(("index", "config") if config is None else ()), *WARM_UP_RESOURCES)
+    preloaded = None
+    if preload_index and config is None:
+        with startup.loading("index"):
+            preloaded = index_loader()
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        global config, index_manager
+        if config is None:
+            loaded = preloaded
+            if loaded is None:
+                with startup.loading("index"):
+                    loaded = index_loader()
+            db, index_version, index_manager = loaded
+            with startup.loading("config"):
+                config = config_builder(db, index_version)
+            logger.info(f"Serving vector index version {index_version} (pid {os.getpid()})")
+        # The server accepts connections meanwhile, /ready reports when it is done
+        warm_up_task = asyncio.create_task(warm_up(config))
+        poller = None
+        poll_interval = float(os.environ.get("INDEX_POLL_INTERVAL", 300))
+        if index_manager is not None and poll_interval > 0:
+            poller = asyncio.create_task(index_manager.poll(config, poll_interval))
+        yield
+        warm_up_task.cancel()
+        if poller is not None:
+            poller.cancel()
+
+    app = FastAPI(lifespan=lifespan)
+    # TODO: Only allow access from frontend domain, or from local development (how to do this)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.include_router(router)
+    return app
+
+
+def __getattr__(name):
+    # For `uvicorn app.app:app`, loads everything when the server starts. Created on first access,
+    # so that importing the module (gunicorn calls create_app itself) builds no second app
+    if name == "app":
+        app = globals()["app"] = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser()
+    args.add_argument("--local", action="store_true", help="Run the server locally")
+    args = args.parse_args()
 
     # Start the Server
     port = int(
         os.environ.get("PORT", 8080)
     )  # Default to 8080 for local development, use PORT env var in Cloud Run
     logger.info(f"Starting server on port {port}")
-    uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")
+    uvicorn.run(
+        create_app(preload_index=True, local=args.local),
+        host="0.0.0.0",
+        port=port,
+        log_level="info",
+    )
@@ -0,0 +1,192 @@
+"""Lexical BM25 index over the chunks of the vector store.
+
+Dense embeddings match exact identifiers such as "ZDoh-2", "76.a člen" or form names poorly, BM25
+matches them exactly. The index is keyed by FAISS position, so its hits can be fused with the dense
+hits, and is stored as a compact `bm25.npz` sidecar next to `index.faiss` (a sorted vocabulary and
+CSR postings) that loads without any per-term Python objects.
+
+Build the sidecar of a vector store:
+    python -m app.index.bm25 --db-path vector_database
+"""
+
+import argparse
+import logging
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+BM25_FILENAME = "bm25.npz"
+
+# Identifiers like "zdoh-2", "76.a" or "doh-prih" are kept whole, and their parts are indexed too
+TOKEN_PATTERN = re.compile(r"\w+(?:[.\-/]\w+)*")
+PART_PATTERN = re.compile(r"[.\-/]")
+
+# Light stemming: the most frequent Slovenian noun and adjective endings, longest first
+SUFFIXES = sorted(
+    [
+        "ega", "emu", "ima", "imi", "ih", "im", "om", "ov", "ev", "ami", "ah", "em",
+        "ja", "ju", "je", "ji", "jo", "a", "e", "i", "o", "u",
+    ],
+    key=len,
+    reverse=True,
+)  # fmt: skip
+MIN_STEM_LENGTH = 4
+
+
+def fold(text):
+    # Lowercase and drop diacritics, so "člen" and "clen" match
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+def stem(token):
+    if not token.isalpha():
+        return token
+    for suffix in SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= MIN_STEM_LENGTH:
+            return token[: -len(suffix)]
+    return token
+
+
+def tokenize(text):
+    tokens = []
+    for token in TOKEN_PATTERN.findall(fold(text)):
+        tokens.append(stem(token))
+        if PART_PATTERN.search(token):
+            tokens.extend(stem(part) for part in PART_PATTERN.split(token) if len(part) > 1)
+    return tokens
+
+
+class BM25Index:
+    def __init__(self, vocabulary, term_offsets, postings, term_freqs, doc_lengths, k1=1.2, b=0.75):
+        self.vocabulary = vocabulary  # sorted array of terms
+        self.term_offsets = term_offsets  # postings of term i: [term_offsets[i], term_offsets[i+1])
+        self.postings = postings  # FAISS positions
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.n_docs = len(doc_lengths)
+        self.avg_doc_length = float(doc_lengths.mean()) if self.n_docs else 0.0
+
+    @classmethod
+    def build(cls, texts, k1=1.2, b=0.75):
+        """Builds the index from the chunk texts, in FAISS position order."""
+        postings_by_term = {}
+        doc_lengths = np.zeros(len(texts), dtype=np.float32)
+        for position, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_lengths[position] = sum(counts.values())
+            for term, count in counts.items():
+                postings_by_term.setdefault(term, []).append((position, count))
+
+        vocabulary = sorted(postings_by_term)
+        term_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        postings, term_freqs = [], []
+        for i, term in enumerate(vocabulary):
+            for position, count in postings_by_term[term]:
+                postings.append(position)
+                term_freqs.append(min(count, np.iinfo(np.uint16).max))
+            term_offsets[i + 1] = len(postings)
+        return cls(
+            np.array(vocabulary, dtype=str),
+            term_offsets,
+            np.array(postings, dtype=np.int32),
+            np.array(term_freqs, dtype=np.uint16),
+            doc_lengths,
+            k1=k1,
+            b=b,
+        )
+
+    def save(self, path):
+        tmp_path = path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            vocabulary=self.vocabulary,
+            term_offsets=self.term_offsets,
+            postings=self.postings,
+            term_freqs=self.term_freqs,
+            doc_lengths=self.doc_lengths,
+            params=np.array([self.k1, self.b]),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            k1, b = data["params"]
+            return cls(
+                data["vocabulary"],
+                data["term_offsets"],
+                data["postings"],
+                data["term_freqs"],
+                data["doc_lengths"],
+                k1=float(k1),
+                b=float(b),
+            )
+
+    def _term_id(self, term):
+        i = int(np.searchsorted(self.vocabulary, term))
+        if i < len(self.vocabulary) and self.vocabulary[i] == term:
+            return i
+        return None
+
+    def search(self, query, k, mask=None):
+        """Returns the FAISS positions of the top k chunks for the query, best first.
+
+        A boolean `mask` over the positions restricts the hits to the chunks where it is set.
+        """
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        length_norm = self.k1 * (1 - self.b + self.b * self.doc_lengths / self.avg_doc_length)
+        for term in set(tokenize(query)):
+            term_id = self._term_id(term)
+            if term_id is None:
+                continue
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            positions = self.postings[start:end]
+            freqs = self.term_freqs[start:end].astype(np.float32)
+            idf = math.log(1 + (self.n_docs - len(positions) + 0.5) / (len(positions) + 0.5))
+            scores[positions] += idf * freqs * (self.k1 + 1) / (freqs + length_norm[positions])
+        if mask is not None:
+            scores[~mask] = 0
+
+        k = min(k, int(np.count_nonzero(scores)))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [int(position) for position in top[np.argsort(-scores[top])]]
+
+
+def load_bm25_index(db_path):
+    path = os.path.join(db_path, BM25_FILENAME)
+    if not os.path.exists(path):
+        return None
+    return BM25Index.load(path)
+
+
+def build_bm25_index(db_path):
+    from app.index.store import load_vector_store
+
+    db = load_vector_store(db_path, None)
+    texts = [
+        db.docstore.search(db.index_to_docstore_id[position]).page_content
+        for position in range(db.index.ntotal)
+    ]
+    index = BM25Index.build(texts)
+    index.save(os.path.join(db_path, BM25_FILENAME))
+    logger.info(f"Built the BM25 index of {len(texts)} chunks, {len(index.vocabulary)} terms")
+    return index
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build the BM25 sidecar of a vector store")
+    parser.add_argument("--db-path", default=os.getenv("VECTOR_DB_PATH"))
+    args = parser.parse_args()
+    build_bm25_index(args.db_path)
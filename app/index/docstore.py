@@ -0,0 +1,138 @@
+"""Compact on-disk docstore for the FAISS vector store.
+
+The pickled `InMemoryDocstore` written by langchain has to be unpickled in full at startup. The
+SQLite docstore keeps the chunks on disk and only reads the rows of the top-k hits of a search.
+
+Convert an existing vector store (writes `docstore.sqlite` next to `index.faiss`):
+    python -m app.index.docstore --db-path vector_database
+"""
+
+import argparse
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+from collections.abc import Mapping
+from typing import List, Union
+
+from langchain_community.docstore.base import Docstore
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+DOCSTORE_FILENAME = "docstore.sqlite"
+
+
+class SqliteDocstore(Docstore):
+    """Read-only docstore backed by a SQLite file, looked up lazily by document id."""
+
+    def __init__(self, path):
+        self.path = path
+        self._connect()
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        self._pid = os.getpid()
+
+    def _fetch(self, query, params):
+        with self._lock:
+            # A SQLite connection must not be used across a fork (gunicorn workers forked from a
+            # master that preloaded the index), so a forked process opens its own
+            if self._pid != os.getpid():
+                self._connect()
+            return self._conn.execute(query, params).fetchall()
+
+    def search(self, search: str) -> Union[str, Document]:
+        rows = self._fetch("SELECT page_content, metadata FROM docs WHERE doc_id = ?", (search,))
+        if not rows:
+            return f"ID {search} not found."
+        page_content, metadata = rows[0]
+        return Document(id=search, page_content=page_content, metadata=json.loads(metadata))
+
+    def search_many(self, ids: List[str]) -> List[Union[str, Document]]:
+        placeholders = ",".join("?" * len(ids))
+        rows = self._fetch(
+            f"SELECT doc_id, page_content, metadata FROM docs WHERE doc_id IN ({placeholders})",
+            tuple(ids),
+        )
+        found = {
+            doc_id: Document(id=doc_id, page_content=page_content, metadata=json.loads(metadata))
+            for doc_id, page_content, metadata in rows
+        }
+        return [found.get(doc_id, f"ID {doc_id} not found.") for doc_id in ids]
+
+    def index_to_docstore_id(self) -> "SqliteIndexMapping":
+        return SqliteIndexMapping(self)
+
+    def __len__(self):
+        return self._fetch("SELECT COUNT(*) FROM docs", ())[0][0]
+
+
+class SqliteIndexMapping(Mapping):
+    """Lazy replacement of the `index_to_docstore_id` dict (FAISS position -> document id)."""
+
+    def __init__(self, docstore: SqliteDocstore):
+        self._docstore = docstore
+
+    def __getitem__(self, position):
+        rows = self._docstore._fetch(
+            "SELECT doc_id FROM positions WHERE position = ?", (int(position),)
+        )
+        if not rows:
+            raise KeyError(position)
+        return rows[0][0]
+
+    def __iter__(self):
+        for (position,) in self._docstore._fetch(
+            "SELECT position FROM positions ORDER BY position", ()
+        ):
+            yield position
+
+    def __len__(self):
+        return self._docstore._fetch("SELECT COUNT(*) FROM positions", ())[0][0]
+
+
+def write_sqlite_docstore(path, documents, index_to_docstore_id):
+    """Writes (doc_id, Document) pairs and the position mapping to a new SQLite docstore."""
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute("CREATE TABLE docs (doc_id TEXT PRIMARY KEY, page_content TEXT, metadata TEXT)")
+    conn.execute("CREATE TABLE positions (position INTEGER PRIMARY KEY, doc_id TEXT)")
+    conn.executemany(
+        "INSERT INTO docs VALUES (?, ?, ?)",
+        (
+            (doc_id, doc.page_content, json.dumps(doc.metadata, ensure_ascii=False))
+            for doc_id, doc in documents
+        ),
+    )
+    conn.executemany(
+        "INSERT INTO positions VALUES (?, ?)",
+        ((int(position), doc_id) for position, doc_id in index_to_docstore_id.items()),
+    )
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.close()
+    os.replace(tmp_path, path)
+
+
+def convert_pickle_docstore(db_path):
+    """Converts the `index.pkl` of a langchain FAISS store into a SQLite docstore."""
+    with open(os.path.join(db_path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    path = os.path.join(db_path, DOCSTORE_FILENAME)
+    write_sqlite_docstore(path, docstore._dict.items(), index_to_docstore_id)
+    logger.info(f"Wrote {len(docstore._dict)} documents to {path}")
+    return path
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Convert a pickled docstore to SQLite")
+    parser.add_argument("--db-path", default=os.getenv("VECTOR_DB_PATH"))
+    args = parser.parse_args()
+    convert_pickle_docstore(args.db_path)
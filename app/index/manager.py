@@ -0,0 +1,238 @@
+"""Versioned vector store snapshots in the storage bucket, and their hot reload.
+
+Bucket layout:
+    vector_database/manifest.json                {"current": "<version>", "versions": [...],
+                                                  "history": [...]}
+    vector_database/versions/<version>/index.faiss, index.pkl, docstore.sqlite, ...
+
+The server polls the manifest and, when `current` changes, downloads and loads the new snapshot off
+the request path and swaps it into the config. Requests pin the config when they start, so the ones
+in flight finish on the index they started with.
+
+Forced reloads and rollbacks rewrite `current` in the manifest, the state all the gunicorn workers
+and instances share: the worker serving the admin request swaps right away, the others on their
+next poll. `history` lists the versions made current, the last one is current.
+
+Publish a snapshot (also works with a file://<dir> bucket):
+    python -m app.index.manager --bucket <bucket> --db-path vector_database --version 2026-10-01
+"""
+
+import argparse
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import shutil
+
+from app.index.store import load_vector_store
+from app.index.variants import apply_search_params
+from app.storage.storage_bucket import get_bucket, sync_folder
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PREFIX = "vector_database"
+
+
+def manifest_blob_name(prefix=DEFAULT_PREFIX):
+    return f"{prefix}/manifest.json"
+
+
+def read_manifest(bucket, prefix=DEFAULT_PREFIX):
+    blob = bucket.blob(manifest_blob_name(prefix))
+    if not blob.exists():
+        return None
+    return json.loads(blob.download_as_bytes())
+
+
+def publish_version(bucket, db_path, version, prefix=DEFAULT_PREFIX):
+    """Uploads a vector store as a new snapshot and makes it the current version."""
+    for filename in sorted(os.listdir(db_path)):
+        local_file_path = os.path.join(db_path, filename)
+        if os.path.isfile(local_file_path):
+            bucket.blob(f"{prefix}/versions/{version}/{filename}").upload_from_filename(
+                local_file_path
+            )
+    manifest = read_manifest(bucket, prefix) or {"versions": []}
+    if version not in manifest["versions"]:
+        manifest["versions"].append(version)
+    set_current(bucket, manifest, version, prefix)
+    logger.info(f"Published version {version} of the vector store")
+
+
+def set_current(bucket, manifest, version, prefix=DEFAULT_PREFIX):
+    """Makes a version of the manifest the current one, for every server polling it."""
+    history = [v for v in manifest.get("history", [manifest.get("current")]) if v is not None]
+    if version in history:
+        history.remove(version)
+    manifest["history"] = history + [version]
+    manifest["current"] = version
+    bucket.blob(manifest_blob_name(prefix)).upload_from_string(json.dumps(manifest, indent=2))
+
+
+class IndexManager:
+    """Loads vector store snapshots from the bucket and swaps them into the config."""
+
+    def __init__(
+        self,
+        bucket,
+        local_root,
+        embeddings,
+        prefix=DEFAULT_PREFIX,
+        mmap=True,
+        nprobe=None,
+        ef_search=None,
+        keep_versions=2,
+        sync_workers=8,
+    ):
+        self.bucket = bucket
+        self.local_root = local_root
+        self.embeddings = embeddings
+        self.prefix = prefix
+        self.mmap = mmap
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.keep_versions = keep_versions
+        self.sync_workers = sync_workers
+        self.active_version = None
+        self.history = []  # versions activated by this worker, the last one is active
+        self._manifest_version = None  # manifest version last acted upon by the poller
+        self._lock = asyncio.Lock()
+
+    def current_version(self):
+        return read_manifest(self.bucket, self.prefix)["current"]
+
+    def load_version(self, version):
+        """Downloads (if needed) and loads a snapshot. Blocking, run it off the event loop."""
+        local_path = os.path.join(self.local_root, version)
+        os.makedirs(local_path, exist_ok=True)
+        # The gunicorn workers of one instance reload at the same time, only one downloads, the
+        # others find the files up to date and map the same pages
+        with open(os.path.join(self.local_root, ".sync.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            sync_folder(
+                self.bucket,
+                f"{self.prefix}/versions/{version}",
+                local_path,
+                max_workers=self.sync_workers,
+                # The version directories only hold the snapshot, a file it lacks is stale
+                remove_extra=True,
+            )
+        db = load_vector_store(local_path, self.embeddings, mmap=self.mmap)
+        apply_search_params(db.index, nprobe=self.nprobe, ef_search=self.ef_search)
+        return db
+
+    def activate(self, config, version, db, manifest=None):
+        # A single synchronous step, so requests never see the db and version of different snapshots
+        config.db = db
+        config.index_version = version
+        previous_version, self.active_version = self.active_version, version
+        if version in self.history:
+            self.history.remove(version)
+        self.history.append(version)
+        logger.info(f"Activated vector index version {version} (previous: {previous_version})")
+        self._remove_old_versions(manifest or {})
+
+    def _remove_old_versions(self, manifest):
+        # Unlinking is safe for memory-mapped files still used by requests in flight. The other
+        # workers of the instance follow the manifest, so its recent versions are kept for them,
+        # and nothing is removed while one of them holds the lock to download a version
+        keep = set(self.history[-self.keep_versions :])
+        keep.update(manifest.get("history", [])[-self.keep_versions :])
+        keep.add(manifest.get("current"))
+        with open(os.path.join(self.local_root, ".sync.lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            for version in os.listdir(self.local_root):
+                path = os.path.join(self.local_root, version)
+                if os.path.isdir(path) and version not in keep:
+                    shutil.rmtree(path, ignore_errors=True)
+
+    def load_current(self, config=None):
+        """Blocking initial load of the manifest's current version, returns (version, db)."""
+        manifest = read_manifest(self.bucket, self.prefix)
+        version = manifest["current"]
+        db = self.load_version(version)
+        self._manifest_version = version
+        if config is not None:
+            self.activate(config, version, db, manifest)
+        else:
+            self.active_version = version
+            self.history.append(version)
+        return version, db
+
+    async def reload(self, config, version=None):
+        """Loads the given (default: the manifest's current) version and swaps it in."""
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            manifest = await loop.run_in_executor(None, read_manifest, self.bucket, self.prefix)
+            if version is None:
+                version = manifest["current"]
+                self._manifest_version = version
+            elif version not in manifest["versions"]:
+                raise ValueError(f"Unknown vector index version {version}")
+            if version == self.active_version:
+                return version
+            db = await loop.run_in_executor(None, self.load_version, version)
+            self.activate(config, version, db, manifest)
+            return version
+
+    async def pin(self, config, version):
+        """Makes the version current in the manifest and swaps it in.
+
+        The other workers and instances swap on their next poll.
+        """
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            manifest = await loop.run_in_executor(None, read_manifest, self.bucket, self.prefix)
+            if version not in manifest["versions"]:
+                raise ValueError(f"Unknown vector index version {version}")
+            if version != manifest["current"]:
+                await loop.run_in_executor(
+                    None, set_current, self.bucket, manifest, version, self.prefix
+                )
+                logger.info(f"Made vector index version {version} current in the manifest")
+        return await self.reload(config)
+
+    async def rollback(self, config):
+        """Makes the previously current version of the manifest current again, or if there is no
+        history, the version published before it."""
+        manifest = await asyncio.get_running_loop().run_in_executor(
+            None, read_manifest, self.bucket, self.prefix
+        )
+        current = manifest["current"]
+        history = [version for version in manifest.get("history", []) if version != current]
+        if history:
+            version = history[-1]
+        else:
+            position = manifest["versions"].index(current)
+            if position == 0:
+                raise ValueError(f"No version to roll back to from {current}")
+            version = manifest["versions"][position - 1]
+        return await self.pin(config, version)
+
+    async def poll(self, config, interval):
+        """Reloads whenever the manifest's current version changes."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                loop = asyncio.get_running_loop()
+                version = await loop.run_in_executor(None, self.current_version)
+                if version != self._manifest_version:
+                    logger.info(f"New vector index version {version} in the manifest")
+                    await self.reload(config)
+            except Exception:
+                logger.exception("Polling the vector index manifest failed")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Publish a vector store snapshot")
+    parser.add_argument("--bucket", default=os.getenv("STORAGE_BUCKET_NAME"))
+    parser.add_argument("--db-path", required=True)
+    parser.add_argument("--version", required=True)
+    parser.add_argument("--prefix", default=DEFAULT_PREFIX)
+    args = parser.parse_args()
+    publish_version(get_bucket(args.bucket), args.db_path, args.version, args.prefix)
@@ -0,0 +1,117 @@
+"""Re-embeds the chunks of a vector store with another embedding backend, into a new vector store.
+
+The chunks are read from the docstore in FAISS position order, embedded in batches and indexed as
+the chosen variant (see app.index.variants), with the metric of the source index. The docstore
+and BM25 files are copied over unchanged, as the positions are kept, and the backend that built
+the index is recorded in `embedding_backend.json`: the server refuses to load the new store with
+any other backend (see app.index.store).
+
+Example, for the local ONNX backend (EMBEDDING_BACKEND=local, EMBEDDING_MODEL_PATH=<model dir>):
+    python -m app.index.rebuild --db-path vector_database --output vector_database_local \
+        --backend local --model-path models/multilingual-e5-small --document-prefix "passage: " \
+        --quantize
+"""
+
+import argparse
+import logging
+import os
+import pickle
+import shutil
+import time
+
+import faiss
+import numpy as np
+
+from app.api.embeddings import backend_spec, create_embeddings, quantize_model
+from app.index.bm25 import BM25_FILENAME
+from app.index.docstore import DOCSTORE_FILENAME, SqliteDocstore
+from app.index.store import read_index, write_embedding_backend
+from app.index.variants import VARIANTS, build_variant
+
+logger = logging.getLogger(__name__)
+
+
+def load_docstore(db_path):
+    sqlite_path = os.path.join(db_path, DOCSTORE_FILENAME)
+    if os.path.exists(sqlite_path):
+        docstore = SqliteDocstore(sqlite_path)
+        return docstore, docstore.index_to_docstore_id()
+    with open(os.path.join(db_path, "index.pkl"), "rb") as f:
+        return pickle.load(f)
+
+
+def iter_text_batches(docstore, index_to_docstore_id, batch_size):
+    """The page contents of the chunks, in FAISS position order."""
+    n_chunks = len(index_to_docstore_id)
+    for start in range(0, n_chunks, batch_size):
+        positions = range(start, min(start + batch_size, n_chunks))
+        yield [
+            docstore.search(index_to_docstore_id[position]).page_content for position in positions
+        ]
+
+
+def rebuild_index(db_path, output_path, embeddings, variant="flat", batch_size=256, **kwargs):
+    if os.path.abspath(db_path) == os.path.abspath(output_path):
+        raise ValueError("Write the rebuilt vector store to a new directory")
+    source_index = read_index(os.path.join(db_path, "index.faiss"))
+    docstore, index_to_docstore_id = load_docstore(db_path)
+    if len(index_to_docstore_id) != source_index.ntotal:
+        raise ValueError(
+            f"The docstore has {len(index_to_docstore_id)} chunks, the index {source_index.ntotal}"
+        )
+
+    start = time.perf_counter()
+    vectors, n_done = [], 0
+    for texts in iter_text_batches(docstore, index_to_docstore_id, batch_size):
+        vectors.append(np.asarray(embeddings.embed_documents(texts), dtype=np.float32))
+        n_done += len(texts)
+        logger.info(f"Embedded {n_done}/{source_index.ntotal} chunks")
+    vectors = np.concatenate(vectors)
+    seconds = time.perf_counter() - start
+    logger.info(f"Embedded {len(vectors)} chunks in {seconds:.1f}s")
+    index = build_variant(vectors, variant, metric=source_index.metric_type, **kwargs)
+
+    os.makedirs(output_path, exist_ok=True)
+    for name in ("index.pkl", DOCSTORE_FILENAME, BM25_FILENAME):
+        if os.path.exists(os.path.join(db_path, name)):
+            shutil.copy2(os.path.join(db_path, name), os.path.join(output_path, name))
+    faiss.write_index(index, os.path.join(output_path, "index.faiss"))
+    write_embedding_backend(
+        output_path,
+        {
+            **backend_spec(embeddings),
+            "dimension": index.d,
+            "document_prefix": getattr(embeddings, "document_prefix", ""),
+            "variant": variant,
+        },
+    )
+    logger.info(f"Wrote the {variant} index of {index.ntotal} re-embedded chunks to {output_path}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Re-embed a vector store with another backend")
+    parser.add_argument("--db-path", default=os.getenv("VECTOR_DB_PATH"))
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--backend", choices=("openai", "local"), default="local")
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL"), help="OpenAI model")
+    parser.add_argument("--model-path", default=os.getenv("EMBEDDING_MODEL_PATH"))
+    parser.add_argument("--document-prefix", default="", help='e.g. "passage: " for E5 models')
+    parser.add_argument("--quantize", action="store_true", help="Write and use the int8 model")
+    parser.add_argument("--variant", choices=VARIANTS, default="flat")
+    parser.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args()
+    if args.quantize:
+        quantize_model(args.model_path)
+    rebuild_index(
+        args.db_path,
+        args.output,
+        create_embeddings(
+            args.backend,
+            model=args.model,
+            model_path=args.model_path,
+            document_prefix=args.document_prefix,
+        ),
+        variant=args.variant,
+        batch_size=args.batch_size,
+    )
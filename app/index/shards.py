@@ -0,0 +1,255 @@
+"""Per-law-family shards of the FAISS index, with a router picking the shards a query needs.
+
+Every chunk belongs to the shard of its law family: the first law abbreviation in its
+`details_href_name` (or `raw_filepath`), without the version suffix, e.g. "ZDDV" for "ZDDV-1" and
+"ZDDV-1A". Chunks without one go to the "other" shard. Each shard is a flat index of its chunks'
+vectors (`shard_<i>.faiss`, with the metric of the main index) mapped back to the FAISS positions
+of the main index, so the docstore and the BM25 index are shared. The shard names, aliases,
+positions and centroids are stored in `shards.npz`, all next to `index.faiss`.
+
+A query is routed to:
+- the shards of the requested sources (the source filter of the API), if any
+- else the shards whose abbreviation (or alias, e.g. "ddv") it mentions
+- else, with a centroid margin set, the shards whose centroid is within the margin of the most
+  similar one, if there are at most `max_shards` of them
+- else the whole main index
+The routed shards are searched in parallel and their hits merged.
+
+Build the shards of a vector store:
+    python -m app.index.shards --db-path vector_database --alias ZDDV="davek na dodano vrednost,ddv"
+"""
+
+import argparse
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import faiss
+import numpy as np
+
+from app.api.metrics import SHARD_ROUTES
+from app.index.bm25 import fold
+
+logger = logging.getLogger(__name__)
+
+SHARDS_FILENAME = "shards.npz"
+OTHER_SHARD = "other"
+
+# Law abbreviations, e.g. "ZDoh-2", "ZDDV-1A", "ZDavNepr": at least two capitals, then the version
+LAW_PATTERN = re.compile(
+    r"\b([A-ZČŠŽ][A-Za-zČŠŽčšž]*[A-ZČŠŽ][A-Za-zČŠŽčšž]*)"  # the law family
+    r"(?:-\d+[A-Z]?)?\b"
+)
+
+
+def law_family(text: Optional[str]) -> Optional[str]:
+    match = LAW_PATTERN.search(text or "")
+    return match.group(1) if match else None
+
+
+def chunk_family(metadata) -> str:
+    return (
+        law_family(metadata.get("details_href_name"))
+        or law_family(metadata.get("raw_filepath"))
+        or OTHER_SHARD
+    )
+
+
+def shard_filename(shard):
+    return f"shard_{shard}.faiss"
+
+
+class ShardIndex:
+    def __init__(self, names, aliases, indexes, positions, centroids, metric):
+        self.names = list(names)  # shard i holds the law family names[i]
+        self.aliases = aliases  # per shard, the folded phrases routing to it
+        self.indexes = indexes
+        self.positions = positions  # per shard, the FAISS positions of its vectors
+        self.centroids = centroids  # normalized mean vector of each shard
+        self.metric = metric
+        self.shard_of = np.zeros(sum(len(p) for p in positions), dtype=np.int32)
+        for shard, shard_positions in enumerate(positions):
+            self.shard_of[shard_positions] = shard
+        self.patterns = []
+        for name, shard_aliases in zip(self.names, aliases):
+            parts = [rf"(?<!\w){re.escape(alias)}(?!\w)" for alias in shard_aliases]
+            if name != OTHER_SHARD:
+                parts.append(rf"(?<!\w){re.escape(fold(name))}(?:-\d+\w*)?(?!\w)")
+            self.patterns.append(re.compile("|".join(parts)) if parts else None)
+        self._executor = None
+        self._pid = None
+
+    @property
+    def executor(self):
+        # Threads do not survive a fork (gunicorn workers forked from a master that preloaded the
+        # index), so each process starts its own
+        if self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(
+                max_workers=len(self.names), thread_name_prefix="shard-search"
+            )
+            self._pid = os.getpid()
+        return self._executor
+
+    def resolve(self, sources: List[str]) -> List[int]:
+        """The shards of the sources, given as law abbreviations or names. ValueError if unknown."""
+        shards = set()
+        for source in sources:
+            family = law_family(source) or source
+            if family not in self.names:
+                raise ValueError(f"Unknown source {source}, expected one of {self.names}")
+            shards.add(self.names.index(family))
+        return sorted(shards)
+
+    def route(self, query, query_embedding, sources=None, centroid_margin=None, max_shards=3):
+        """The shards to search for the query, None for the whole index."""
+        if sources:
+            SHARD_ROUTES.labels("filter").inc()
+            return self.resolve(sources)
+        folded = fold(query)
+        mentioned = [
+            shard
+            for shard, pattern in enumerate(self.patterns)
+            if pattern is not None and pattern.search(folded)
+        ]
+        if mentioned:
+            SHARD_ROUTES.labels("keyword").inc()
+            return mentioned
+        if centroid_margin is not None and len(self.names) > max_shards:
+            vector = np.asarray(query_embedding, dtype=np.float32)
+            similarities = self.centroids @ (vector / np.linalg.norm(vector))
+            order = np.argsort(-similarities)
+            # Confident only if the shards within the margin are all among the top max_shards
+            if similarities[order[max_shards]] < similarities[order[0]] - centroid_margin:
+                SHARD_ROUTES.labels("centroid").inc()
+                cutoff = similarities[order[0]] - centroid_margin
+                return sorted(
+                    int(shard) for shard in order[:max_shards] if similarities[shard] >= cutoff
+                )
+        SHARD_ROUTES.labels("all").inc()
+        return None
+
+    def search(self, vectors, k, routes):
+        """Searches each query's routed shards, in parallel across shards. Returns the scores and
+        FAISS positions like a FAISS search, the queries routed to None are left empty (-1)."""
+        n_queries = len(vectors)
+        larger_is_better = self.metric == faiss.METRIC_INNER_PRODUCT
+        worst = -np.inf if larger_is_better else np.inf
+        scores = np.full((n_queries, k), worst, dtype=np.float32)
+        indices = np.full((n_queries, k), -1, dtype=np.int64)
+
+        queries_of = {}
+        for query, route in enumerate(routes):
+            for shard in route or ():
+                queries_of.setdefault(shard, []).append(query)
+        futures = {
+            shard: self.executor.submit(self.indexes[shard].search, vectors[queries], k)
+            for shard, queries in queries_of.items()
+        }
+        hits = [[] for _ in range(n_queries)]
+        for shard, future in futures.items():
+            shard_scores, shard_indices = future.result()
+            for query, row_scores, row_indices in zip(
+                queries_of[shard], shard_scores, shard_indices
+            ):
+                hits[query].extend(
+                    (float(score), int(self.positions[shard][i]))
+                    for score, i in zip(row_scores, row_indices)
+                    if i != -1
+                )
+        for query, query_hits in enumerate(hits):
+            query_hits.sort(reverse=larger_is_better)
+            for rank, (score, position) in enumerate(query_hits[:k]):
+                scores[query, rank] = score
+                indices[query, rank] = position
+        return scores, indices
+
+    def mask(self, shards):
+        """Boolean mask of the FAISS positions in the shards."""
+        return np.isin(self.shard_of, shards)
+
+
+def load_shard_index(db_path, mmap=True):
+    from app.index.store import read_index
+
+    path = os.path.join(db_path, SHARDS_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        names = [str(name) for name in data["names"]]
+        aliases = [[alias for alias in str(a).split("\n") if alias] for a in data["aliases"]]
+        offsets = data["offsets"]
+        positions = [data["positions"][offsets[i] : offsets[i + 1]] for i in range(len(names))]
+        centroids = data["centroids"]
+    indexes = [
+        read_index(os.path.join(db_path, shard_filename(shard)), mmap=mmap)
+        for shard in range(len(names))
+    ]
+    return ShardIndex(names, aliases, indexes, positions, centroids, indexes[0].metric_type)
+
+
+def build_shards(db_path, aliases=None):
+    """Splits the index of the vector store into the shards of its law families."""
+    from app.index.store import load_vector_store
+    from app.index.variants import build_variant, extract_vectors
+
+    db = load_vector_store(db_path, None, mmap=False)
+    families = np.array(
+        [
+            chunk_family(db.docstore.search(db.index_to_docstore_id[position]).metadata)
+            for position in range(db.index.ntotal)
+        ]
+    )
+    vectors = extract_vectors(db.index)
+    names = sorted(str(family) for family in set(families))
+    aliases = aliases or {}
+    shard_positions, centroids = [], []
+    for shard, name in enumerate(names):
+        positions = np.flatnonzero(families == name)
+        shard_vectors = vectors[positions]
+        index = build_variant(shard_vectors, "flat", metric=db.index.metric_type)
+        faiss.write_index(index, os.path.join(db_path, shard_filename(shard)))
+        centroid = shard_vectors.mean(axis=0)
+        centroids.append(centroid / np.linalg.norm(centroid))
+        shard_positions.append(positions)
+        logger.info(f"Shard {shard} ({name}): {len(positions)} chunks")
+
+    tmp_path = os.path.join(db_path, SHARDS_FILENAME + ".tmp.npz")
+    np.savez(
+        tmp_path,
+        names=np.array(names, dtype=str),
+        aliases=np.array(
+            ["\n".join(fold(alias) for alias in aliases.get(name, [])) for name in names], dtype=str
+        ),
+        offsets=np.cumsum([0] + [len(positions) for positions in shard_positions]),
+        positions=np.concatenate(shard_positions).astype(np.int64),
+        centroids=np.stack(centroids).astype(np.float32),
+    )
+    os.replace(tmp_path, os.path.join(db_path, SHARDS_FILENAME))
+    logger.info(f"Built {len(names)} shards of {db.index.ntotal} chunks in {db_path}")
+    return names
+
+
+def parse_aliases(values):
+    # ["ZDDV=davek na dodano vrednost,ddv", ...] -> {"ZDDV": ["davek na dodano vrednost", "ddv"]}
+    aliases = {}
+    for value in values or []:
+        name, phrases = value.split("=", 1)
+        aliases.setdefault(name.strip(), []).extend(
+            phrase.strip() for phrase in phrases.split(",") if phrase.strip()
+        )
+    return aliases
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Split the FAISS index into law family shards")
+    parser.add_argument("--db-path", default=os.getenv("VECTOR_DB_PATH"))
+    parser.add_argument(
+        "--alias",
+        action="append",
+        help='Phrases routing to a shard, e.g. ZDDV="ddv,davek na dodano"',
+    )
+    args = parser.parse_args()
+    build_shards(args.db_path, parse_aliases(args.alias))
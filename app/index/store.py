@@ -0,0 +1,91 @@
+"""Loading of the FAISS vector store used for retrieval."""
+
+import json
+import logging
+import os
+import pickle
+
+import faiss
+from langchain_community.vectorstores.faiss import FAISS
+
+from app.api.embeddings import backend_spec
+from app.index.bm25 import load_bm25_index
+from app.index.docstore import DOCSTORE_FILENAME, SqliteDocstore
+from app.index.shards import load_shard_index
+
+logger = logging.getLogger(__name__)
+
+# Memory-map the flat codes (IndexFlat*, IndexScalarQuantizer, HNSW storage, ...). Older FAISS
+# releases only know the IVF flag.
+MMAP_FLAGS = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+# IVF inverted lists can only be memory-mapped with the plain mmap flag
+IVF_MMAP_FLAGS = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+# The embedding backend that built the index (see app.index.rebuild)
+EMBEDDING_BACKEND_FILENAME = "embedding_backend.json"
+
+
+class EmbeddingBackendMismatch(ValueError):
+    pass
+
+
+def read_index(path, mmap=True):
+    if not mmap:
+        return faiss.read_index(path)
+    try:
+        return faiss.read_index(path, MMAP_FLAGS)
+    except RuntimeError:
+        return faiss.read_index(path, IVF_MMAP_FLAGS)
+
+
+def write_embedding_backend(db_path, spec):
+    with open(os.path.join(db_path, EMBEDDING_BACKEND_FILENAME), "w") as f:
+        json.dump(spec, f, indent=2)
+
+
+def read_embedding_backend(db_path):
+    path = os.path.join(db_path, EMBEDDING_BACKEND_FILENAME)
+    if not os.path.exists(path):
+        # Stores built before the backends were recorded were all embedded by OpenAI
+        return {"backend": "openai", "model": None}
+    with open(path) as f:
+        return json.load(f)
+
+
+def check_embedding_backend(db_path, embeddings, index):
+    """Raises EmbeddingBackendMismatch unless the index was built by the backend of `embeddings`."""
+    built_by = read_embedding_backend(db_path)
+    spec = backend_spec(embeddings)
+    mismatch = built_by["backend"] != spec["backend"] or (
+        None not in (built_by.get("model"), spec["model"]) and built_by["model"] != spec["model"]
+    )
+    if mismatch or built_by.get("dimension", index.d) != index.d:
+        raise EmbeddingBackendMismatch(
+            f"The index in {db_path} was built by the {built_by} embeddings, it cannot serve "
+            f"queries embedded by {spec}"
+        )
+
+
+def load_vector_store(db_path, embeddings, mmap=True, **kwargs):
+    """Loads the vector store, preferring the memory-mapped index and the SQLite docstore.
+
+    Falls back to the pickled langchain docstore when the store has not been converted yet. The
+    BM25 sidecar and the shards, if built, are attached as `db.bm25_index` and `db.shard_index`, so
+    they are swapped together with the index.
+    Refuses (EmbeddingBackendMismatch) an index built by another embedding backend or model.
+    """
+    index = read_index(os.path.join(db_path, "index.faiss"), mmap=mmap)
+    if embeddings is not None:
+        # Tools that only read the chunks pass no embeddings
+        check_embedding_backend(db_path, embeddings, index)
+    sqlite_path = os.path.join(db_path, DOCSTORE_FILENAME)
+    if os.path.exists(sqlite_path):
+        docstore = SqliteDocstore(sqlite_path)
+        index_to_docstore_id = docstore.index_to_docstore_id()
+    else:
+        logger.info("No SQLite docstore found, unpickling the langchain docstore")
+        with open(os.path.join(db_path, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+    db = FAISS(embeddings, index, docstore, index_to_docstore_id, **kwargs)
+    db.bm25_index = load_bm25_index(db_path)
+    db.shard_index = load_shard_index(db_path, mmap=mmap)
+    return db
@@ -0,0 +1,98 @@
+"""Index upgrade step that precomputes the context block of every chunk.
+
+Each document in the docstore gets its rendered `Source/Link/Text` block and the block's token count
+written into its metadata, so the context packing on the request path needs no tokenization. Both
+the pickled docstore and, if the store was converted (app.index.docstore), the SQLite one that the
+server loads instead are upgraded.
+
+Example:
+    python -m app.index.upgrade --db-path vector_database --embedding-model text-embedding-3-small
+"""
+
+import argparse
+import json
+import logging
+import os
+import pickle
+import shutil
+import sqlite3
+
+from langchain_core.documents import Document
+
+from app.api.retrieval import (
+    CONTEXT_BLOCK_KEY,
+    CONTEXT_TOKENS_KEY,
+    get_encoder,
+    render_context_block,
+)
+from app.index.docstore import DOCSTORE_FILENAME
+
+logger = logging.getLogger(__name__)
+
+
+def add_context_metadata(documents, embedding_model):
+    enc = get_encoder(embedding_model)
+    for doc in documents:
+        block = render_context_block(doc.page_content, doc.metadata)
+        doc.metadata[CONTEXT_BLOCK_KEY] = block
+        doc.metadata[CONTEXT_TOKENS_KEY] = len(enc.encode(block))
+
+
+def upgrade_pickle_docstore(pkl_path, embedding_model):
+    """Rewrites the pickled docstore of a langchain FAISS index with the precomputed metadata."""
+    with open(pkl_path, "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+
+    add_context_metadata(docstore._dict.values(), embedding_model)
+
+    tmp_path = pkl_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump((docstore, index_to_docstore_id), f)
+    os.replace(tmp_path, pkl_path)
+    logger.info(f"Precomputed the context blocks of {len(docstore._dict)} chunks in {pkl_path}")
+
+
+def upgrade_sqlite_docstore(sqlite_path, embedding_model):
+    """Rewrites the metadata of a SQLite docstore with the precomputed metadata."""
+    # Updated on a copy, the servers reading the file keep the old one until they reload
+    tmp_path = sqlite_path + ".tmp"
+    shutil.copyfile(sqlite_path, tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    documents = [
+        Document(id=doc_id, page_content=page_content, metadata=json.loads(metadata))
+        for doc_id, page_content, metadata in conn.execute(
+            "SELECT doc_id, page_content, metadata FROM docs"
+        )
+    ]
+    add_context_metadata(documents, embedding_model)
+    conn.executemany(
+        "UPDATE docs SET metadata = ? WHERE doc_id = ?",
+        ((json.dumps(doc.metadata, ensure_ascii=False), doc.id) for doc in documents),
+    )
+    conn.commit()
+    conn.close()
+    os.replace(tmp_path, sqlite_path)
+    logger.info(f"Precomputed the context blocks of {len(documents)} chunks in {sqlite_path}")
+
+
+def upgrade_index(db_path, embedding_model):
+    """Writes the precomputed metadata into every docstore of a langchain FAISS index."""
+    pkl_path = os.path.join(db_path, "index.pkl")
+    sqlite_path = os.path.join(db_path, DOCSTORE_FILENAME)
+    if not os.path.exists(pkl_path) and not os.path.exists(sqlite_path):
+        raise FileNotFoundError(f"No index.pkl or {DOCSTORE_FILENAME} docstore in {db_path}")
+    if os.path.exists(pkl_path):
+        upgrade_pickle_docstore(pkl_path, embedding_model)
+    if os.path.exists(sqlite_path):
+        upgrade_sqlite_docstore(sqlite_path, embedding_model)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Precompute context blocks and token counts")
+    parser.add_argument("--db-path", default=os.getenv("VECTOR_DB_PATH"))
+    parser.add_argument(
+        "--embedding-model", default=os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+    )
+    args = parser.parse_args()
+    upgrade_index(args.db_path, args.embedding_model)
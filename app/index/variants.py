@@ -0,0 +1,116 @@
+"""Approximate and compressed variants of the flat FAISS index.
+
+The vectors are read back from the existing (flat) index of a vector store and re-indexed as one of:
+    hnsw:     IndexHNSWFlat, graph search tuned at query time with efSearch
+    ivf_flat: IndexIVFFlat, inverted lists tuned at query time with nprobe
+    ivf_pq:   IndexIVFPQ, product-quantized inverted lists, also tuned with nprobe
+    sq8:      IndexScalarQuantizer with int8 codes, exhaustive search on 4x smaller codes
+
+The docstore files are copied over unchanged, as the variants keep the FAISS positions.
+
+Example:
+    python -m app.index.variants --db-path vector_database --output vector_database_hnsw \
+        --variant hnsw
+"""
+
+import argparse
+import logging
+import math
+import os
+import shutil
+
+import faiss
+
+from app.index.docstore import DOCSTORE_FILENAME
+from app.index.store import EMBEDDING_BACKEND_FILENAME, read_index
+
+logger = logging.getLogger(__name__)
+
+VARIANTS = ("flat", "hnsw", "ivf_flat", "ivf_pq", "sq8")
+
+
+def extract_vectors(index):
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def default_nlist(n_vectors):
+    # ~4 sqrt(n) lists, with enough training points per centroid for k-means
+    return max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39))
+
+
+def default_pq_m(dimension):
+    # Sub-quantizers of 16 dimensions (e.g. 96 bytes per 1536-d vector), m has to divide d
+    m = max(1, dimension // 16)
+    while dimension % m != 0:
+        m -= 1
+    return m
+
+
+def build_variant(vectors, variant, metric=faiss.METRIC_L2, nlist=None, pq_m=None, hnsw_m=32):
+    n_vectors, dimension = vectors.shape
+    if variant == "flat":
+        index = faiss.IndexFlat(dimension, metric)
+    elif variant == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, hnsw_m, metric)
+        index.hnsw.efConstruction = 200
+    elif variant in ("ivf_flat", "ivf_pq"):
+        nlist = nlist or default_nlist(n_vectors)
+        quantizer = faiss.IndexFlat(dimension, metric)
+        if variant == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist, metric)
+        else:
+            index = faiss.IndexIVFPQ(
+                quantizer, dimension, nlist, pq_m or default_pq_m(dimension), 8, metric
+            )
+    elif variant == "sq8":
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, metric)
+    else:
+        raise ValueError(f"Unknown index variant {variant}, expected one of {VARIANTS}")
+
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def apply_search_params(index, nprobe=None, ef_search=None):
+    """Sets the query time knobs of the IVF and HNSW variants, ignored by the other indexes."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and nprobe is not None:
+        ivf.nprobe = nprobe
+    index = faiss.downcast_index(index)
+    if hasattr(index, "hnsw") and ef_search is not None:
+        index.hnsw.efSearch = ef_search
+
+
+def write_variant(db_path, output_path, variant, **kwargs):
+    source_index = read_index(os.path.join(db_path, "index.faiss"), mmap=False)
+    vectors = extract_vectors(source_index)
+    index = build_variant(vectors, variant, metric=source_index.metric_type, **kwargs)
+
+    os.makedirs(output_path, exist_ok=True)
+    for name in ("index.pkl", DOCSTORE_FILENAME, EMBEDDING_BACKEND_FILENAME):
+        if os.path.exists(os.path.join(db_path, name)):
+            shutil.copy2(os.path.join(db_path, name), os.path.join(output_path, name))
+    faiss.write_index(index, os.path.join(output_path, "index.faiss"))
+    logger.info(f"Wrote the {variant} variant of {index.ntotal} vectors to {output_path}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build an approximate FAISS index variant")
+    parser.add_argument("--db-path", default=os.getenv("VECTOR_DB_PATH"))
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--variant", choices=VARIANTS, required=True)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--pq-m", type=int, default=None)
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    args = parser.parse_args()
+    write_variant(
+        args.db_path,
+        args.output,
+        args.variant,
+        nlist=args.nlist,
+        pq_m=args.pq_m,
+        hnsw_m=args.hnsw_m,
+    )
@@ -0,0 +1,97 @@
+import base64
+import hashlib
+import os
+import shutil
+
+import google_crc32c
+
+"""A local directory that stands in for a GCS bucket (e.g. STORAGE_BUCKET_NAME=file:///tmp/bucket).
+
+Implements the subset of the `google.cloud.storage` Bucket and Blob API used by the storage utils,
+including the base64 encoded CRC32C/MD5 checksums GCS reports for every object.
+"""
+
+
+def file_checksums(path, chunk_size=1 << 20):
+    crc32c = google_crc32c.Checksum()
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            crc32c.update(chunk)
+            md5.update(chunk)
+    return base64.b64encode(crc32c.digest()).decode(), base64.b64encode(md5.digest()).decode()
+
+
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.root, name)
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    @property
+    def crc32c(self):
+        return file_checksums(self.path)[0]
+
+    @property
+    def md5_hash(self):
+        return file_checksums(self.path)[1]
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def download_to_file(self, file_obj, start=None, end=None, checksum="md5"):
+        # Like GCS, `end` is inclusive
+        with open(self.path, "rb") as f:
+            f.seek(start or 0)
+            remaining = None if end is None else end - (start or 0) + 1
+            while remaining is None or remaining > 0:
+                chunk = f.read(1 << 20 if remaining is None else min(1 << 20, remaining))
+                if not chunk:
+                    break
+                file_obj.write(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+
+    def download_to_filename(self, filename, start=None, end=None):
+        with open(filename, "wb") as f:
+            self.download_to_file(f, start=start, end=end)
+
+    def download_as_bytes(self, start=None, end=None):
+        with open(self.path, "rb") as f:
+            f.seek(start or 0)
+            return f.read(-1 if end is None else end - (start or 0) + 1)
+
+    def upload_from_filename(self, filename):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, self.path)
+
+    def upload_from_string(self, data):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as f:
+            f.write(data.encode() if isinstance(data, str) else data)
+
+
+class LocalBucket:
+    def __init__(self, root):
+        self.root = root
+        self.name = root
+
+    def blob(self, blob_name):
+        return LocalBlob(self, blob_name)
+
+    def list_blobs(self, prefix="", max_results=None):
+        names = []
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                name = os.path.relpath(os.path.join(directory, filename), self.root)
+                name = name.replace(os.sep, "/")
+                if name.startswith(prefix):
+                    names.append(name)
+        names.sort()
+        if max_results is not None:
+            names = names[:max_results]
+        return [LocalBlob(self, name) for name in names]
@@ -1,11 +1,21 @@
 import os
-from google.cloud import storage
-import google.auth
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from app.storage.local_bucket import LocalBucket, file_checksums
 
 """Utils for interacting with Google Cloud Storage (GCS)."""
 
+logger = logging.getLogger(__name__)
+
+LOCAL_BUCKET_PREFIX = "file://"
+
 
 def authenticate_gcs(local=False):
+    # Imported on first use, most processes (local buckets, the benchmarks) never need them
+    from google.cloud import storage
+    import google.auth
+
     if not local:
         client = storage.Client()  # when running on GCP it will automatically authenticate
     else:
@@ -23,10 +33,22 @@ def authenticate_gcs(local=False):
     return client
 
 
+@functools.lru_cache(maxsize=None)
+def get_storage_client(local=False):
+    """Returns the GCS client of the process, authenticated once."""
+    return authenticate_gcs(local=local)
+
+
+def get_bucket(bucket_name, local=False):
+    """Returns the bucket, or a local directory standing in for it if named file://<path>."""
+    if bucket_name.startswith(LOCAL_BUCKET_PREFIX):
+        return LocalBucket(bucket_name[len(LOCAL_BUCKET_PREFIX) :])
+    return get_storage_client(local=local).bucket(bucket_name)
+
+
 def upload_folder_to_bucket(bucket_name, folder_path, destination_blob_folder, local=False):
     """Uploads a folder and its contents to the bucket, maintaining the folder structure."""
-    storage_client = authenticate_gcs(local=local)
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name, local=local)
 
     for local_file in os.listdir(folder_path):
         local_file_path = os.path.join(folder_path, local_file)
@@ -44,8 +66,7 @@ def upload_folder_to_bucket(bucket_name, folder_path, destination_blob_folder, l
 
 def upload_blob(bucket_name, source_file_name, destination_blob_name, local=False):
     """Uploads a file to the bucket."""
-    storage_client = authenticate_gcs(local=local)
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name, local=local)
     blob = bucket.blob(destination_blob_name)
 
     blob.upload_from_filename(source_file_name)
@@ -54,8 +75,7 @@ def upload_blob(bucket_name, source_file_name, destination_blob_name, local=Fals
 
 def download_blob(bucket_name, source_blob_name, destination_file_name, local=False):
     """Downloads a blob from the bucket to a local file."""
-    storage_client = authenticate_gcs(local=local)
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name, local=local)
     blob = bucket.blob(source_blob_name)
 
     if blob.exists():
@@ -65,32 +85,122 @@ def download_blob(bucket_name, source_blob_name, destination_file_name, local=Fa
 
 def download_folder(bucket_name, folder_prefix, local_destination_dir, local=False):
     """Downloads all blobs in a folder from the bucket to a local directory."""
-    storage_client = authenticate_gcs(local=local)
-    bucket = storage_client.bucket(bucket_name)
-
-    # Ensure the folder_prefix ends with a '/' to properly match all objects within the folder
+    bucket = get_bucket(bucket_name, local=local)
+    return sync_folder(bucket, folder_prefix, local_destination_dir)
+
+
+def is_blob_up_to_date(blob, local_file_path):
+    """Check if the local file has the size and CRC32C (or MD5) checksum of the blob."""
+    if not os.path.isfile(local_file_path) or os.path.getsize(local_file_path) != blob.size:
+        return False
+    crc32c, md5_hash = file_checksums(local_file_path)
+    if blob.crc32c is not None:
+        return crc32c == blob.crc32c
+    return blob.md5_hash is not None and md5_hash == blob.md5_hash
+
+
+def _download_range(blob, tmp_file_path, start, end):
+    with open(tmp_file_path, "r+b") as f:
+        f.seek(start)
+        # The checksum of the whole file is verified once all its ranges are downloaded
+        blob.download_to_file(f, start=start, end=end, checksum=None)
+
+
+def sync_folder(
+    bucket,
+    folder_prefix,
+    local_destination_dir,
+    max_workers=8,
+    chunk_size=32 << 20,
+    remove_extra=False,
+):
+    """Mirrors a folder of the bucket into a local directory.
+
+    Files whose checksum already matches the blob are skipped. The others are downloaded
+    concurrently, large blobs in ranges of `chunk_size` bytes, into temporary files that are
+    verified against the blob checksum and then atomically renamed, so an interrupted sync never
+    leaves a partial file in place of a good one. With `remove_extra`, the local files that are
+    not in the bucket folder are removed once the downloads succeeded. Only use it on a directory
+    that holds nothing but the bucket copy, as it also removes the sidecars built locally.
+    """
     if not folder_prefix.endswith("/"):
         folder_prefix += "/"
 
-    blobs = bucket.list_blobs(prefix=folder_prefix)
-    for blob in blobs:
-        # Construct the local filepath to save the downloaded file
-        local_file_path = os.path.join(
-            local_destination_dir, blob.name[len(folder_prefix) :]
-        )  # noqa: E203
-
-        # Create any necessary directories for nested objects
-        os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
-
-        # Download the blob to the local_file_path
-        blob.download_to_filename(local_file_path)
-        print(f"Downloaded {blob.name} to {local_file_path}.")
+    blobs = [
+        blob for blob in bucket.list_blobs(prefix=folder_prefix) if not blob.name.endswith("/")
+    ]
+    local_file_paths = [
+        os.path.join(local_destination_dir, blob.name[len(folder_prefix) :]) for blob in blobs
+    ]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        up_to_date = list(executor.map(is_blob_up_to_date, blobs, local_file_paths))
+        downloads = [
+            (blob, local_file_path)
+            for blob, local_file_path, skip in zip(blobs, local_file_paths, up_to_date)
+            if not skip
+        ]
+
+        # Preallocate the temporary files and split them into ranges
+        ranges = []
+        for blob, local_file_path in downloads:
+            os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
+            tmp_file_path = local_file_path + ".download"
+            with open(tmp_file_path, "wb") as f:
+                f.truncate(blob.size)
+            for start in range(0, blob.size, chunk_size):
+                end = min(start + chunk_size, blob.size) - 1
+                ranges.append((blob, tmp_file_path, start, end))
+
+        futures = []
+        try:
+            futures = [executor.submit(_download_range, *blob_range) for blob_range in ranges]
+            for future in futures:
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            for _, local_file_path in downloads:
+                if os.path.exists(local_file_path + ".download"):
+                    os.remove(local_file_path + ".download")
+            raise
+
+    for blob, local_file_path in downloads:
+        tmp_file_path = local_file_path + ".download"
+        if not is_blob_up_to_date(blob, tmp_file_path):
+            os.remove(tmp_file_path)
+            raise IOError(f"Checksum mismatch after downloading {blob.name}")
+        os.replace(tmp_file_path, local_file_path)
+        logger.info(f"Downloaded {blob.name} to {local_file_path}.")
+
+    removed = []
+    if remove_extra:
+        removed = remove_extra_files(local_destination_dir, local_file_paths)
+
+    logger.info(
+        f"Synced {folder_prefix} to {local_destination_dir}: {len(downloads)} downloaded, "
+        f"{len(blobs) - len(downloads)} already up to date, {len(removed)} removed"
+    )
+    return [blob.name for blob, _ in downloads]
+
+
+def remove_extra_files(local_dir, keep_paths):
+    """Removes the files under local_dir that are not in keep_paths, returns their paths."""
+    keep = {os.path.normpath(path) for path in keep_paths}
+    removed = []
+    for dirpath, _, filenames in os.walk(local_dir):
+        for filename in filenames:
+            path = os.path.normpath(os.path.join(dirpath, filename))
+            if path not in keep:
+                os.remove(path)
+                removed.append(path)
+                logger.info(f"Removed {path}, it is no longer in the bucket.")
+    return removed
 
 
 def check_blob_exists(bucket_name, blob_name, local=False):
     """Check if a blob exists in the specified GCS bucket."""
-    storage_client = authenticate_gcs(local=local)
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name, local=local)
     blob = bucket.blob(blob_name)
 
     return blob.exists()
@@ -98,8 +208,7 @@ def check_blob_exists(bucket_name, blob_name, local=False):
 
 def check_folder_exists(bucket_name, folder_name, local=False):
     """Check if any objects exist within the specified 'folder' in the GCS bucket."""
-    storage_client = authenticate_gcs(local=local)
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name, local=local)
 
     # Ensure the folder_name ends with a '/' to properly check the prefix
     if not folder_name.endswith("/"):
@@ -0,0 +1,160 @@
+"""Check of the admission control against fake upstreams that enforce OpenAI-like rate limits.
+
+Sends a burst of two-turn chats (a reformulation and an answer each) to /api/chat, more than the
+fake upstreams' tokens per minute allow, once on a server without and once on a server with the
+admission control (app.api.admission) set to the same limits.
+
+Without it, the calls over the limit fail upstream with a 429 (after the OpenAI client's own
+retries) and the requests fail with a 500. With it, they wait in the admission queue, or are
+rejected right away with a 429 and a Retry-After, and the upstreams see no rate limit errors.
+
+Example:
+    python -m benchmarks.admission_check --requests 60 --tpm-limit 20000
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import tempfile
+import time
+
+import httpx
+import numpy as np
+
+from benchmarks.chat_benchmark import git_commit, start_servers
+from benchmarks.synthetic_index import make_questions
+
+STATS_PATTERN = re.compile(r"^taxgpt_admission_(\w+) (\S+)$", re.M)
+WAIT_PATTERN = re.compile(
+    r'^taxgpt_admission_wait_seconds_(sum|count)\{model="[^"]+"\} (\S+)$', re.M
+)
+
+
+async def send_chat(client, question, outcomes, latencies):
+    messages = [
+        {"role": "user", "content": "Kako se obdavči dohodek iz dejavnosti?"},
+        {"role": "assistant", "content": "Dohodek iz dejavnosti se obdavči z dohodnino."},
+        {"role": "user", "content": question},
+    ]
+    start = time.perf_counter()
+    try:
+        async with client.stream("POST", "/api/chat", json={"messages": messages}) as response:
+            if response.status_code == 429:
+                has_retry_after = response.headers.get("Retry-After", "").isdigit()
+                outcomes["rejected" if has_retry_after else "rejected_without_retry_after"] += 1
+                return
+            if response.status_code != 200:
+                outcomes["failed"] += 1
+                return
+            data = b"".join([chunk async for chunk in response.aiter_raw()])
+    except (httpx.HTTPError, httpx.StreamError):
+        outcomes["failed"] += 1
+        return
+    outcomes["completed" if data.endswith(b"data: [DONE]\n\n") else "failed"] += 1
+    latencies.append(time.perf_counter() - start)
+
+
+async def run(args, url, upstream_url):
+    outcomes = dict.fromkeys(["completed", "rejected", "rejected_without_retry_after", "failed"], 0)
+    latencies = []
+    questions = make_questions(args.requests)
+    limits = httpx.Limits(max_connections=args.requests + 1)
+    async with httpx.AsyncClient(base_url=url, timeout=args.timeout, limits=limits) as client:
+        tasks = []
+        for question in questions:
+            tasks.append(asyncio.create_task(send_chat(client, question, outcomes, latencies)))
+            await asyncio.sleep(args.interval)
+        await asyncio.gather(*tasks)
+        metrics = (await client.get("/metrics")).text
+        upstream_stats = (await client.get(f"{upstream_url}/stats")).json()
+    server_stats = {name: float(value) for name, value in STATS_PATTERN.findall(metrics)}
+    waits = {name: float(value) for name, value in WAIT_PATTERN.findall(metrics)}
+    return {
+        **outcomes,
+        "upstream_rate_limited": upstream_stats["rate_limited"],
+        "upstream_chat_requests": upstream_stats["chat"],
+        "latency_p50_s": float(np.percentile(latencies, 50)) if latencies else None,
+        "latency_p99_s": float(np.percentile(latencies, 99)) if latencies else None,
+        "mean_admission_wait_s": (waits["sum"] / waits["count"] if waits.get("count") else None),
+        "admission_queued": server_stats.get("queued"),
+    }
+
+
+def main(args, upstream_args):
+    limit_args = ["--tpm-limit", str(args.tpm_limit)]
+    if args.rpm_limit:
+        limit_args += ["--rpm-limit", str(args.rpm_limit)]
+    upstream_args = upstream_args + limit_args + ["--answer-tokens", str(args.answer_tokens)]
+    admission_limits = f"gpt-4o={args.tpm_limit}:{args.rpm_limit or ''}"
+    results = {}
+    print(
+        f"{'setup':>12} {'completed':>9} {'429':>5} {'failed':>6} {'upstream 429':>12} "
+        f"{'p50':>7} {'p99':>7} {'mean wait':>9}"
+    )
+    for setup, server_args in (
+        ("unprotected", []),
+        (
+            "admission",
+            ["--admission-limits", admission_limits]
+            + ["--admission-max-wait", str(args.max_wait)]
+            + ["--admission-max-queue", str(args.max_queue)],
+        ),
+    ):
+        server_args = server_args + ["--expected-answer-tokens", str(args.answer_tokens)]
+        processes = []
+        with tempfile.TemporaryDirectory() as workdir:
+            try:
+                url, processes = start_servers(args, upstream_args, workdir, server_args)
+                upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+                result = asyncio.run(run(args, url, upstream_url))
+            finally:
+                for process in processes:
+                    process.terminate()
+                    process.wait()
+        results[setup] = result
+        print(
+            f"{setup:>12} {result['completed']:>9} {result['rejected']:>5} {result['failed']:>6} "
+            f"{result['upstream_rate_limited']:>12} {result['latency_p50_s'] or 0:>6.1f}s "
+            f"{result['latency_p99_s'] or 0:>6.1f}s {result['mean_admission_wait_s'] or 0:>8.2f}s"
+        )
+
+    protected = results["admission"]
+    ok = (
+        protected["failed"] == 0
+        and protected["rejected_without_retry_after"] == 0
+        and protected["upstream_rate_limited"] == 0
+    )
+    print("OK" if ok else "FAILED: the admission control let rate limit errors through")
+
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key != "output"}
+        settings["upstream_args"] = upstream_args
+        with open(args.output, "w") as f:
+            json.dump(
+                {"commit": git_commit(), "settings": settings, "results": results}, f, indent=2
+            )
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Admission control check on rate limited upstreams"
+    )
+    parser.add_argument("--requests", type=int, default=60)
+    parser.add_argument("--interval", type=float, default=0.05, help="Seconds between requests")
+    parser.add_argument("--tpm-limit", type=float, default=20000)
+    parser.add_argument("--rpm-limit", type=float)
+    parser.add_argument("--answer-tokens", type=int, default=120)
+    parser.add_argument("--max-wait", type=float, default=10.0)
+    parser.add_argument("--max-queue", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--db-path", help="Vector store to serve, default: a synthetic one")
+    parser.add_argument("--n-chunks", type=int, default=2000)
+    parser.add_argument("--pipeline-mode", default="speculative")
+    parser.add_argument("--caches", action="store_true")
+    parser.add_argument("--port", type=int, default=8185)
+    parser.add_argument("--upstream-port", type=int, default=9195)
+    parser.add_argument("--output", help="Write the results as JSON")
+    main(*parser.parse_known_args())
@@ -0,0 +1,168 @@
+"""The chat server wired to the fake upstreams and a local vector store, for the benchmarks.
+
+The config mirrors the production one in app.app, except that the OpenAI, embedding and rerank
+clients point at the fake upstreams, and the caches are off unless --caches is given, so that
+every request exercises the whole pipeline.
+
+Under gunicorn (see benchmarks.workers_benchmark) the app is created by `create_bench_app_from_env`,
+with the arguments in the BENCH_SERVER_ARGS environment variable.
+
+Example:
+    python -m benchmarks.bench_server --db-path /tmp/synthetic_db \
+        --upstream-url http://127.0.0.1:9000
+"""
+
+import argparse
+import logging
+import os
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+
+import uvicorn
+from langchain_openai import OpenAIEmbeddings
+from openai import AsyncOpenAI
+
+from app.app import create_app
+from app.api.admission import AdmissionController, parse_limits
+from app.api.cache import AnswerCache, EmbeddingCache, RerankCache
+from app.api.conversation import ConversationStore
+from app.api.metrics import register_stats_source
+from app.api.openai_interface import Config
+from app.api.capture import RequestCapture
+from app.api.pruning import CandidatePruning
+from app.api.rerank import CohereReranker
+from app.api.resilience import create_resilience
+from app.index.store import load_vector_store
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+
+def load_db(args):
+    embeddings = OpenAIEmbeddings(
+        model=EMBEDDING_MODEL,
+        base_url=f"{args.upstream_url}/v1",
+        api_key="fake",
+        check_embedding_ctx_length=False,
+    )
+    return load_vector_store(args.db_path, embeddings, mmap=not args.no_mmap)
+
+
+def create_config(args, db=None):
+    base_url = f"{args.upstream_url}/v1"
+    config = Config(
+        retrieve_n=args.retrieve_n,
+        rerank_max_n=args.rerank_max_n,
+        max_context_len=4096,
+        model="gpt-4o",
+        client=AsyncOpenAI(base_url=base_url, api_key="fake"),
+        embedding_model=EMBEDDING_MODEL,
+        db=db if db is not None else load_db(args),
+        use_reformulated_question=True,
+        search_executor=ThreadPoolExecutor(max_workers=4, thread_name_prefix="faiss-search"),
+        pipeline_mode=args.pipeline_mode,
+        embedding_cache=EmbeddingCache() if args.caches else None,
+        answer_cache=AnswerCache() if args.caches else None,
+        reranker=CohereReranker(api_key="fake", base_url=args.upstream_url),
+        rerank_cache=RerankCache() if args.caches else None,
+        conversation_store=ConversationStore() if args.conversation_store else None,
+        history_token_budget=args.history_token_budget,
+        admission=(
+            AdmissionController(
+                parse_limits(args.admission_limits),
+                max_queue=args.admission_max_queue,
+                max_wait=args.admission_max_wait,
+            )
+            if args.admission_limits
+            else None
+        ),
+        expected_answer_tokens=args.expected_answer_tokens,
+        resilience=(
+            create_resilience(
+                {
+                    "embed": args.embed_deadline,
+                    "rerank": args.rerank_deadline,
+                    "reformulate": args.reformulate_deadline,
+                },
+                hedge_quantile=args.hedge_quantile or None,
+            )
+            if args.resilience
+            else None
+        ),
+        shard_centroid_margin=args.shard_centroid_margin,
+        pruning=(
+            CandidatePruning(mmr_lambda=args.mmr_lambda or None, mmr_n=args.mmr_n)
+            if args.pruning
+            else None
+        ),
+        capture=(
+            RequestCapture(args.capture_path, sample_rate=args.capture_sample_rate)
+            if args.capture_path
+            else None
+        ),
+    )
+    for name in (
+        "embedding_cache",
+        "answer_cache",
+        "rerank_cache",
+        "reranker",
+        "conversation_store",
+        "admission",
+        "resilience",
+        "pruning",
+        "capture",
+    ):
+        register_stats_source(name, getattr(config, name))
+    return config
+
+
+def create_bench_app(args):
+    # The vector store is loaded when the app is created (in the gunicorn master), the config in
+    # every worker
+    return create_app(
+        preload_index=True,
+        index_loader=lambda: (load_db(args), None, None),
+        config_builder=lambda db, index_version: create_config(args, db),
+    )
+
+
+def create_bench_app_from_env():
+    logging.getLogger().setLevel(logging.WARNING)
+    return create_bench_app(get_parser().parse_args(shlex.split(os.environ["BENCH_SERVER_ARGS"])))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Chat server on the fake upstreams")
+    parser.add_argument("--db-path", required=True)
+    parser.add_argument("--upstream-url", default="http://127.0.0.1:9000")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--pipeline-mode", default="speculative")
+    parser.add_argument("--retrieve-n", type=int, default=25)
+    parser.add_argument("--rerank-max-n", type=int, default=5)
+    parser.add_argument("--caches", action="store_true")
+    parser.add_argument("--conversation-store", action="store_true")
+    parser.add_argument("--history-token-budget", type=int, default=1500)
+    parser.add_argument("--no-mmap", action="store_true", help="Load the FAISS index into memory")
+    parser.add_argument("--admission-limits", help='e.g. "gpt-4o=30000:500", see ADMISSION_LIMITS')
+    parser.add_argument("--admission-max-queue", type=int, default=100)
+    parser.add_argument("--admission-max-wait", type=float, default=10.0)
+    parser.add_argument("--expected-answer-tokens", type=int, default=800)
+    parser.add_argument("--resilience", action="store_true", help="Deadlines, hedging and retries")
+    parser.add_argument("--embed-deadline", type=float, default=3.0)
+    parser.add_argument("--rerank-deadline", type=float, default=3.0)
+    parser.add_argument("--reformulate-deadline", type=float, default=8.0)
+    parser.add_argument("--hedge-quantile", type=float, default=0.95, help="0 disables hedging")
+    parser.add_argument("--shard-centroid-margin", type=float, help="Route by shard centroids")
+    parser.add_argument("--pruning", action="store_true", help="Dedup, MMR and chunk grouping")
+    parser.add_argument("--mmr-lambda", type=float, default=0.7, help="0 disables MMR")
+    parser.add_argument("--mmr-n", type=int)
+    parser.add_argument(
+        "--capture-path", help="Capture the chats for the replay, see app.api.capture"
+    )
+    parser.add_argument("--capture-sample-rate", type=float, default=1.0)
+    return parser
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.WARNING)
+    args = get_parser().parse_args()
+    uvicorn.run(create_bench_app(args), host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,231 @@
+"""Offline latency and throughput benchmark of the chat endpoints.
+
+By default starts the fake upstreams (benchmarks.fake_upstreams) and the chat server on a synthetic
+vector store (benchmarks.bench_server) in subprocesses, then keeps `--concurrency` streams open
+against each endpoint for `--duration` seconds. Pass --url to drive an already running server
+instead. Arguments not listed here are passed on to the fake upstreams (e.g. --token-rate 40).
+
+Reports per endpoint the throughput, TTFB, inter-token latency (the gaps between the streamed
+chunks after the first one) and total latency percentiles, and the server's peak resident memory
+(read from its /metrics). The results are saved as JSON with the commit they were measured on.
+
+Example:
+    python -m benchmarks.chat_benchmark --concurrency 32 --duration 30 --output bench.json \
+        --chat-ttft 0.5:0.4 --error-rate 0.01
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import numpy as np
+
+from benchmarks.synthetic_index import build_synthetic_index, make_questions
+
+
+def percentiles(values, prefix):
+    if not values:
+        return {f"{prefix}_p{p}_ms": None for p in (50, 90, 99)}
+    return {f"{prefix}_p{p}_ms": float(np.percentile(values, p)) * 1000 for p in (50, 90, 99)}
+
+
+async def run_stream(client, endpoint, question):
+    payload = {"messages": [{"role": "user", "content": question}]}
+    start = time.perf_counter()
+    arrivals = []
+    async with client.stream("POST", endpoint, json=payload) as response:
+        response.raise_for_status()
+        async for _ in response.aiter_raw():
+            arrivals.append(time.perf_counter())
+    return start, arrivals
+
+
+async def scrape_rss_mb(client):
+    try:
+        response = await client.get("/metrics")
+        for line in response.text.splitlines():
+            if line.startswith("process_resident_memory_bytes"):
+                return float(line.split()[1]) / 2**20
+    except httpx.HTTPError:
+        pass
+    return None
+
+
+async def run_endpoint(url, endpoint, concurrency, duration, questions, timeout):
+    limits = httpx.Limits(max_connections=concurrency + 1, max_keepalive_connections=concurrency)
+    ttfbs, inter_token, totals, rss = [], [], [], []
+    n_requests, n_errors, n_chunks = 0, 0, 0
+    rng = random.Random(0)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            nonlocal n_requests, n_errors, n_chunks
+            while time.perf_counter() < deadline:
+                n_requests += 1
+                try:
+                    start, arrivals = await run_stream(client, endpoint, rng.choice(questions))
+                except (httpx.HTTPError, httpx.StreamError):
+                    n_errors += 1
+                    continue
+                if not arrivals:
+                    continue
+                ttfbs.append(arrivals[0] - start)
+                totals.append(arrivals[-1] - start)
+                inter_token.extend(np.diff(arrivals).tolist())
+                n_chunks += len(arrivals)
+
+        async def sample_memory():
+            while time.perf_counter() < deadline:
+                rss.append(await scrape_rss_mb(client))
+                await asyncio.sleep(0.5)
+
+        start = time.perf_counter()
+        await asyncio.gather(sample_memory(), *(worker() for _ in range(concurrency)))
+        wall_time = time.perf_counter() - start
+
+    rss = [value for value in rss if value is not None]
+    result = {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": n_requests,
+        "errors": n_errors,
+        "wall_time_s": wall_time,
+        "throughput_rps": (n_requests - n_errors) / wall_time,
+        "chunks_per_s": n_chunks / wall_time,
+        "peak_rss_mb": max(rss) if rss else None,
+    }
+    result.update(percentiles(ttfbs, "ttfb"))
+    result.update(percentiles(inter_token, "inter_token"))
+    result.update(percentiles(totals, "total"))
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def wait_until_up(url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def start_servers(args, upstream_args, workdir, server_args=()):
+    db_path = args.db_path
+    if db_path is None:
+        db_path = os.path.join(workdir, "synthetic_db")
+        build_synthetic_index(db_path, args.n_chunks)
+    upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+    processes = [
+        subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.fake_upstreams", "--port", str(args.upstream_port)]
+            + upstream_args
+        )
+    ]
+    wait_until_up(f"{upstream_url}/stats")
+    processes.append(
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.bench_server",
+                "--db-path",
+                db_path,
+                "--upstream-url",
+                upstream_url,
+                "--port",
+                str(args.port),
+                "--pipeline-mode",
+                args.pipeline_mode,
+            ]
+            + (["--caches"] if args.caches else [])
+            + list(server_args)
+        )
+    )
+    url = f"http://127.0.0.1:{args.port}"
+    wait_until_up(url)
+    return url, processes
+
+
+async def run(args, url):
+    questions = make_questions(args.n_questions)
+    results = []
+    print(
+        f"{'endpoint':>24} {'rps':>6} {'errors':>6} {'ttfb p50':>9} {'ttfb p99':>9} "
+        f"{'itl p50':>8} {'itl p99':>8} {'rss MB':>7}"
+    )
+    for endpoint in args.endpoints:
+        result = await run_endpoint(
+            url, endpoint, args.concurrency, args.duration, questions, args.timeout
+        )
+        results.append(result)
+        print(
+            f"{endpoint:>24} {result['throughput_rps']:>6.1f} {result['errors']:>6} "
+            f"{result['ttfb_p50_ms'] or 0:>8.0f}ms {result['ttfb_p99_ms'] or 0:>8.0f}ms "
+            f"{result['inter_token_p50_ms'] or 0:>6.1f}ms "
+            f"{result['inter_token_p99_ms'] or 0:>6.1f}ms "
+            f"{result['peak_rss_mb'] or 0:>7.0f}"
+        )
+    return results
+
+
+def main(args, upstream_args):
+    processes = []
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            url = args.url
+            if url is None:
+                url, processes = start_servers(args, upstream_args, workdir)
+            results = asyncio.run(run(args, url))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key != "output"}
+        settings["upstream_args"] = upstream_args
+        report = {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "settings": settings,
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline chat latency/throughput benchmark")
+    parser.add_argument("--url", help="A running server, instead of starting one on the fakes")
+    parser.add_argument("--endpoints", nargs="+", default=["/api/chat", "/api/chat_with_context"])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--n-questions", type=int, default=200)
+    parser.add_argument("--db-path", help="Vector store to serve, default: a synthetic one")
+    parser.add_argument("--n-chunks", type=int, default=2000)
+    parser.add_argument("--pipeline-mode", default="speculative")
+    parser.add_argument("--caches", action="store_true")
+    parser.add_argument("--port", type=int, default=8181)
+    parser.add_argument("--upstream-port", type=int, default=9191)
+    parser.add_argument("--output", help="Write the results as JSON")
+    main(*parser.parse_known_args())
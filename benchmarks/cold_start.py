@@ -0,0 +1,183 @@
+"""Cold start of the chat server, offline: time to listen, time to ready, and the first requests.
+
+Starts the server (benchmarks.bench_server, on a synthetic vector store and the fake upstreams)
+`--runs` times in a fresh process, with a proxy that refuses every connection, so that any download
+at startup (e.g. a tokenizer file missing from TIKTOKEN_CACHE_DIR) fails instead of being timed.
+Reports per run the seconds until the port accepts connections, until /ready reports OK, and the
+TTFB of the first and second /api/chat request, plus the startup report of the server (its
+imports, resources and milestones). The import-time breakdown of `import app.app` by top-level
+package comes from `python -X importtime`.
+
+Example:
+    TIKTOKEN_CACHE_DIR=/opt/tiktoken python -m benchmarks.cold_start --runs 5
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import httpx
+import numpy as np
+
+from benchmarks.chat_benchmark import git_commit, wait_until_up
+from benchmarks.synthetic_index import build_synthetic_index
+
+# Nothing listens there, so every proxied download fails right away
+OFFLINE_PROXY = "http://127.0.0.1:9"
+
+
+def import_breakdown(top=12):
+    """Cumulative import time (s) of `import app.app` by top-level package, the slowest first."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.app"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    packages = defaultdict(float)
+    parents = []
+    # Children are printed before their parent, reversed every import follows its parent
+    for line in reversed(result.stderr.splitlines()):
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        parents[depth:] = [name]
+        # The first import outside the app counts, its cumulative time includes its own imports
+        outside = [parent for parent in parents if parent.split(".")[0] != "app"]
+        if outside == [name]:
+            packages[name.split(".")[0]] += int(cumulative) / 1e6
+    return dict(sorted(packages.items(), key=lambda item: -item[1])[:top])
+
+
+def port_open(port):
+    with socket.socket() as sock:
+        return sock.connect_ex(("127.0.0.1", port)) == 0
+
+
+def first_ttfb(client):
+    payload = {"messages": [{"role": "user", "content": "Kako se obdavči najemnina?"}]}
+    start = time.perf_counter()
+    with client.stream("POST", "/api/chat", json=payload) as response:
+        response.raise_for_status()
+        for _ in response.iter_raw():
+            return time.perf_counter() - start
+
+
+def cold_start(args, db_path, upstream_url):
+    env = dict(os.environ, HTTPS_PROXY=OFFLINE_PROXY, HTTP_PROXY=OFFLINE_PROXY)
+    env["NO_PROXY"] = "127.0.0.1,localhost"
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.bench_server", "--db-path", db_path]
+        + ["--upstream-url", upstream_url, "--port", str(args.port)]
+        + (["--no-mmap"] if args.no_mmap else []),
+        env=env,
+    )
+    try:
+        while not port_open(args.port):
+            if server.poll() is not None or time.perf_counter() - start > args.timeout:
+                raise RuntimeError("The server did not start")
+            time.sleep(0.01)
+        listening = time.perf_counter() - start
+        url = f"http://127.0.0.1:{args.port}"
+        with httpx.Client(base_url=url, timeout=args.timeout) as client:
+            while True:
+                response = client.get("/ready")
+                if response.status_code == 200:
+                    break
+                if time.perf_counter() - start > args.timeout:
+                    raise RuntimeError(f"Not ready: {response.text}")
+                time.sleep(0.01)
+            ready = time.perf_counter() - start
+            report = response.json()
+            ttfbs = [first_ttfb(client), first_ttfb(client)]
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        "listening_s": listening,
+        "ready_s": ready,
+        "first_ttfb_ms": ttfbs[0] * 1000,
+        "second_ttfb_ms": ttfbs[1] * 1000,
+        "report": report,
+    }
+
+
+def main(args, upstream_args):
+    imports = import_breakdown()
+    print("import app.app, cumulative seconds by package:")
+    for package, seconds in imports.items():
+        print(f"  {package:<24} {seconds:.3f}")
+
+    runs = []
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = args.db_path
+        if db_path is None:
+            db_path = os.path.join(workdir, "synthetic_db")
+            build_synthetic_index(db_path, args.n_chunks)
+        upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+        upstream = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.fake_upstreams", "--port", str(args.upstream_port)]
+            + upstream_args
+        )
+        try:
+            wait_until_up(f"{upstream_url}/stats")
+            print(f"{'run':>4} {'listening':>10} {'ready':>8} {'1st TTFB':>9} {'2nd TTFB':>9}")
+            for run in range(args.runs):
+                result = cold_start(args, db_path, upstream_url)
+                runs.append(result)
+                print(
+                    f"{run:>4} {result['listening_s']:>9.2f}s {result['ready_s']:>7.2f}s "
+                    f"{result['first_ttfb_ms']:>7.0f}ms {result['second_ttfb_ms']:>7.0f}ms"
+                )
+        finally:
+            upstream.terminate()
+            upstream.wait()
+
+    report = runs[-1]["report"]
+    print("Startup report of the last run:")
+    print(
+        json.dumps({key: report[key] for key in ("milestones", "imports", "resources")}, indent=2)
+    )
+    summary = {
+        f"{key}_median": float(np.median([run[key] for run in runs]))
+        for key in ("listening_s", "ready_s", "first_ttfb_ms", "second_ttfb_ms")
+    }
+    print(" ".join(f"{key}={value:.2f}" for key, value in summary.items()))
+
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key != "output"}
+        settings["upstream_args"] = upstream_args
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "commit": git_commit(),
+                    "settings": settings,
+                    "imports": imports,
+                    "summary": summary,
+                    "runs": runs,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline cold start measurement")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--db-path", help="Vector store to serve, default: a synthetic one")
+    parser.add_argument("--n-chunks", type=int, default=20000)
+    parser.add_argument("--no-mmap", action="store_true", help="Load the FAISS index into memory")
+    parser.add_argument("--port", type=int, default=8187)
+    parser.add_argument("--upstream-port", type=int, default=9197)
+    parser.add_argument("--output", help="Write the results as JSON")
+    main(*parser.parse_known_args())
@@ -0,0 +1,141 @@
+"""Prompt size of long conversations, with and without the per-chat conversation store.
+
+Runs `--conversations` concurrent chats of `--turns` turns each against /api/chat, every turn
+sending the whole history like the frontend does, once on a server without and once on a server
+with the conversation store (rolling summaries, app.api.conversation). Both servers run on the
+fake upstreams, which count the words of the prompts they receive.
+
+Reports per setup the prompt words sent upstream (answers, and reformulations plus summaries),
+the history tokens the server saved according to its own stats, and the TTFB of the late turns.
+
+Example:
+    python -m benchmarks.conversation_benchmark --conversations 8 --turns 20
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import tempfile
+import time
+
+import httpx
+import numpy as np
+
+from benchmarks.chat_benchmark import git_commit, start_servers
+from benchmarks.synthetic_index import make_questions
+
+STATS_PATTERN = re.compile(r"^taxgpt_conversation_store_(\w+) (\S+)$", re.M)
+
+
+def parse_answer(data: str) -> str:
+    texts = []
+    for event in data.split("\n\n"):
+        if event and event != "data: [DONE]":
+            texts.append("\n".join(line[len("data: ") :] for line in event.split("\n")))
+    return "".join(texts)
+
+
+async def run_conversation(client, chat_id, questions, think_time, ttfbs):
+    messages = []
+    for turn, question in enumerate(questions):
+        messages.append({"role": "user", "content": question})
+        payload = {"messages": messages, "chat_id": chat_id}
+        start = time.perf_counter()
+        data = b""
+        async with client.stream("POST", "/api/chat", json=payload) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_raw():
+                if not data:
+                    ttfbs.setdefault(turn, []).append(time.perf_counter() - start)
+                data += chunk
+        messages.append({"role": "assistant", "content": parse_answer(data.decode())})
+        # Time to read the answer, during which the server updates the summary
+        await asyncio.sleep(think_time)
+
+
+async def run(args, url, upstream_url):
+    questions = make_questions(args.conversations * args.turns)
+    ttfbs = {}
+    async with httpx.AsyncClient(base_url=url, timeout=args.timeout) as client:
+        await asyncio.gather(
+            *(
+                run_conversation(
+                    client,
+                    f"chat-{i}",
+                    questions[i * args.turns : (i + 1) * args.turns],
+                    args.think_time,
+                    ttfbs,
+                )
+                for i in range(args.conversations)
+            )
+        )
+        server_stats = {
+            name: float(value)
+            for name, value in STATS_PATTERN.findall((await client.get("/metrics")).text)
+        }
+        upstream_stats = (await client.get(f"{upstream_url}/stats")).json()
+    late_turns = [
+        ttfb for turn, values in ttfbs.items() if turn >= args.turns // 2 for ttfb in values
+    ]
+    return {
+        "prompt_words_answer": upstream_stats["prompt_words"]["answer"],
+        "prompt_words_json": upstream_stats["prompt_words"]["json"],
+        "saved_history_tokens": server_stats.get("saved_history_tokens"),
+        "summaries": server_stats.get("summaries"),
+        "late_turn_ttfb_p50_ms": float(np.percentile(late_turns, 50)) * 1000,
+    }
+
+
+def main(args, upstream_args):
+    results = {}
+    print(
+        f"{'setup':>20} {'answer words':>13} {'reform.+summary words':>22} "
+        f"{'saved tokens':>13} {'late TTFB p50':>14}"
+    )
+    for setup, server_args in (
+        ("full_history", []),
+        ("conversation_store", ["--conversation-store"]),
+    ):
+        server_args = server_args + ["--history-token-budget", str(args.history_token_budget)]
+        processes = []
+        with tempfile.TemporaryDirectory() as workdir:
+            try:
+                url, processes = start_servers(args, upstream_args, workdir, server_args)
+                upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+                result = asyncio.run(run(args, url, upstream_url))
+            finally:
+                for process in processes:
+                    process.terminate()
+                    process.wait()
+        results[setup] = result
+        print(
+            f"{setup:>20} {result['prompt_words_answer']:>13} {result['prompt_words_json']:>22} "
+            f"{result['saved_history_tokens'] or 0:>13.0f} "
+            f"{result['late_turn_ttfb_p50_ms']:>12.0f}ms"
+        )
+
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key != "output"}
+        settings["upstream_args"] = upstream_args
+        with open(args.output, "w") as f:
+            json.dump(
+                {"commit": git_commit(), "settings": settings, "results": results}, f, indent=2
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Conversation store prompt size benchmark")
+    parser.add_argument("--conversations", type=int, default=8)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--think-time", type=float, default=0.5)
+    parser.add_argument("--history-token-budget", type=int, default=1500)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--db-path", help="Vector store to serve, default: a synthetic one")
+    parser.add_argument("--n-chunks", type=int, default=2000)
+    parser.add_argument("--pipeline-mode", default="speculative")
+    parser.add_argument("--caches", action="store_true")
+    parser.add_argument("--port", type=int, default=8183)
+    parser.add_argument("--upstream-port", type=int, default=9193)
+    parser.add_argument("--output", help="Write the results as JSON")
+    main(*parser.parse_known_args())
@@ -0,0 +1,142 @@
+"""Checks that a client disconnect stops the upstream work.
+
+Starts the fake upstreams and the chat server like benchmarks.chat_benchmark, then:
+    streaming     reads the first bytes of an answer and disconnects; the fake OpenAI server must
+                  see its stream closed long before the answer is complete
+    pre_answer    disconnects while the question is still being reformulated; no answer stream may
+                  be started upstream
+
+Both cases must also show up in the server's taxgpt_abandoned_requests metric.
+
+Example:
+    python -m benchmarks.disconnect_check --reformulate-latency 1.5
+"""
+
+import argparse
+import asyncio
+import re
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.chat_benchmark import start_servers
+
+# A follow-up question, so that the server reformulates it before retrieving
+PAYLOAD = {
+    "messages": [
+        {"role": "user", "content": "Kaj pravi ZDoh-2 o davčni olajšavi?"},
+        {"role": "assistant", "content": "Olajšava zmanjša davčno osnovo."},
+        {"role": "user", "content": "Kolikšna je za vzdrževanega otroka?"},
+    ]
+}
+# The empty lines the server sends between the references and the answer
+ANSWER_SEPARATOR = b"data: \ndata: \ndata: \ndata: \ndata: \n\n"
+ABANDONED_PATTERN = re.compile(r'^taxgpt_abandoned_requests_total\{stage="(\w+)"\} (\S+)$', re.M)
+
+
+async def abandoned_requests(client):
+    response = await client.get("/metrics")
+    return {stage: float(value) for stage, value in ABANDONED_PATTERN.findall(response.text)}
+
+
+async def upstream_streams(upstream_url):
+    async with httpx.AsyncClient() as client:
+        return (await client.get(f"{upstream_url}/stats")).json()["streams"]
+
+
+async def wait_for(condition, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if await condition():
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+async def check_streaming(client, upstream_url, timeout):
+    before = await upstream_streams(upstream_url)
+    received = b""
+    async with client.stream("POST", "/api/chat", json=PAYLOAD) as response:
+        # Disconnect once the answer itself is streaming
+        async for chunk in response.aiter_raw():
+            received += chunk
+            if not received.endswith(ANSWER_SEPARATOR) and ANSWER_SEPARATOR in received:
+                break
+    disconnected_at = time.perf_counter()
+
+    async def closed_upstream():
+        streams = await upstream_streams(upstream_url)
+        return streams["abandoned"] > before["abandoned"] and streams["open"] == 0
+
+    closed = await wait_for(closed_upstream, timeout)
+    return closed, time.perf_counter() - disconnected_at
+
+
+async def check_pre_answer(client, upstream_url, disconnect_after):
+    before = await upstream_streams(upstream_url)
+    try:
+        await asyncio.wait_for(client.post("/api/chat", json=PAYLOAD), disconnect_after)
+    except asyncio.TimeoutError:
+        pass
+    # Long enough for a reformulation that was not cancelled to finish and start the answer
+    await asyncio.sleep(2 * disconnect_after)
+    after = await upstream_streams(upstream_url)
+    return after["started"] == before["started"]
+
+
+async def run(args, url, upstream_url):
+    ok = True
+    async with httpx.AsyncClient(base_url=url, timeout=args.timeout) as client:
+        closed, seconds = await check_streaming(client, upstream_url, args.timeout)
+        print(f"streaming:  upstream stream closed={closed} after {1000 * seconds:.0f}ms")
+        ok &= closed
+
+        not_started = await check_pre_answer(client, upstream_url, args.reformulate_latency / 3)
+        print(f"pre_answer: answer stream not started={not_started}")
+        ok &= not_started
+
+        abandoned = await abandoned_requests(client)
+        print(f"taxgpt_abandoned_requests: {abandoned}")
+        ok &= abandoned.get("streaming", 0) >= 1 and abandoned.get("pre_answer", 0) >= 1
+    return ok
+
+
+def main(args):
+    # A slow answer, so that it is still streaming when the client disconnects
+    upstream_args = [
+        "--token-rate",
+        "10",
+        "--answer-tokens",
+        "200",
+        "--chat-ttft",
+        "0.05",
+        "--reformulate-latency",
+        str(args.reformulate_latency),
+    ]
+    processes = []
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            url, processes = start_servers(args, upstream_args, workdir)
+            upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+            ok = asyncio.run(run(args, url, upstream_url))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Client disconnect check on the fake upstreams")
+    parser.add_argument("--reformulate-latency", type=float, default=1.5)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--db-path", help="Vector store to serve, default: a synthetic one")
+    parser.add_argument("--n-chunks", type=int, default=500)
+    parser.add_argument("--pipeline-mode", default="speculative")
+    parser.add_argument("--caches", action="store_true")
+    parser.add_argument("--port", type=int, default=8182)
+    parser.add_argument("--upstream-port", type=int, default=9192)
+    main(parser.parse_args())
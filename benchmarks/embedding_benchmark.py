@@ -0,0 +1,180 @@
+"""Query embedding latency and retrieval recall of the OpenAI and the local embedding backends.
+
+Each backend embeds the held-out questions one at a time, as on the request path, and searches the
+vector store it built: the OpenAI one (`--db-path`) and the one rebuilt with the local model
+(`--local-db-path`, see app.index.rebuild, rebuilt into a temporary directory from `--db-path`
+when not given). The questions file has one JSON object per line, {"question": ..., "sources":
+[...]}, the sources being the `raw_filepath` or `details_href_name` of the relevant chunks.
+
+Reports per backend the p50/p99 embedding latency, hit@k (a relevant chunk in the top k) and
+recall@k (the share of a question's sources found in the top k), and the overlap of the local top
+k with the OpenAI top k.
+
+Without --db-path, the synthetic vector store is used, embedded by the fake upstreams in place of
+OpenAI, with held-out synthetic questions whose relevant chunks are those of the law they ask
+about.
+
+Example:
+    python -m benchmarks.embedding_benchmark --db-path vector_database \
+        --questions heldout_questions.jsonl --model-path models/multilingual-e5-small \
+        --query-prefix "query: " --document-prefix "passage: " --k 5 --output embeddings.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from langchain_openai import OpenAIEmbeddings
+
+from app.api.embeddings import LocalEmbeddings
+from app.api.retrieval import dense_search
+from app.index.rebuild import rebuild_index
+from app.index.store import load_vector_store
+from benchmarks.chat_benchmark import git_commit, wait_until_up
+from benchmarks.synthetic_index import LAWS, build_synthetic_index, make_questions
+
+
+def load_questions(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def synthetic_questions(n_questions):
+    # Another seed than the benchmark questions, the relevant chunks are those of the asked law
+    questions = []
+    for question in make_questions(n_questions, seed=7):
+        law = next(law for law in LAWS if f" {law} " in question)
+        questions.append({"question": question, "sources": [f"Zakon {law}"]})
+    return questions
+
+
+async def evaluate(db, questions, k, warm_up=3):
+    for question in questions[:warm_up]:
+        await db.embeddings.aembed_query(question["question"])
+    latencies, rankings = [], []
+    for question in questions:
+        start = time.perf_counter()
+        embedding = await db.embeddings.aembed_query(question["question"])
+        latencies.append(time.perf_counter() - start)
+        _, indices = dense_search(db, [embedding], k)
+        rankings.append([int(i) for i in indices[0] if i >= 0])
+    return latencies, rankings
+
+
+def found_sources(db, ranking, sources):
+    found = set()
+    for position in ranking:
+        metadata = db.docstore.search(db.index_to_docstore_id[position]).metadata
+        found |= sources & {metadata.get("raw_filepath"), metadata.get("details_href_name")}
+    return found
+
+
+def score(db, questions, latencies, rankings, k):
+    hits, recalls = [], []
+    for question, ranking in zip(questions, rankings):
+        sources = set(question["sources"])
+        found = found_sources(db, ranking, sources)
+        hits.append(bool(found))
+        recalls.append(len(found) / len(sources))
+    latencies_ms = 1000 * np.array(latencies)
+    return {
+        "embed_p50_ms": float(np.percentile(latencies_ms, 50)),
+        "embed_p99_ms": float(np.percentile(latencies_ms, 99)),
+        f"hit_at_{k}": float(np.mean(hits)),
+        f"recall_at_{k}": float(np.mean(recalls)),
+    }
+
+
+def run_backend(db, questions, k):
+    latencies, rankings = asyncio.run(evaluate(db, questions, k))
+    return score(db, questions, latencies, rankings, k), rankings
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        upstream = None
+        db_path, questions = args.db_path, None
+        openai_kwargs = {}
+        if db_path is None:
+            db_path = build_synthetic_index(os.path.join(workdir, "synthetic_db"), args.n_chunks)
+            questions = synthetic_questions(args.n_questions)
+            args.upstream_url = args.upstream_url or f"http://127.0.0.1:{args.upstream_port}"
+            upstream = subprocess.Popen(
+                [sys.executable, "-m", "benchmarks.fake_upstreams"]
+                + ["--port", str(args.upstream_port)]
+            )
+        if args.questions:
+            questions = load_questions(args.questions)
+        if args.upstream_url:
+            openai_kwargs = dict(
+                base_url=f"{args.upstream_url}/v1", api_key="fake", check_embedding_ctx_length=False
+            )
+
+        results = {}
+        try:
+            if upstream is not None:
+                wait_until_up(f"{args.upstream_url}/stats")
+            db = load_vector_store(
+                db_path, OpenAIEmbeddings(model=args.embedding_model, **openai_kwargs)
+            )
+            results["openai"], openai_rankings = run_backend(db, questions, args.k)
+
+            if args.model_path:
+                local_embeddings = LocalEmbeddings(
+                    args.model_path,
+                    query_prefix=args.query_prefix,
+                    document_prefix=args.document_prefix,
+                )
+                local_db_path = args.local_db_path
+                if local_db_path is None:
+                    local_db_path = os.path.join(workdir, "local_db")
+                    rebuild_index(db_path, local_db_path, local_embeddings)
+                local_db = load_vector_store(local_db_path, local_embeddings)
+                results["local"], local_rankings = run_backend(local_db, questions, args.k)
+                results["local"][f"overlap_at_{args.k}_with_openai"] = float(
+                    np.mean(
+                        [
+                            len(set(local) & set(openai)) / args.k
+                            for local, openai in zip(local_rankings, openai_rankings)
+                        ]
+                    )
+                )
+        finally:
+            if upstream is not None:
+                upstream.terminate()
+                upstream.wait()
+
+    print(f"{len(questions)} held-out questions, k={args.k}")
+    for backend, result in results.items():
+        print(f"{backend:>8} " + " ".join(f"{key}={value:.3f}" for key, value in result.items()))
+
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key != "output"}
+        with open(args.output, "w") as f:
+            json.dump(
+                {"commit": git_commit(), "settings": settings, "results": results}, f, indent=2
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local vs OpenAI query embeddings")
+    parser.add_argument("--db-path", help="Vector store built by OpenAI, default: a synthetic one")
+    parser.add_argument("--local-db-path", help="The same chunks, rebuilt by the local model")
+    parser.add_argument("--questions", help="Held-out questions (JSONL), with their sources")
+    parser.add_argument("--model-path", help="ONNX export of the local embedding model")
+    parser.add_argument("--query-prefix", default="")
+    parser.add_argument("--document-prefix", default="")
+    parser.add_argument("--embedding-model", default="text-embedding-3-small")
+    parser.add_argument("--upstream-url", help="Fake upstreams instead of OpenAI")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--n-chunks", type=int, default=2000)
+    parser.add_argument("--n-questions", type=int, default=200)
+    parser.add_argument("--upstream-port", type=int, default=9198)
+    parser.add_argument("--output", help="Write the results as JSON")
+    main(parser.parse_args())
@@ -0,0 +1,311 @@
+"""Local stand-ins for the OpenAI and Cohere APIs, for benchmarking without API costs.
+
+One HTTP server implements the endpoints the service calls, so the real SDK clients can be pointed
+at it (`AsyncOpenAI(base_url=...)`, `OpenAIEmbeddings(base_url=...)`,
+`CohereReranker(base_url=...)`):
+    POST /v1/chat/completions   streamed answers, JSON reformulations and summaries
+    POST /v1/embeddings         deterministic hashed bag-of-words embeddings
+    POST /v1/rerank             Cohere style rerank by word overlap
+
+Latencies are lognormal, given as "median[:sigma]" in seconds, answers are streamed at a fixed
+token rate, and a fraction of the requests fails with a 500 or 429 error. With --tpm-limit or
+--rpm-limit, the chat completions also enforce per-model rate limits like OpenAI's: a completion
+that does not fit the tokens (prompt words plus --answer-tokens) or requests per minute left
+fails with a 429 and its Retry-After. With --stall-rate, a fraction of the embedding, rerank and
+JSON completion requests stalls for --stall-latency seconds before answering.
+
+Example:
+    python -m benchmarks.fake_upstreams --port 9000 --chat-ttft 0.5:0.4 --token-rate 40 \
+        --error-rate 0.01
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+import uuid
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from app.api.admission import TokenBucket
+
+EMBEDDING_DIM = 256
+WORD_PATTERN = re.compile(r"\w+")
+ANSWER_WORDS = (
+    "Po zakonu je zavezanec dolžan plačati davek od dohodka v roku, ki ga določa "
+    "odločba davčnega organa, pri čemer se upoštevajo olajšave in davčna osnova iz "
+    "preteklega obdobja."
+).split()
+
+
+class Latency:
+    """Lognormal latency with the given median and sigma, in seconds."""
+
+    def __init__(self, median=0.0, sigma=0.0, rng=None):
+        self.median = median
+        self.sigma = sigma
+        self.rng = rng or random.Random()
+
+    @classmethod
+    def parse(cls, value):
+        median, _, sigma = value.partition(":")
+        return cls(float(median), float(sigma or 0))
+
+    def sample(self):
+        if self.median <= 0:
+            return 0.0
+        return self.median * float(np.exp(self.sigma * self.rng.gauss(0, 1)))
+
+    async def wait(self):
+        delay = self.sample()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def words(text):
+    return WORD_PATTERN.findall(text.lower())
+
+
+def hash_embedding(text, dim=EMBEDDING_DIM):
+    """Normalized hashed bag of words, so texts sharing words embed close to each other."""
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in words(text):
+        digest = hashlib.blake2b(word.encode(), digest_size=8).digest()
+        bucket = int.from_bytes(digest[:4], "little") % dim
+        vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def create_app(
+    chat_ttft=None,
+    token_rate=50.0,
+    answer_tokens=120,
+    reformulate_latency=None,
+    embedding_latency=None,
+    rerank_latency=None,
+    error_rate=0.0,
+    dim=EMBEDDING_DIM,
+    seed=0,
+    tpm_limit=None,
+    rpm_limit=None,
+    stall_rate=0.0,
+    stall_latency=10.0,
+):
+    rng = random.Random(seed)
+    chat_ttft = chat_ttft or Latency(0.5, 0.3, rng)
+    reformulate_latency = reformulate_latency or Latency(0.8, 0.3, rng)
+    embedding_latency = embedding_latency or Latency(0.1, 0.3, rng)
+    rerank_latency = rerank_latency or Latency(0.2, 0.3, rng)
+    app = FastAPI()
+    app.state.requests = {
+        "chat": 0,
+        "embeddings": 0,
+        "rerank": 0,
+        "errors": 0,
+        "rate_limited": 0,
+        "stalled": 0,
+    }
+    rate_limits = {}  # model -> TokenBucket
+    # Streams whose client closed the connection before the end count as abandoned
+    app.state.streams = {"started": 0, "completed": 0, "abandoned": 0, "open": 0}
+    # Words of the chat prompts, a stand-in for the prompt tokens the service pays for
+    app.state.prompt_words = {"answer": 0, "json": 0}
+
+    def injected_error():
+        if rng.random() >= error_rate:
+            return None
+        app.state.requests["errors"] += 1
+        if rng.random() < 0.5:
+            return JSONResponse(
+                {"error": {"message": "Rate limited", "type": "rate_limit"}},
+                status_code=429,
+                headers={"Retry-After": "0.1"},
+            )
+        return JSONResponse({"error": {"message": "Injected failure"}}, status_code=500)
+
+    async def maybe_stall():
+        # The occasional very slow call, the tail the hedging and deadlines are for
+        if rng.random() < stall_rate:
+            app.state.requests["stalled"] += 1
+            await asyncio.sleep(stall_latency)
+
+    def rate_limit_error(model, tokens):
+        if tpm_limit is None and rpm_limit is None:
+            return None
+        bucket = rate_limits.setdefault(model, TokenBucket(tpm_limit, rpm_limit))
+        wait = bucket.wait_time(tokens)
+        if wait == 0:
+            bucket.consume(tokens)
+            return None
+        app.state.requests["rate_limited"] += 1
+        return JSONResponse(
+            {"error": {"message": f"Rate limit reached for {model}", "type": "tokens"}},
+            status_code=429,
+            headers={"Retry-After": f"{wait:.3f}"},
+        )
+
+    def completion_chunk(content, finish_reason=None):
+        delta = {"content": content} if content is not None else {}
+        choice = {"index": 0, "delta": delta, "finish_reason": finish_reason}
+        chunk = {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": "fake",
+            "choices": [choice],
+        }
+        return f"data: {json.dumps(chunk)}\n\n"
+
+    async def stream_answer():
+        streams = app.state.streams
+        streams["started"] += 1
+        streams["open"] += 1
+        completed = False
+        try:
+            await chat_ttft.wait()
+            yield completion_chunk("")
+            for i in range(answer_tokens):
+                yield completion_chunk(ANSWER_WORDS[i % len(ANSWER_WORDS)] + " ")
+                await asyncio.sleep(1 / token_rate)
+            yield completion_chunk(None, finish_reason="stop")
+            yield "data: [DONE]\n\n"
+            completed = True
+        finally:
+            streams["open"] -= 1
+            streams["completed" if completed else "abandoned"] += 1
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        app.state.requests["chat"] += 1
+        body = await request.json()
+        error = injected_error()
+        if error is not None:
+            return error
+        prompt_words = sum(len(message["content"].split()) for message in body["messages"])
+        error = rate_limit_error(body.get("model", "fake"), prompt_words + answer_tokens)
+        if error is not None:
+            return error
+        if body.get("stream"):
+            app.state.prompt_words["answer"] += prompt_words
+            return StreamingResponse(stream_answer(), media_type="text/event-stream")
+
+        # The reformulation: the last user line of the conversation in the prompt. Summaries are
+        # the first words of each line of the conversation
+        app.state.prompt_words["json"] += prompt_words
+        await reformulate_latency.wait()
+        await maybe_stall()
+        prompt = body["messages"][-1]["content"]
+        user_lines = re.findall(r"^user: (.*)$", prompt, flags=re.MULTILINE)
+        question = user_lines[-1].strip() if user_lines else prompt[-200:]
+        lines = re.findall(r"^(?:user|assistant): (.*)$", prompt, flags=re.MULTILINE)
+        summary = " ".join(" ".join(line.split()[:8]) for line in lines)
+        content = json.dumps({"reformulated_question": question, "summary": summary})
+        message = {"role": "assistant", "content": content}
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        app.state.requests["embeddings"] += 1
+        body = await request.json()
+        error = injected_error()
+        if error is not None:
+            return error
+        await embedding_latency.wait()
+        await maybe_stall()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        data = [
+            {"object": "embedding", "index": i, "embedding": hash_embedding(text, dim).tolist()}
+            for i, text in enumerate(inputs)
+        ]
+        return {
+            "object": "list",
+            "data": data,
+            "model": body.get("model", "fake"),
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+
+    @app.post("/v1/rerank")
+    async def rerank(request: Request):
+        app.state.requests["rerank"] += 1
+        body = await request.json()
+        error = injected_error()
+        if error is not None:
+            return error
+        await rerank_latency.wait()
+        await maybe_stall()
+        query_words = set(words(body["query"]))
+        scores = []
+        for i, document in enumerate(body["documents"]):
+            text = document if isinstance(document, str) else document.get("text", "")
+            document_words = set(words(text))
+            overlap = len(query_words & document_words) / max(len(query_words), 1)
+            scores.append((i, overlap))
+        scores.sort(key=lambda item: item[1], reverse=True)
+        top_n = body.get("top_n") or len(scores)
+        return {
+            "id": str(uuid.uuid4()),
+            "results": [{"index": i, "relevance_score": score} for i, score in scores[:top_n]],
+            "meta": {"api_version": {"version": "1"}},
+        }
+
+    @app.get("/stats")
+    async def stats():
+        return {
+            **app.state.requests,
+            "streams": app.state.streams,
+            "prompt_words": app.state.prompt_words,
+        }
+
+    return app
+
+
+def add_arguments(parser):
+    parser.add_argument("--chat-ttft", type=Latency.parse, default=Latency(0.5, 0.3))
+    parser.add_argument("--token-rate", type=float, default=50.0, help="Answer tokens per second")
+    parser.add_argument("--answer-tokens", type=int, default=120)
+    parser.add_argument("--reformulate-latency", type=Latency.parse, default=Latency(0.8, 0.3))
+    parser.add_argument("--embedding-latency", type=Latency.parse, default=Latency(0.1, 0.3))
+    parser.add_argument("--rerank-latency", type=Latency.parse, default=Latency(0.2, 0.3))
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--tpm-limit", type=float, help="Chat tokens (words) per minute per model")
+    parser.add_argument("--rpm-limit", type=float, help="Chat requests per minute per model")
+    parser.add_argument("--stall-rate", type=float, default=0.0)
+    parser.add_argument("--stall-latency", type=float, default=10.0)
+
+
+def app_from_args(args):
+    return create_app(
+        chat_ttft=args.chat_ttft,
+        token_rate=args.token_rate,
+        answer_tokens=args.answer_tokens,
+        reformulate_latency=args.reformulate_latency,
+        embedding_latency=args.embedding_latency,
+        rerank_latency=args.rerank_latency,
+        error_rate=args.error_rate,
+        tpm_limit=args.tpm_limit,
+        rpm_limit=args.rpm_limit,
+        stall_rate=args.stall_rate,
+        stall_latency=args.stall_latency,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI and Cohere API server")
+    parser.add_argument("--port", type=int, default=9000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(app_from_args(args), host="127.0.0.1", port=args.port, log_level="warning")
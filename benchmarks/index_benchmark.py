@@ -0,0 +1,99 @@
+"""Recall, latency and memory of the approximate index variants against the flat index.
+
+The variants are built in memory from the vectors of the given vector store. The queries are
+either held-out query embeddings (.npy of shape [n, d]) or, by default, stored vectors with added
+Gaussian noise. Recall@k is measured against the exact top-k of the flat index, and latency is
+measured per single-query search, as on the request path.
+
+Example:
+    python -m benchmarks.index_benchmark --db-path vector_database --k 25 \
+        --nprobe 8 16 32 --ef-search 64 128 256 --output index_benchmark.json
+"""
+
+import argparse
+import json
+import os
+import time
+
+import faiss
+import numpy as np
+
+from app.index.store import read_index
+from app.index.variants import apply_search_params, build_variant, extract_vectors
+
+
+def make_queries(vectors, n_queries, noise, seed=0):
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), size=n_queries, replace=False)].copy()
+    queries += rng.normal(scale=noise * np.abs(queries).mean(), size=queries.shape)
+    return queries.astype(np.float32)
+
+
+def measure(index, queries, ground_truth, k):
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, ground_truth):
+        start = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), k)
+        latencies.append(time.perf_counter() - start)
+        hits += len(set(ids[0]) & set(expected))
+    latencies_ms = 1000 * np.array(latencies)
+    return {
+        "recall_at_k": hits / (k * len(queries)),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "memory_mb": len(faiss.serialize_index(index)) / 2**20,
+    }
+
+
+def main(args):
+    flat = read_index(os.path.join(args.db_path, "index.faiss"), mmap=False)
+    vectors = extract_vectors(flat)
+    if args.queries:
+        queries = np.load(args.queries).astype(np.float32)
+    else:
+        queries = make_queries(vectors, min(args.n_queries, len(vectors)), args.noise)
+    _, ground_truth = flat.search(queries, args.k)
+
+    results = []
+    for variant in args.variants:
+        start = time.perf_counter()
+        index = build_variant(vectors, variant, metric=flat.metric_type)
+        build_time = time.perf_counter() - start
+        if variant in ("ivf_flat", "ivf_pq"):
+            settings = [{"nprobe": nprobe} for nprobe in args.nprobe]
+        elif variant == "hnsw":
+            settings = [{"ef_search": ef_search} for ef_search in args.ef_search]
+        else:
+            settings = [{}]
+        for params in settings:
+            apply_search_params(index, **params)
+            result = {"variant": variant, "params": params, "build_s": build_time}
+            result.update(measure(index, queries, ground_truth, args.k))
+            results.append(result)
+            params_str = ",".join(f"{key}={value}" for key, value in params.items()) or "-"
+            print(
+                f"{variant:>9} {params_str:>14} recall@{args.k}={result['recall_at_k']:.3f} "
+                f"p50={result['p50_ms']:.3f}ms p99={result['p99_ms']:.3f}ms "
+                f"memory={result['memory_mb']:.1f}MB"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index variant recall/latency benchmark")
+    parser.add_argument("--db-path", required=True)
+    parser.add_argument(
+        "--variants", nargs="+", default=["flat", "hnsw", "ivf_flat", "ivf_pq", "sq8"]
+    )
+    parser.add_argument("--k", type=int, default=25)
+    parser.add_argument("--queries", help="Held-out query embeddings as a .npy file")
+    parser.add_argument("--n-queries", type=int, default=500)
+    parser.add_argument("--noise", type=float, default=0.1)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[32, 64, 128])
+    parser.add_argument("--output", help="Write the results as JSON")
+    main(parser.parse_args())
@@ -0,0 +1,142 @@
+"""Checks the versioned vector store snapshots and their hot swap (app.index.manager).
+
+Publishes synthetic vector stores of different sizes to a local file:// bucket and loads them with
+two IndexManagers standing in for two gunicorn workers of one instance, the second one polling the
+manifest:
+    load_current    the manifest's current version is loaded and activated
+    empty_rollback  rolling back with a single published version fails, the active one stays
+    reload          a newly published version is swapped in by reload and by the poller
+    in_flight       a request that pinned the config before a swap keeps searching its snapshot
+    rollback        goes back to the previously current version, in both workers
+    pin             a forced version is made current in the manifest and followed by both workers
+    stale_files     a local file the snapshot in the bucket does not have is removed on loading it
+
+Example:
+    python -m benchmarks.index_swap_check --n-chunks 500
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+
+from openai import AsyncOpenAI
+
+from app.api.openai_interface import Config
+from app.api.retrieval import dense_search
+from app.index.manager import IndexManager, publish_version, read_manifest
+from app.storage.storage_bucket import LOCAL_BUCKET_PREFIX, get_bucket
+from benchmarks.fake_upstreams import hash_embedding
+from benchmarks.synthetic_index import build_synthetic_index
+
+QUESTION = "Kakšna je stopnja davka na dodano vrednost?"
+
+
+def create_config(version, db):
+    return Config(
+        retrieve_n=10,
+        rerank_max_n=5,
+        max_context_len=4096,
+        model="gpt-4o",
+        client=AsyncOpenAI(api_key="check"),
+        embedding_model="text-embedding-3-small",
+        db=db,
+        index_version=version,
+    )
+
+
+def search(db):
+    # The FAISS positions of the question's hits, all of them valid in a healthy snapshot
+    _, indices = dense_search(db, [hash_embedding(QUESTION)], 10)
+    return [int(i) for i in indices[0] if i >= 0]
+
+
+async def wait_for(condition, timeout):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        if condition():
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+async def run(args, workdir):
+    bucket = get_bucket(LOCAL_BUCKET_PREFIX + os.path.join(workdir, "bucket"))
+    os.makedirs(bucket.root, exist_ok=True)
+    sizes = {"v1": args.n_chunks, "v2": args.n_chunks + 100, "v3": args.n_chunks + 200}
+    paths = {
+        version: build_synthetic_index(os.path.join(workdir, version), n_chunks, seed=seed)
+        for seed, (version, n_chunks) in enumerate(sizes.items())
+    }
+
+    def serves(config, version):
+        return config.index_version == version and config.db.index.ntotal == sizes[version]
+
+    local_root = os.path.join(workdir, "local")
+    workers = [IndexManager(bucket, local_root, None) for _ in range(2)]
+    results = {}
+
+    publish_version(bucket, paths["v1"], "v1")
+    configs = [create_config(*manager.load_current()) for manager in workers]
+    results["load_current"] = all(serves(config, "v1") for config in configs)
+
+    try:
+        await workers[0].rollback(configs[0])
+        results["empty_rollback"] = False
+    except ValueError:
+        results["empty_rollback"] = serves(configs[0], "v1")
+
+    poller = asyncio.create_task(workers[1].poll(configs[1], args.poll_interval))
+    try:
+        publish_version(bucket, paths["v2"], "v2")
+        # A request pins the config when it starts, as app.app.pin_config does
+        pinned = configs[0].model_copy()
+        version = await workers[0].reload(configs[0])
+        followed = await wait_for(lambda: serves(configs[1], "v2"), args.timeout)
+        results["reload"] = version == "v2" and serves(configs[0], "v2") and followed
+        results["in_flight"] = serves(pinned, "v1") and len(search(pinned.db)) > 0
+
+        version = await workers[0].rollback(configs[0])
+        followed = await wait_for(lambda: serves(configs[1], "v1"), args.timeout)
+        results["rollback"] = version == "v1" and serves(configs[0], "v1") and followed
+
+        publish_version(bucket, paths["v3"], "v3")
+        await wait_for(lambda: serves(configs[1], "v3"), args.timeout)
+        version = await workers[0].pin(configs[0], "v2")
+        followed = await wait_for(lambda: serves(configs[1], "v2"), args.timeout)
+        results["pin"] = (
+            version == "v2"
+            and read_manifest(bucket)["current"] == "v2"
+            and serves(configs[0], "v2")
+            and followed
+        )
+
+        # A sidecar in the local copy of v3 (still kept) that v3 in the bucket does not have
+        sidecar = os.path.join(local_root, "v3", "stale.npz")
+        with open(sidecar, "wb") as f:
+            f.write(b"stale")
+        version = await workers[0].pin(configs[0], "v3")
+        results["stale_files"] = version == "v3" and not os.path.exists(sidecar)
+    finally:
+        poller.cancel()
+
+    for name, ok in results.items():
+        print(f"{name:>14}: {'ok' if ok else 'FAILED'}")
+    return all(results.values())
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        ok = asyncio.run(run(args, workdir))
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Versioned index snapshot and hot swap check")
+    parser.add_argument("--n-chunks", type=int, default=500)
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    main(parser.parse_args())
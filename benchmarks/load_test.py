@@ -0,0 +1,83 @@
+"""Load test for the streaming chat endpoints.
+
+Opens an increasing number of concurrent SSE streams against a running server and reports, for
+each concurrency level, how many streams completed and how long the clients waited for the first
+byte. The highest level at which every stream completed within the TTFB budget is the number of
+concurrent streams a single instance can hold.
+
+Example:
+    python -m benchmarks.load_test --url http://localhost:8080 --levels 10 20 40 80 160
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+DEFAULT_QUESTION = "Kakšen je prag za vstop v sistem DDV?"
+
+
+async def run_stream(client, url, payload):
+    start = time.perf_counter()
+    ttfb = None
+    n_bytes = 0
+    async with client.stream("POST", url, json=payload) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes():
+            if ttfb is None:
+                ttfb = time.perf_counter() - start
+            n_bytes += len(chunk)
+    return ttfb, time.perf_counter() - start, n_bytes
+
+
+async def run_level(base_url, endpoint, concurrency, question, timeout):
+    payload = {"messages": [{"role": "user", "content": question}]}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(run_stream(client, endpoint, payload) for _ in range(concurrency)),
+            return_exceptions=True,
+        )
+        wall_time = time.perf_counter() - start
+
+    ok = [r for r in results if not isinstance(r, BaseException)]
+    ttfbs = sorted(r[0] for r in ok if r[0] is not None)
+    return {
+        "concurrency": concurrency,
+        "completed": len(ok),
+        "failed": len(results) - len(ok),
+        "wall_time_s": wall_time,
+        "ttfb_p50_s": statistics.median(ttfbs) if ttfbs else None,
+        "ttfb_max_s": ttfbs[-1] if ttfbs else None,
+    }
+
+
+async def main(args):
+    print(f"{'streams':>8} {'ok':>5} {'failed':>7} {'ttfb p50':>9} {'ttfb max':>9} {'wall':>7}")
+    max_held = 0
+    for level in args.levels:
+        result = await run_level(args.url, args.endpoint, level, args.question, args.timeout)
+        print(
+            f"{result['concurrency']:>8} {result['completed']:>5} {result['failed']:>7} "
+            f"{result['ttfb_p50_s'] or 0:>9.2f} {result['ttfb_max_s'] or 0:>9.2f} "
+            f"{result['wall_time_s']:>7.2f}"
+        )
+        held = result["failed"] == 0 and (result["ttfb_max_s"] or 0) <= args.max_ttfb
+        if not held:
+            break
+        max_held = level
+    print(f"Concurrent streams held within a {args.max_ttfb}s TTFB budget: {max_held}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent stream load test")
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--endpoint", default="/api/chat")
+    parser.add_argument("--levels", type=int, nargs="+", default=[10, 20, 40, 80, 160])
+    parser.add_argument("--question", default=DEFAULT_QUESTION)
+    parser.add_argument("--max-ttfb", type=float, default=10.0)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,89 @@
+"""Micro-benchmark of the context packing step at the end of get_law_context_chunks.
+
+Compares the previous packing loop, which re-encoded the whole growing context on every iteration,
+with pack_context on an index without precomputed metadata (encoder fallback) and on an upgraded
+index (no tokenization at all).
+
+Example:
+    python -m benchmarks.packing_benchmark --sizes 25 50 100
+"""
+
+import argparse
+import copy
+import random
+import timeit
+
+from app.api.retrieval import (
+    CONTEXT_HEADER,
+    get_encoder,
+    pack_context,
+    render_context_block,
+)
+from app.index.upgrade import add_context_metadata
+
+WORDS = (
+    "davek dohodek zavezanec člen odstavek zakon davčna osnova obveznost plačilo prispevki "
+    "samostojni podjetnik DDV prag obdobje olajšava najemnina dividende"
+).split()
+
+
+class _Doc:
+    def __init__(self, page_content, metadata):
+        self.page_content = page_content
+        self.metadata = metadata
+
+
+def make_chunks(n, words_per_chunk, seed=0):
+    rng = random.Random(seed)
+    texts = [" ".join(rng.choices(WORDS, k=words_per_chunk)) for _ in range(n)]
+    sources = [
+        {"details_href_name": f"Zakon {i % 12}", "raw_filepath": f"https://pisrs.si/{i % 12}"}
+        for i in range(n)
+    ]
+    return texts, sources
+
+
+def legacy_pack_context(law_articles_text, law_articles_sources, max_context_len, model):
+    enc = get_encoder(model)
+    references = []
+    context = CONTEXT_HEADER
+    for article, source in zip(law_articles_text, law_articles_sources):
+        article_context = render_context_block(article, source)
+        tokens = enc.encode(context + article_context)
+        if len(tokens) < max_context_len:
+            context += article_context
+            references.append(source)
+    return context, references
+
+
+def main(args):
+    get_encoder(args.embedding_model)  # load the BPE file outside the timings
+    print(f"{'n':>5} {'legacy ms':>10} {'fallback ms':>12} {'precomputed ms':>15}")
+    for n in args.sizes:
+        texts, sources = make_chunks(n, args.words_per_chunk)
+        upgraded = [_Doc(text, copy.deepcopy(source)) for text, source in zip(texts, sources)]
+        add_context_metadata(upgraded, args.embedding_model)
+        upgraded_sources = [doc.metadata for doc in upgraded]
+
+        timings = []
+        for fn, pack_sources in (
+            (legacy_pack_context, sources),
+            (pack_context, sources),
+            (pack_context, upgraded_sources),
+        ):
+            total = timeit.timeit(
+                lambda: fn(texts, pack_sources, args.max_context_len, args.embedding_model),
+                number=args.repeat,
+            )
+            timings.append(1000 * total / args.repeat)
+        print(f"{n:>5} {timings[0]:>10.2f} {timings[1]:>12.2f} {timings[2]:>15.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Context packing micro-benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[25, 50, 100])
+    parser.add_argument("--words-per-chunk", type=int, default=150)
+    parser.add_argument("--max-context-len", type=int, default=16000)
+    parser.add_argument("--embedding-model", default="text-embedding-3-small")
+    parser.add_argument("--repeat", type=int, default=20)
+    main(parser.parse_args())
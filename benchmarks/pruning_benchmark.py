@@ -0,0 +1,195 @@
+"""Reranker input and packed context of the retrieved candidates with and without pruning.
+
+Builds a synthetic vector store of law articles split into consecutive chunks, a share of them
+indexed again as a later consolidated version of the law (the same chunks, a few words changed)
+and a share of their chunks indexed twice. Held-out questions are drawn from one article's words
+and retrieved as on the request path (find_candidates), then reranked by word overlap like the
+fake upstreams' reranker and the top `--rerank-max-n` packed into the context.
+
+Reports per setup the reranker input (candidates and words sent), the packed context tokens, the
+distinct articles in the context and the tokens spent per article, the share of questions whose
+article made it into the context and the p50 of the first stage retrieval.
+
+Example:
+    python -m benchmarks.pruning_benchmark --n-articles 2000 --k 25 --rerank-max-n 5
+"""
+
+import argparse
+import json
+import random
+import time
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.embeddings import FakeEmbeddings
+from langchain_community.vectorstores.faiss import FAISS
+from langchain_core.documents import Document
+
+from app.api.pruning import CandidatePruning
+from app.api.retrieval import find_candidates, get_encoder, pack_context
+from benchmarks.chat_benchmark import git_commit
+from benchmarks.fake_upstreams import EMBEDDING_DIM, hash_embedding, words
+from benchmarks.synthetic_index import BASE_WORDS, LAWS
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+
+def make_articles(n_articles, max_chunks=4, words_per_chunk=40, seed=0):
+    # Per article: law index, article number, its chunks. Each article has a few words of its own
+    rng = random.Random(seed)
+    articles = []
+    for i in range(n_articles):
+        law_index = i % len(LAWS)
+        vocabulary = rng.sample(BASE_WORDS, 10) + [f"pojem{i}x{j}" for j in range(4)]
+        chunks = [
+            " ".join(rng.choices(vocabulary, k=words_per_chunk))
+            for _ in range(rng.randint(1, max_chunks))
+        ]
+        articles.append((law_index, i // len(LAWS) + 1, chunks))
+    return articles
+
+
+def build_store(articles, consolidated_share, duplicate_share, seed=0):
+    rng = random.Random(seed)
+    texts, metadatas, article_ids = [], [], []
+
+    def add(article_id, version, chunk):
+        law_index, article, _ = articles[article_id]
+        law = LAWS[law_index] + version
+        texts.append(f"{article}. člen {law}: {chunk}")
+        metadatas.append(
+            {
+                "details_href_name": f"Zakon {law}",
+                "raw_filepath": f"https://pisrs.si/{law}#{article}",
+            }
+        )
+        article_ids.append(article_id)
+
+    for article_id, (_, _, chunks) in enumerate(articles):
+        for chunk in chunks:
+            add(article_id, "", chunk)
+            if rng.random() < duplicate_share:
+                add(article_id, "", chunk)
+    for article_id, (_, _, chunks) in enumerate(articles):
+        if rng.random() < consolidated_share:
+            for chunk in chunks:
+                chunk_words = chunk.split()
+                chunk_words[rng.randrange(len(chunk_words))] = rng.choice(BASE_WORDS)
+                add(article_id, "A", " ".join(chunk_words))
+
+    vectors = np.stack([hash_embedding(text) for text in texts]).astype(np.float32)
+    index = faiss.IndexFlatIP(EMBEDDING_DIM)
+    index.add(vectors)
+    ids = [str(i) for i in range(len(texts))]
+    docstore = InMemoryDocstore(
+        {
+            doc_id: Document(page_content=text, metadata={**metadata, "article": article_id})
+            for doc_id, text, metadata, article_id in zip(ids, texts, metadatas, article_ids)
+        }
+    )
+    db = FAISS(
+        FakeEmbeddings(size=EMBEDDING_DIM),
+        index,
+        docstore,
+        dict(enumerate(ids)),
+        distance_strategy="MAX_INNER_PRODUCT",
+    )
+    return db
+
+
+def make_questions(articles, n_questions, n_words=10, seed=11):
+    rng = random.Random(seed)
+    questions = []
+    for _ in range(n_questions):
+        article_id = rng.randrange(len(articles))
+        law_index, _, chunks = articles[article_id]
+        question = " ".join(rng.choices(" ".join(chunks).split(), k=n_words))
+        questions.append((article_id, f"Kaj pravi {LAWS[law_index]} o {question}?"))
+    return questions
+
+
+def rerank(question, candidates, top_n):
+    # Word overlap with the question, as the fake upstreams' reranker
+    question_words = set(words(question))
+    scores = [
+        len(question_words & set(words(doc.page_content))) / max(len(question_words), 1)
+        for doc, _ in candidates
+    ]
+    order = sorted(range(len(candidates)), key=lambda i: scores[i], reverse=True)
+    return [candidates[i][0] for i in order[:top_n]]
+
+
+def run(db, questions, args, pruning):
+    encoder = get_encoder(EMBEDDING_MODEL)
+    latencies, n_candidates, n_words, n_tokens, n_articles, found = [], [], [], [], [], []
+    for article_id, question in questions:
+        embedding = hash_embedding(question)
+        start = time.perf_counter()
+        [(candidates, _)] = find_candidates(
+            db, [question], [embedding], args.k, rerank_max_n=args.rerank_max_n, pruning=pruning
+        )
+        latencies.append(time.perf_counter() - start)
+        n_candidates.append(len(candidates))
+        n_words.append(sum(len(doc.page_content.split()) for doc, _ in candidates))
+        docs = rerank(question, candidates, args.rerank_max_n)
+        context, _ = pack_context(
+            [doc.page_content for doc in docs],
+            [doc.metadata for doc in docs],
+            args.max_context_len,
+            EMBEDDING_MODEL,
+        )
+        n_tokens.append(len(encoder.encode(context)))
+        packed = {doc.metadata["article"] for doc in docs}
+        n_articles.append(len(packed))
+        found.append(article_id in packed)
+    return {
+        "rerank_input_docs": float(np.mean(n_candidates)),
+        "rerank_input_words": float(np.mean(n_words)),
+        "context_tokens": float(np.mean(n_tokens)),
+        "context_articles": float(np.mean(n_articles)),
+        "tokens_per_article": float(np.sum(n_tokens) / np.sum(n_articles)),
+        "article_in_context": float(np.mean(found)),
+        "retrieval_p50_ms": float(np.percentile(1000 * np.array(latencies), 50)),
+    }
+
+
+def main(args):
+    articles = make_articles(args.n_articles)
+    db = build_store(articles, args.consolidated_share, args.duplicate_share)
+    questions = make_questions(articles, args.n_questions)
+    print(f"{db.index.ntotal} chunks of {len(articles)} articles, k={args.k}")
+    setups = {
+        "none": None,
+        "dedup": CandidatePruning(mmr_lambda=None, group=False),
+        "dedup+group": CandidatePruning(mmr_lambda=None),
+        "dedup+mmr+group": CandidatePruning(mmr_lambda=args.mmr_lambda),
+    }
+    results = {}
+    for setup, pruning in setups.items():
+        results[setup] = run(db, questions, args, pruning)
+        print(
+            f"{setup:>16} "
+            + " ".join(f"{key}={value:.3f}" for key, value in results[setup].items())
+        )
+
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key != "output"}
+        with open(args.output, "w") as f:
+            json.dump(
+                {"commit": git_commit(), "settings": settings, "results": results}, f, indent=2
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Candidate pruning before the rerank")
+    parser.add_argument("--n-articles", type=int, default=2000)
+    parser.add_argument("--n-questions", type=int, default=300)
+    parser.add_argument("--consolidated-share", type=float, default=0.3)
+    parser.add_argument("--duplicate-share", type=float, default=0.1)
+    parser.add_argument("--k", type=int, default=25)
+    parser.add_argument("--rerank-max-n", type=int, default=5)
+    parser.add_argument("--max-context-len", type=int, default=4096)
+    parser.add_argument("--mmr-lambda", type=float, default=0.7)
+    parser.add_argument("--output", help="Write the results as JSON")
+    main(parser.parse_args())
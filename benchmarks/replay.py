@@ -0,0 +1,348 @@
+"""Deterministic offline replay of the captured chat requests (see app.api.capture).
+
+Runs every captured request again through process_question_and_stream_response, on the given
+vector store, with the upstreams answering what they answered when it was captured: the OpenAI
+client is served the recorded reformulation and answer by an in-process transport, and the query
+embeddings and rerank results come from the capture. The settings of the captured config are
+reused, without the caches, the conversation store, admission control, deadlines and the SSE
+frame coalescing, and the FAISS search runs inline on the event loop, so a replay depends only on
+the capture and the index.
+
+Reports per stage the p50/p99 duration and checks that repeated replays (`--repeat`) stream the
+same bytes. With `--profile cprofile` (or `pyinstrument`, if installed) each stage is profiled
+separately, the code outside the stages as "other", and the profiles are written to
+`--profile-dir`: `<stage>.prof` for pstats/snakeviz, or `<stage>.html`. Stages that overlap in the
+speculative mode are attributed to the stage entered last, and the cumulative times of a profile
+include the stages entered below it, so compare the own (tottime) times.
+
+Example, on the index the requests were captured on:
+    python -m benchmarks.replay captures/requests.jsonl* --db-path vector_database \
+        --profile cprofile --profile-dir profiles/
+"""
+
+import argparse
+import asyncio
+import cProfile
+import hashlib
+import io
+import json
+import os
+import pstats
+import re
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import httpx
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from openai import AsyncOpenAI
+
+from app.api.capture import decode_vector, text_key
+from app.api.metrics import RequestTimings, current_stage_profiler, current_timings
+from app.api.openai_interface import Config, Message, process_question_and_stream_response
+from app.api.pruning import CandidatePruning
+from app.api.rerank import Reranker
+from app.api.retrieval import current_sources, get_index_version
+from app.index.store import load_vector_store
+from benchmarks.chat_benchmark import git_commit
+
+
+class ReplayMiss(KeyError):
+    """The replay asked an upstream something the capture has no answer for."""
+
+
+class RecordedUpstreams:
+    """The upstream responses of the request being replayed."""
+
+    def __init__(self):
+        self.record = None
+        self.n_reformulations = 0
+
+    def use(self, record):
+        self.record = record
+        self.n_reformulations = 0
+
+    def embedding(self, text):
+        key = text_key(text)
+        if key not in self.record["upstream"]["embeddings"]:
+            raise ReplayMiss(f"No captured embedding of {text!r}")
+        return decode_vector(self.record["upstream"]["embeddings"][key])
+
+    def rerank(self, query, top_n):
+        results = self.record["upstream"]["reranks"].get(text_key(query))
+        if results is None:
+            raise ReplayMiss(f"No captured rerank of {query!r}")
+        return [(i, score) for i, score in results[:top_n]]
+
+    def reformulation(self):
+        reformulations = self.record["upstream"]["reformulations"]
+        if not reformulations:
+            raise ReplayMiss("No captured reformulation")
+        question = reformulations[min(self.n_reformulations, len(reformulations) - 1)]
+        self.n_reformulations += 1
+        return question
+
+    def answer_deltas(self):
+        # The answer in as many word aligned deltas as were streamed
+        upstream = self.record["upstream"]
+        words = re.findall(r"\s*\S+", upstream["answer"]) or [""]
+        parts = np.array_split(np.array(words, dtype=object), max(upstream["answer_deltas"], 1))
+        return ["".join(part) for part in parts if len(part)]
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        # OpenAI chat completions: the JSON reformulation, or the streamed answer
+        body = json.loads(request.content)
+        if not body.get("stream"):
+            content = json.dumps({"reformulated_question": self.reformulation()})
+            return httpx.Response(
+                200,
+                json={
+                    "id": "replay",
+                    "object": "chat.completion",
+                    "created": 0,
+                    "model": body["model"],
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                },
+            )
+        events = []
+        for delta in self.answer_deltas():
+            chunk = {
+                "id": "replay",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": body["model"],
+                "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}],
+            }
+            events.append(f"data: {json.dumps(chunk)}\n\n")
+        events.append("data: [DONE]\n\n")
+        return httpx.Response(
+            200,
+            content="".join(events).encode(),
+            headers={"content-type": "text/event-stream"},
+        )
+
+
+class ReplayEmbeddings(Embeddings):
+    def __init__(self, upstreams: RecordedUpstreams, name):
+        self.upstreams = upstreams
+        self.name = name
+
+    def embed_documents(self, texts):
+        return [self.upstreams.embedding(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.upstreams.embedding(text)
+
+    async def aembed_documents(self, texts):
+        return self.embed_documents(texts)
+
+    async def aembed_query(self, text):
+        return self.embed_query(text)
+
+
+class ReplayReranker(Reranker):
+    name = "replay"
+
+    def __init__(self, upstreams: RecordedUpstreams):
+        super().__init__()
+        self.upstreams = upstreams
+
+    async def _rerank(self, query, documents, top_n):
+        return self.upstreams.rerank(query, top_n)
+
+
+class InlineExecutor(ThreadPoolExecutor):
+    """Runs the submitted calls right away, in the calling thread, instead of in the pool."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class StageProfiler:
+    """One profiler per stage, only the one of the innermost active stage running."""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.profilers = {}
+        self.active = []
+
+    def _profiler(self, name):
+        if name not in self.profilers:
+            if self.kind == "pyinstrument":
+                from pyinstrument import Profiler
+
+                self.profilers[name] = Profiler(async_mode="disabled")
+            else:
+                self.profilers[name] = cProfile.Profile()
+        return self.profilers[name]
+
+    def _start(self, name):
+        if self.kind == "pyinstrument":
+            self._profiler(name).start()
+        else:
+            self._profiler(name).enable()
+
+    def _stop(self, name):
+        if self.kind == "pyinstrument":
+            self.profilers[name].stop()
+        else:
+            self.profilers[name].disable()
+
+    def enter(self, name):
+        if self.active:
+            self._stop(self.active[-1])
+        self.active.append(name)
+        self._start(name)
+
+    def exit(self, name):
+        # Concurrent stages do not necessarily exit in the order they entered
+        self._stop(self.active[-1])
+        del self.active[len(self.active) - 1 - self.active[::-1].index(name)]
+        if self.active:
+            self._start(self.active[-1])
+
+    def write(self, profile_dir, top=15):
+        os.makedirs(profile_dir, exist_ok=True)
+        for name, profiler in self.profilers.items():
+            if self.kind == "pyinstrument":
+                with open(os.path.join(profile_dir, f"{name}.html"), "w") as f:
+                    f.write(profiler.output_html())
+                continue
+            profiler.dump_stats(os.path.join(profile_dir, f"{name}.prof"))
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("tottime").print_stats(top)
+            print(f"--- {name}\n" + out.getvalue().split("\n\n", 1)[-1].strip())
+
+
+def load_records(paths):
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def create_replay_config(db, settings, upstreams):
+    settings = dict(settings)
+    pruning = settings.pop("pruning", None)
+    return Config(
+        **{key: value for key, value in settings.items() if value is not None},
+        client=AsyncOpenAI(
+            api_key="replay",
+            base_url="http://replay/v1",
+            max_retries=0,
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(upstreams.handle)),
+        ),
+        db=db,
+        search_executor=InlineExecutor(),
+        # Every delta in its own frame, coalescing them depends on the timing
+        sse_flush_interval=0,
+        reranker=ReplayReranker(upstreams),
+        pruning=CandidatePruning(**pruning) if pruning is not None else None,
+    )
+
+
+async def replay(record, config, profiler=None):
+    """Streams the answer to the captured request. Returns its digest and the stage timings."""
+    current_sources.set(record["request"].get("sources"))
+    timings = RequestTimings()
+    current_timings.set(timings)
+    messages = [Message(**message) for message in record["request"]["messages"]]
+    digest = hashlib.sha256()
+    start = time.perf_counter()
+    if profiler is not None:
+        current_stage_profiler.set(profiler)
+        profiler.enter("other")
+    try:
+        async for chunk in process_question_and_stream_response(messages, config):
+            digest.update(chunk if isinstance(chunk, bytes) else chunk.encode())
+    finally:
+        if profiler is not None:
+            profiler.exit("other")
+    timings.add("total", time.perf_counter() - start)
+    return digest.hexdigest(), timings.durations
+
+
+async def replay_all(db, records, args):
+    upstreams = RecordedUpstreams()
+    db.embedding_function = ReplayEmbeddings(upstreams, "replay")
+    profiler = StageProfiler(args.profile) if args.profile else None
+    durations, digests, misses = {}, {}, 0
+    for _ in range(args.repeat):
+        for record in records:
+            upstreams.use(record)
+            config = create_replay_config(db, record["settings"], upstreams)
+            try:
+                # A task per request, so that its context variables do not leak into the next
+                digest, timings = await asyncio.create_task(replay(record, config, profiler))
+            except ReplayMiss as e:
+                misses += 1
+                print(f"{record['id']}: {e}")
+                continue
+            digests.setdefault(record["id"], set()).add(digest)
+            for name, seconds in timings.items():
+                durations.setdefault(name, []).append(1000 * seconds)
+    if profiler is not None:
+        profiler.write(args.profile_dir)
+    return durations, digests, misses
+
+
+def main(args):
+    records = load_records(args.captures)[: args.limit]
+    db = load_vector_store(args.db_path, None, mmap=not args.no_mmap)
+    index_version = get_index_version(args.db_path)
+    other_versions = {r["settings"].get("index_version") for r in records} - {index_version, None}
+    if other_versions:
+        print(f"Captured on other index versions {other_versions}, the replay may differ")
+
+    durations, digests, misses = asyncio.run(replay_all(db, records, args))
+    results = {
+        "requests": len(records),
+        "misses": misses,
+        "nondeterministic": sum(len(d) > 1 for d in digests.values()),
+        "stages_ms": {
+            name: {
+                "p50": float(np.percentile(values, 50)),
+                "p99": float(np.percentile(values, 99)),
+                "n": len(values),
+            }
+            for name, values in durations.items()
+        },
+    }
+    print(
+        f"{results['requests']} requests x {args.repeat}, {misses} misses, "
+        f"{results['nondeterministic']} nondeterministic"
+    )
+    for name, stats in results["stages_ms"].items():
+        print(f"{name:>12} p50={stats['p50']:.2f}ms p99={stats['p99']:.2f}ms n={stats['n']}")
+
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key != "output"}
+        with open(args.output, "w") as f:
+            json.dump(
+                {"commit": git_commit(), "settings": settings, "results": results}, f, indent=2
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay captured chat requests offline")
+    parser.add_argument("captures", nargs="+", help="Capture files (REQUEST_CAPTURE_PATH)")
+    parser.add_argument("--db-path", default=os.getenv("VECTOR_DB_PATH"))
+    parser.add_argument("--no-mmap", action="store_true", help="Load the FAISS index into memory")
+    parser.add_argument("--limit", type=int, help="Replay only the first requests")
+    parser.add_argument("--repeat", type=int, default=2)
+    parser.add_argument("--profile", choices=("cprofile", "pyinstrument"))
+    parser.add_argument("--profile-dir", default="profiles")
+    parser.add_argument("--output", help="Write the results as JSON")
+    main(parser.parse_args())
@@ -0,0 +1,123 @@
+"""Tail latency of /api/chat with occasionally stalling upstreams, with and without the resilience
+policies (deadlines, hedging and retries, app.api.resilience).
+
+The fake upstreams stall a fraction (`--stall-rate`) of the embedding, rerank and reformulation
+calls for `--stall-latency` seconds. Chats of three messages (so that the question is reformulated)
+are sent by `--concurrency` clients, until `--requests` have been sent.
+
+Reports the TTFB percentiles, the requests whose TTFB exceeded the 30 s Cloud Run request timeout
+(`--request-timeout`) or that failed, and the hedged calls and fallbacks counted by the server.
+
+Example:
+    python -m benchmarks.resilience_benchmark --requests 400 --stall-rate 0.02 --stall-latency 20
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import tempfile
+import time
+
+import httpx
+import numpy as np
+
+from benchmarks.chat_benchmark import git_commit, start_servers
+from benchmarks.synthetic_index import make_questions
+
+COUNTER_PATTERN = re.compile(r"^taxgpt_(fallbacks|hedged_calls)_total\{(.*)\} (\S+)$", re.M)
+
+
+async def run(args, url):
+    questions = make_questions(args.requests)
+    ttfbs, failed = [], 0
+    limits = httpx.Limits(max_connections=args.concurrency + 1)
+    async with httpx.AsyncClient(
+        base_url=url, timeout=args.request_timeout, limits=limits
+    ) as client:
+
+        async def worker():
+            nonlocal failed
+            while questions:
+                messages = [
+                    {"role": "user", "content": "Kako se obdavči dohodek iz dejavnosti?"},
+                    {"role": "assistant", "content": "Z dohodnino, po pravilih za dejavnost."},
+                    {"role": "user", "content": questions.pop()},
+                ]
+                start = time.perf_counter()
+                try:
+                    async with client.stream(
+                        "POST", "/api/chat", json={"messages": messages}
+                    ) as response:
+                        response.raise_for_status()
+                        async for _ in response.aiter_raw():
+                            ttfbs.append(time.perf_counter() - start)
+                            break
+                except (httpx.HTTPError, httpx.StreamError):
+                    failed += 1
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        counters = {}
+        for name, labels, value in COUNTER_PATTERN.findall((await client.get("/metrics")).text):
+            counters[f"{name}{{{labels}}}"] = float(value)
+    return {
+        "requests": args.requests,
+        "failed_or_timed_out": failed,
+        "ttfb_p50_ms": float(np.percentile(ttfbs, 50)) * 1000 if ttfbs else None,
+        "ttfb_p99_ms": float(np.percentile(ttfbs, 99)) * 1000 if ttfbs else None,
+        "ttfb_max_ms": max(ttfbs) * 1000 if ttfbs else None,
+        "counters": counters,
+    }
+
+
+def main(args, upstream_args):
+    upstream_args = upstream_args + [
+        "--stall-rate",
+        str(args.stall_rate),
+        "--stall-latency",
+        str(args.stall_latency),
+    ]
+    results = {}
+    print(f"{'setup':>12} {'failed':>7} {'TTFB p50':>9} {'TTFB p99':>9} {'TTFB max':>9}")
+    for setup, server_args in (("plain", []), ("resilience", ["--resilience"])):
+        processes = []
+        with tempfile.TemporaryDirectory() as workdir:
+            try:
+                url, processes = start_servers(args, upstream_args, workdir, server_args)
+                result = asyncio.run(run(args, url))
+            finally:
+                for process in processes:
+                    process.terminate()
+                    process.wait()
+        results[setup] = result
+        print(
+            f"{setup:>12} {result['failed_or_timed_out']:>7} {result['ttfb_p50_ms'] or 0:>7.0f}ms "
+            f"{result['ttfb_p99_ms'] or 0:>7.0f}ms {result['ttfb_max_ms'] or 0:>7.0f}ms"
+        )
+        for name, value in sorted(result["counters"].items()):
+            print(f"{'':>12} {name} {value:.0f}")
+
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key != "output"}
+        settings["upstream_args"] = upstream_args
+        with open(args.output, "w") as f:
+            json.dump(
+                {"commit": git_commit(), "settings": settings, "results": results}, f, indent=2
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tail latency with stalling upstreams")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--stall-rate", type=float, default=0.02)
+    parser.add_argument("--stall-latency", type=float, default=20.0)
+    parser.add_argument("--request-timeout", type=float, default=30.0)
+    parser.add_argument("--db-path", help="Vector store to serve, default: a synthetic one")
+    parser.add_argument("--n-chunks", type=int, default=2000)
+    parser.add_argument("--pipeline-mode", default="speculative")
+    parser.add_argument("--caches", action="store_true")
+    parser.add_argument("--port", type=int, default=8186)
+    parser.add_argument("--upstream-port", type=int, default=9196)
+    parser.add_argument("--output", help="Write the results as JSON")
+    main(*parser.parse_known_args())
@@ -0,0 +1,117 @@
+"""Search cost and candidate pool of the routed law family shards against the whole index.
+
+Builds the shards (app.index.shards) of a synthetic vector store and searches held-out questions
+one at a time, as on the request path, once in the whole index and once in the shards they are
+routed to. Two question sets: questions naming their law ("Kaj pravi ZDDV-1 o ..."), routed by
+keyword, and the same questions without the law, routed by centroid with `--centroid-margin`.
+
+Reports per set the search p50/p99, the shards searched per question, the purity of the top k
+(the share of the candidates from the asked law) and the overlap of the routed top k with the top
+k of the whole index.
+
+Example:
+    python -m benchmarks.shard_benchmark --n-chunks 100000 --k 25 --centroid-margin 0.02
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from app.api.retrieval import dense_search
+from app.index.shards import build_shards
+from app.index.store import load_vector_store
+from benchmarks.chat_benchmark import git_commit
+from benchmarks.fake_upstreams import hash_embedding
+from benchmarks.synthetic_index import LAWS, build_synthetic_index, make_corpus
+
+
+def make_heldout_questions(n_questions, n_words=12, seed=11):
+    # (law index, question naming the law, the same question without it)
+    rng = random.Random(seed)
+    vocabularies = make_corpus(0, seed=0)[2]
+    questions = []
+    for _ in range(n_questions):
+        law_index = rng.randrange(len(LAWS))
+        words = " ".join(rng.choices(vocabularies[law_index], k=n_words))
+        questions.append((law_index, f"Kaj pravi {LAWS[law_index]} o {words}?", f"{words}?"))
+    return questions
+
+
+def run(db, laws, questions, k, routed, centroid_margin, max_shards):
+    shard_index = db.shard_index
+    latencies, purities, overlaps, n_shards = [], [], [], []
+    for law_index, question in questions:
+        embedding = hash_embedding(question)
+        _, full_indices = dense_search(db, [embedding], k)
+        start = time.perf_counter()
+        route = None
+        if routed:
+            route = shard_index.route(question, embedding, None, centroid_margin, max_shards)
+        _, indices = dense_search(db, [embedding], k, shard_index, [route])
+        latencies.append(time.perf_counter() - start)
+        hits = [int(i) for i in indices[0] if i >= 0]
+        purities.append(np.mean([laws[i] == law_index for i in hits]))
+        overlaps.append(len(set(hits) & set(full_indices[0].tolist())) / k)
+        n_shards.append(len(shard_index.names) if route is None else len(route))
+    latencies_ms = 1000 * np.array(latencies)
+    return {
+        "search_p50_ms": float(np.percentile(latencies_ms, 50)),
+        "search_p99_ms": float(np.percentile(latencies_ms, 99)),
+        "shards_searched": float(np.mean(n_shards)),
+        f"purity_at_{k}": float(np.mean(purities)),
+        f"overlap_at_{k}_with_full": float(np.mean(overlaps)),
+    }
+
+
+def main(args):
+    questions = make_heldout_questions(args.n_questions)
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = build_synthetic_index(os.path.join(workdir, "db"), args.n_chunks)
+        build_shards(db_path)
+        db = load_vector_store(db_path, None, mmap=False)
+        # The synthetic chunks cycle through the laws
+        laws = np.arange(db.index.ntotal) % len(LAWS)
+        print(f"{args.n_chunks} chunks in {len(db.shard_index.names)} shards, k={args.k}")
+        for name, question_set in (
+            ("named", [(law, named) for law, named, _ in questions]),
+            ("unnamed", [(law, unnamed) for law, _, unnamed in questions]),
+        ):
+            for routed in (False, True):
+                setup = f"{name}/{'routed' if routed else 'full'}"
+                results[setup] = run(
+                    db,
+                    laws,
+                    question_set,
+                    args.k,
+                    routed,
+                    args.centroid_margin,
+                    args.max_shards,
+                )
+                print(
+                    f"{setup:>16} "
+                    + " ".join(f"{key}={value:.3f}" for key, value in results[setup].items())
+                )
+
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key != "output"}
+        with open(args.output, "w") as f:
+            json.dump(
+                {"commit": git_commit(), "settings": settings, "results": results}, f, indent=2
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Routed shards vs the whole index")
+    parser.add_argument("--n-chunks", type=int, default=100000)
+    parser.add_argument("--n-questions", type=int, default=500)
+    parser.add_argument("--k", type=int, default=25)
+    parser.add_argument("--centroid-margin", type=float, default=0.02)
+    parser.add_argument("--max-shards", type=int, default=3)
+    parser.add_argument("--output", help="Write the results as JSON")
+    main(parser.parse_args())
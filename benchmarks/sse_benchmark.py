@@ -0,0 +1,164 @@
+"""Frames, CPU and smoothness of the SSE encoding of streamed answers.
+
+Simulates `--streams` concurrent answers, each a sequence of 1-4 character deltas arriving at
+`--token-rate` per second, and sends them over local sockets either as one frame per delta (the
+previous encoding) or through app.api.sse.coalesce_events. The client side parses the events back,
+checks that the reassembled text is unchanged, and measures for every delta how long after it was
+generated it reached the client.
+
+Reports per encoding the frames sent per second, the CPU time per stream (both socket ends run in
+this process) and the delivery latency percentiles, the client-perceived smoothness.
+
+Example:
+    python -m benchmarks.sse_benchmark --streams 80 --deltas 300 --token-rate 50
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import socket
+import time
+
+import numpy as np
+
+from app.api.sse import coalesce_events
+
+DELTAS = ["a", "ob", "ve", "za", "nost", " ", ". ", "\n", "č", "člen", " 5", "\n\n- ", "**"]
+
+
+def encode_per_delta(content):
+    # The previous encoding: one frame per delta, a str encoded by the server on every write
+    return ("\n".join("data: " + line for line in content.split("\n")) + "\n\n").encode()
+
+
+async def per_delta_frames(texts):
+    async for text in texts:
+        yield encode_per_delta(text)
+
+
+async def generate_deltas(n_deltas, token_rate, rng, generated):
+    for _ in range(n_deltas):
+        await asyncio.sleep(rng.expovariate(token_rate))
+        text = rng.choice(DELTAS)
+        generated.append((time.perf_counter(), text))
+        yield text
+
+
+def parse_events(data):
+    texts = []
+    for event in data.split("\n\n"):
+        if event:
+            texts.append("\n".join(line[len("data: ") :] for line in event.split("\n")))
+    return "".join(texts)
+
+
+async def run_stream(encoding, args, seed):
+    rng = random.Random(seed)
+    server_socket, client_socket = socket.socketpair()
+    _, writer = await asyncio.open_connection(sock=server_socket)
+    reader, client_writer = await asyncio.open_connection(sock=client_socket)
+    generated = []
+    texts = generate_deltas(args.deltas, args.token_rate, rng, generated)
+    if encoding == "per_delta":
+        frames = per_delta_frames(texts)
+    else:
+        frames = coalesce_events(
+            texts,
+            flush_interval=args.flush_interval,
+            flush_bytes=args.flush_bytes,
+            flush_on_newline=not args.no_newline_flush,
+        )
+    n_frames = 0
+
+    async def send():
+        nonlocal n_frames
+        async for frame in frames:
+            writer.write(frame)
+            await writer.drain()
+            n_frames += 1
+        writer.close()
+
+    async def receive():
+        pending, received_text, latencies = "", "", []
+        delivered, delivered_chars = 0, 0
+        while True:
+            chunk = await reader.read(1 << 16)
+            if not chunk:
+                break
+            now = time.perf_counter()
+            pending += chunk.decode()
+            complete, _, pending = pending.rpartition("\n\n")
+            if not complete:
+                continue
+            # Every delta completed by the newly received text was delivered now
+            received_text += parse_events(complete + "\n\n")
+            while delivered < len(generated):
+                generated_at, text = generated[delivered]
+                if delivered_chars + len(text) > len(received_text):
+                    break
+                latencies.append(now - generated_at)
+                delivered += 1
+                delivered_chars += len(text)
+        client_writer.close()
+        return received_text, latencies
+
+    _, (received_text, latencies) = await asyncio.gather(send(), receive())
+    return {
+        "frames": n_frames,
+        "text_ok": received_text == "".join(text for _, text in generated),
+        "latencies": latencies,
+    }
+
+
+async def run_encoding(encoding, args):
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    results = await asyncio.gather(
+        *(run_stream(encoding, args, seed) for seed in range(args.streams))
+    )
+    cpu_time, wall_time = time.process_time() - cpu_start, time.perf_counter() - wall_start
+    latencies = 1000 * np.array([latency for result in results for latency in result["latencies"]])
+    frames = sum(result["frames"] for result in results)
+    return {
+        "encoding": encoding,
+        "streams": args.streams,
+        "frames": frames,
+        "frames_per_s": frames / wall_time,
+        "cpu_ms_per_stream": 1000 * cpu_time / args.streams,
+        "delivery_p50_ms": float(np.percentile(latencies, 50)),
+        "delivery_p99_ms": float(np.percentile(latencies, 99)),
+        "delivery_max_ms": float(latencies.max()),
+        "text_ok": all(result["text_ok"] for result in results),
+    }
+
+
+async def main(args):
+    print(
+        f"{'encoding':>10} {'frames':>8} {'frames/s':>9} {'CPU ms/stream':>14} "
+        f"{'delivery p50':>13} {'p99':>8} {'max':>8} {'text ok':>8}"
+    )
+    results = []
+    for encoding in ("per_delta", "coalesced"):
+        result = await run_encoding(encoding, args)
+        results.append(result)
+        print(
+            f"{encoding:>10} {result['frames']:>8} {result['frames_per_s']:>9.0f} "
+            f"{result['cpu_ms_per_stream']:>14.1f} {result['delivery_p50_ms']:>11.1f}ms "
+            f"{result['delivery_p99_ms']:>6.1f}ms {result['delivery_max_ms']:>6.1f}ms "
+            f"{str(result['text_ok']):>8}"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SSE encoding benchmark")
+    parser.add_argument("--streams", type=int, default=80)
+    parser.add_argument("--deltas", type=int, default=300)
+    parser.add_argument("--token-rate", type=float, default=50.0)
+    parser.add_argument("--flush-interval", type=float, default=0.03)
+    parser.add_argument("--flush-bytes", type=int, default=1024)
+    parser.add_argument("--no-newline-flush", action="store_true")
+    parser.add_argument("--output", help="Write the results as JSON")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,84 @@
+"""Startup time and memory of the vector store loading modes.
+
+Each mode is loaded in a fresh subprocess, which reports the load time, the resident memory after
+loading, and after a first search. The modes are:
+    pickle: FAISS.load_local, the index read into RAM and the full docstore unpickled
+    mmap:   load_vector_store, the memory-mapped index and the SQLite docstore (if converted)
+
+Example:
+    python -m benchmarks.startup_benchmark --db-path vector_database
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def measure(mode, db_path):
+    from langchain_community.embeddings import FakeEmbeddings
+
+    baseline_rss = rss_mb()
+    start = time.perf_counter()
+    if mode == "pickle":
+        from langchain_community.vectorstores.faiss import FAISS
+
+        db = FAISS.load_local(db_path, FakeEmbeddings(size=1), allow_dangerous_deserialization=True)
+    else:
+        from app.index.store import load_vector_store
+
+        db = load_vector_store(db_path, FakeEmbeddings(size=1), mmap=True)
+    load_time = time.perf_counter() - start
+    loaded_rss = rss_mb()
+
+    query = np.random.default_rng(0).normal(size=db.index.d).astype(np.float32)
+    start = time.perf_counter()
+    db.similarity_search_with_score_by_vector(query.tolist(), k=25)
+    first_search_time = time.perf_counter() - start
+    return {
+        "mode": mode,
+        "load_time_s": load_time,
+        "first_search_s": first_search_time,
+        "rss_loaded_mb": loaded_rss - baseline_rss,
+        "rss_after_search_mb": rss_mb() - baseline_rss,
+    }
+
+
+def main(args):
+    print(
+        f"{'mode':>7} {'load s':>8} {'1st search s':>13} "
+        f"{'RSS loaded MB':>14} {'RSS search MB':>14}"
+    )
+    for mode in args.modes:
+        command = [sys.executable, "-m", "benchmarks.startup_benchmark", "--child", mode]
+        output = subprocess.run(
+            command + ["--db-path", args.db_path], check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{result['mode']:>7} {result['load_time_s']:>8.2f} {result['first_search_s']:>13.3f} "
+            f"{result['rss_loaded_mb']:>14.1f} {result['rss_after_search_mb']:>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vector store startup benchmark")
+    parser.add_argument("--db-path", required=True)
+    parser.add_argument("--modes", nargs="+", default=["pickle", "mmap"])
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(measure(args.child, args.db_path)))
+    else:
+        main(args)
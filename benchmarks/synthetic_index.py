@@ -0,0 +1,94 @@
+"""Small synthetic vector store and questions for the offline benchmarks.
+
+Chunks are drawn from a per-law vocabulary and embedded with the hashed bag-of-words embeddings of
+the fake upstreams, so questions built from a law's words retrieve that law's chunks with
+realistic similarity scores, and enough of them to exercise the reranker.
+
+Example:
+    python -m benchmarks.synthetic_index --db-path /tmp/synthetic_db --n-chunks 5000
+"""
+
+import argparse
+import random
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.embeddings import FakeEmbeddings
+from langchain_community.vectorstores.faiss import FAISS
+from langchain_core.documents import Document
+
+from benchmarks.fake_upstreams import EMBEDDING_DIM, hash_embedding
+
+BASE_WORDS = (
+    "davek dohodek zavezanec člen odstavek zakon davčna osnova obveznost plačilo prispevki "
+    "samostojni podjetnik DDV prag obdobje olajšava najemnina dividende dediščina darilo "
+    "nepremičnina pokojnina plača regres izvoz uvoz račun odbitek stopnja oprostitev akontacija "
+    "napoved odločba rok obresti kazen globa družba delež kapital dobiček izguba amortizacija "
+    "stroški prihodki"
+).split()
+LAWS = ["ZDoh-2", "ZDDV-1", "ZDDPO-2", "ZDavP-2", "ZPIZ-2", "ZDDD", "ZDavNepr", "ZTro-1"]
+
+
+def law_vocabulary(law_index, rng, size=30):
+    return [law.lower() for law in LAWS[law_index : law_index + 1]] + rng.sample(BASE_WORDS, size)
+
+
+def make_corpus(n_chunks, words_per_chunk=25, seed=0):
+    rng = random.Random(seed)
+    vocabularies = [law_vocabulary(i, rng) for i in range(len(LAWS))]
+    texts, sources = [], []
+    for i in range(n_chunks):
+        law_index = i % len(LAWS)
+        article = i // len(LAWS) + 1
+        body = " ".join(rng.choices(vocabularies[law_index], k=words_per_chunk))
+        texts.append(f"{article}. člen {LAWS[law_index]}: {body}")
+        sources.append(
+            {
+                "details_href_name": f"Zakon {LAWS[law_index]}",
+                "raw_filepath": f"https://pisrs.si/{LAWS[law_index]}#{article}",
+            }
+        )
+    return texts, sources, vocabularies
+
+
+def make_questions(n_questions, n_words=12, seed=1):
+    rng = random.Random(seed)
+    vocabularies = make_corpus(0, seed=0)[2]
+    questions = []
+    for i in range(n_questions):
+        law_index = rng.randrange(len(LAWS))
+        question = " ".join(rng.choices(vocabularies[law_index], k=n_words))
+        questions.append(f"Kaj pravi {LAWS[law_index]} o {question}?")
+    return questions
+
+
+def build_synthetic_index(db_path, n_chunks=2000, dim=EMBEDDING_DIM, seed=0):
+    texts, sources, _ = make_corpus(n_chunks, seed=seed)
+    vectors = np.stack([hash_embedding(text, dim) for text in texts]).astype(np.float32)
+    index = faiss.IndexFlatIP(dim)
+    index.add(vectors)
+    ids = [str(i) for i in range(n_chunks)]
+    docstore = InMemoryDocstore(
+        {
+            doc_id: Document(page_content=text, metadata=source)
+            for doc_id, text, source in zip(ids, texts, sources)
+        }
+    )
+    db = FAISS(
+        FakeEmbeddings(size=dim),
+        index,
+        docstore,
+        dict(enumerate(ids)),
+        distance_strategy="MAX_INNER_PRODUCT",
+    )
+    db.save_local(db_path)
+    return db_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a synthetic vector store")
+    parser.add_argument("--db-path", required=True)
+    parser.add_argument("--n-chunks", type=int, default=2000)
+    args = parser.parse_args()
+    build_synthetic_index(args.db_path, args.n_chunks)
@@ -0,0 +1,191 @@
+"""Throughput and memory of the server as the number of gunicorn workers goes up.
+
+Runs the chat server under gunicorn with the production settings (gunicorn_conf.py) on the fake
+upstreams and a synthetic vector store, for every worker count, once with the index preloaded in
+the master and shared by the forked workers, and once loaded by every worker. The server processes
+are pinned to `--cpus` CPUs, like the 2 CPUs of a Cloud Run instance.
+
+Reports the throughput and TTFB of /api/chat, and the peak RSS and PSS summed over the master and
+its workers. RSS counts shared pages once per process, PSS splits them between the processes
+sharing them, so the PSS sum is the memory the instance actually uses.
+
+Example:
+    python -m benchmarks.workers_benchmark --workers 1 2 4 --cpus 2 --n-chunks 50000 --no-mmap
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.chat_benchmark import git_commit, run_endpoint, wait_until_up
+from benchmarks.synthetic_index import build_synthetic_index, make_questions
+
+
+def process_tree(pid):
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        return pids
+    for child in children:
+        pids.extend(process_tree(child))
+    return pids
+
+
+def memory_mb(pid):
+    """RSS and PSS in MB, summed over the process and its descendants."""
+    rss, pss = 0, 0
+    for process in process_tree(pid):
+        try:
+            with open(f"/proc/{process}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Rss:"):
+                        rss += int(line.split()[1])
+                    elif line.startswith("Pss:"):
+                        pss += int(line.split()[1])
+        except OSError:
+            continue
+    return rss / 1024, pss / 1024
+
+
+def pin_to_cpus(n_cpus):
+    cpus = sorted(os.sched_getaffinity(0))[:n_cpus]
+    return lambda: os.sched_setaffinity(0, cpus)
+
+
+def start_gunicorn(args, workers, preload, db_path, upstream_url):
+    server_args = ["--db-path", db_path, "--upstream-url", upstream_url]
+    server_args += ["--pipeline-mode", args.pipeline_mode] + (["--no-mmap"] if args.no_mmap else [])
+    env = dict(
+        os.environ,
+        PORT=str(args.port),
+        WEB_CONCURRENCY=str(workers),
+        PRELOAD_INDEX="1" if preload else "0",
+        LOG_LEVEL="warning",
+        BENCH_SERVER_ARGS=shlex.join(server_args),
+    )
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "-c",
+            "gunicorn_conf.py",
+            "--access-logfile",
+            "/dev/null",
+            "benchmarks.bench_server:create_bench_app_from_env()",
+        ],
+        env=env,
+        preexec_fn=pin_to_cpus(args.cpus),
+    )
+    url = f"http://127.0.0.1:{args.port}"
+    wait_until_up(url, timeout=300)
+    return url, process
+
+
+async def measure(args, url, pid, questions):
+    peak = [0.0, 0.0]
+    done = False
+
+    async def sample_memory():
+        while not done:
+            rss, pss = memory_mb(pid)
+            peak[0], peak[1] = max(peak[0], rss), max(peak[1], pss)
+            await asyncio.sleep(0.5)
+
+    sampler = asyncio.create_task(sample_memory())
+    idle_rss, idle_pss = memory_mb(pid)
+    result = await run_endpoint(
+        url, "/api/chat", args.concurrency, args.duration, questions, args.timeout
+    )
+    done = True
+    await sampler
+    result.update(
+        {
+            "idle_rss_mb": idle_rss,
+            "idle_pss_mb": idle_pss,
+            "peak_rss_mb": peak[0],
+            "peak_pss_mb": peak[1],
+        }
+    )
+    return result
+
+
+def main(args, upstream_args):
+    questions = make_questions(args.n_questions)
+    results = []
+    print(
+        f"{'workers':>7} {'mode':>10} {'rps':>6} {'errors':>6} {'ttfb p50':>9} {'ttfb p99':>9} "
+        f"{'idle PSS':>9} {'peak RSS':>9} {'peak PSS':>9}"
+    )
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = args.db_path
+        if db_path is None:
+            db_path = os.path.join(workdir, "synthetic_db")
+            build_synthetic_index(db_path, args.n_chunks)
+        upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+        upstream = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.fake_upstreams", "--port", str(args.upstream_port)]
+            + upstream_args
+        )
+        try:
+            wait_until_up(f"{upstream_url}/stats")
+            for workers in args.workers:
+                for mode in args.modes:
+                    url, server = start_gunicorn(
+                        args, workers, mode == "preload", db_path, upstream_url
+                    )
+                    try:
+                        # Every worker has loaded its config before the measurement starts
+                        time.sleep(args.warmup)
+                        result = asyncio.run(measure(args, url, server.pid, questions))
+                    finally:
+                        server.terminate()
+                        server.wait()
+                    result.update({"workers": workers, "mode": mode, "cpus": args.cpus})
+                    results.append(result)
+                    print(
+                        f"{workers:>7} {mode:>10} {result['throughput_rps']:>6.1f} "
+                        f"{result['errors']:>6} {result['ttfb_p50_ms'] or 0:>7.0f}ms "
+                        f"{result['ttfb_p99_ms'] or 0:>7.0f}ms {result['idle_pss_mb']:>7.0f}MB "
+                        f"{result['peak_rss_mb']:>7.0f}MB {result['peak_pss_mb']:>7.0f}MB"
+                    )
+        finally:
+            upstream.terminate()
+            upstream.wait()
+
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key != "output"}
+        settings["upstream_args"] = upstream_args
+        with open(args.output, "w") as f:
+            json.dump(
+                {"commit": git_commit(), "settings": settings, "results": results}, f, indent=2
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput and memory per gunicorn worker count")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--modes", nargs="+", default=["preload", "per_worker"])
+    parser.add_argument("--cpus", type=int, default=2, help="CPUs the server processes may use")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--n-questions", type=int, default=200)
+    parser.add_argument("--db-path", help="Vector store to serve, default: a synthetic one")
+    parser.add_argument("--n-chunks", type=int, default=20000)
+    parser.add_argument("--no-mmap", action="store_true", help="Load the FAISS index into memory")
+    parser.add_argument("--pipeline-mode", default="speculative")
+    parser.add_argument("--port", type=int, default=8184)
+    parser.add_argument("--upstream-port", type=int, default=9194)
+    parser.add_argument("--output", help="Write the results as JSON")
+    main(*parser.parse_known_args())
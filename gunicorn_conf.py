@@ -0,0 +1,42 @@
+"""Gunicorn settings of the container: uvicorn workers forked from a master that preloads the index.
+
+    gunicorn -c gunicorn_conf.py "app.app:create_app(preload_index=True)"
+
+The vector store is loaded once in the master (see app.app.create_app), and the workers share its
+pages: the memory-mapped FAISS index through the page cache, the rest copy-on-write. Run with
+PRELOAD_INDEX=0 to load the index in every worker instead.
+"""
+
+import gc
+import multiprocessing
+import os
+import tempfile
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+worker_class = "uvicorn_worker.UvicornWorker"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+preload_app = os.environ.get("PRELOAD_INDEX", "1") == "1"
+# The answers stream for up to a minute
+timeout = int(os.environ.get("WORKER_TIMEOUT", 120))
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+keepalive = 5
+loglevel = os.environ.get("LOG_LEVEL", "info")
+accesslog = "-"
+
+# The workers write their metrics to files that /metrics aggregates. Set before prometheus_client
+# is first imported (by the app), as it picks the storage of the metrics on import
+if workers > 1 and "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="prometheus-")
+
+
+def when_ready(server):
+    # Objects loaded so far are never freed, so the garbage collector of the workers does not touch
+    # (and copy) their pages
+    gc.freeze()
+
+
+def child_exit(server, worker):
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
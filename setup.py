@@ -6,6 +6,6 @@ with open("requirements.txt") as f:
 setup(
     name="taxgpt-backend",
     version="0.1",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     install_requires=requirements,
 )
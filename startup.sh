@@ -1,3 +1,3 @@
 #!/bin/bash
 export PORT=${PORT:-8000}
-exec python -m app.app
\ No newline at end of file
+exec gunicorn -c gunicorn_conf.py "app.app:create_app(preload_index=True)"